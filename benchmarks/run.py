@@ -0,0 +1,151 @@
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from compiler.driver import compile_source
+from compiler.passes import PassManager
+from compiler.assembler_8086 import assemble_with_symbols
+from compiler.sim_8086 import run as simulate
+from . import synth
+
+# Benchmark runner: compiles every benchmarks/*.ql program and the synthetic
+# generators, records per-pass compile time, peak memory and generated-code
+# metrics, and compares them against benchmarks/baseline.json.
+#
+#   python -m benchmarks.run                     compare with the baseline
+#   python -m benchmarks.run --update-baseline   record a new baseline
+#   python -m benchmarks.run --only sieve --json out.json
+
+BENCH_DIR = Path(__file__).resolve().parent
+BASELINE = BENCH_DIR / "baseline.json"
+
+# Compile-only: most of these are too large for a 64 KiB .COM image
+SYNTHETIC: Dict[str, Callable[[], str]] = {
+    "synth_functions": lambda: synth.many_functions(2000),
+    "synth_nesting": lambda: synth.deep_nesting(200),
+    "synth_expression": lambda: synth.long_expression(800),
+}
+
+# Passes shown in the table; all recorded passes go into the JSON
+PHASES = ("lex", "parse", "sema", "codegen")
+
+# Deterministic for a given compiler: any growth past --threshold fails
+CODE_METRICS = ("instructions", "com_bytes", "cycles")
+# Machine-dependent metrics (every "<pass>_ms" and peak_kib) are only compared
+# with --check-compile, against --time-threshold. Timing differences smaller
+# than this are noise.
+TIME_FLOOR_MS = 2.0
+
+def time_passes(src: str, repeat: int) -> Dict[str, float]:
+    # Best of `repeat` runs per pass, in milliseconds
+    best: Dict[str, float] = {}
+    for _ in range(repeat):
+        pm = PassManager()
+        compile_source(src, pm)
+        for t in pm.timings:
+            best[t.name] = min(best.get(t.name, float("inf")), t.seconds * 1000)
+    return {f"{name}_ms": round(ms, 3) for name, ms in best.items()}
+
+def measure(name: str, src: str, runnable: bool, repeat: int) -> Dict[str, object]:
+    result: Dict[str, object] = dict(time_passes(src, repeat))
+    # A separate run: tracemalloc slows the passes it watches
+    pm = PassManager(track_memory=True)
+    asm = compile_source(src, pm)
+    result["peak_kib"] = pm.peak_bytes() // 1024
+    result["instructions"] = pm.stats["instructions"]
+    result["com_bytes"] = result["cycles"] = result["stdout"] = None
+    if runnable:
+        image, symbols = assemble_with_symbols(asm, name)
+        run = simulate(image, symbols)
+        result["com_bytes"] = len(image)
+        result["cycles"] = run.cycles
+        result["stdout"] = run.stdout.decode("latin-1")
+    return result
+
+def collect(only: Optional[List[str]], repeat: int) -> Dict[str, Dict[str, object]]:
+    cases = [(p.stem, lambda p=p: p.read_text(encoding="utf-8"), True)
+             for p in sorted(BENCH_DIR.glob("*.ql"))]
+    cases += [(name, gen, False) for name, gen in SYNTHETIC.items()]
+    results: Dict[str, Dict[str, object]] = {}
+    for name, source, runnable in cases:
+        if only and name not in only:
+            continue
+        results[name] = measure(name, source(), runnable, repeat)
+    return results
+
+def compare(results: Dict[str, Dict[str, object]], baseline: Dict[str, Dict[str, object]],
+            threshold: float, time_threshold: float, check_compile: bool) -> List[str]:
+    problems: List[str] = []
+    for name, cur in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if base.get("stdout") is not None and cur.get("stdout") != base["stdout"]:
+            problems.append(f"{name}: program output changed")
+        keys = [(k, threshold) for k in CODE_METRICS]
+        if check_compile:
+            keys += [(k, time_threshold) for k in cur if k.endswith("_ms") or k == "peak_kib"]
+        for key, limit in keys:
+            old, new = base.get(key), cur.get(key)
+            if old is None or new is None or new <= old * (1 + limit):
+                continue
+            if key.endswith("_ms") and new - old < TIME_FLOOR_MS:
+                continue
+            problems.append(f"{name}: {key} {old} -> {new} ({_pct(old, new)})")
+    return problems
+
+def _pct(old, new) -> str:
+    return f"{100 * (new - old) / old:+.1f}%" if old else "new"
+
+def print_table(results: Dict[str, Dict[str, object]], baseline: Dict[str, Dict[str, object]]):
+    cols = [f"{p}_ms" for p in PHASES] + ["peak_kib", "instructions", "com_bytes", "cycles"]
+    print(f"{'benchmark':<18}" + "".join(f"{c:>14}" for c in cols))
+    for name, res in results.items():
+        cells = []
+        for c in cols:
+            v = res.get(c)
+            cell = "-" if v is None else str(v)
+            old = baseline.get(name, {}).get(c)
+            if c in CODE_METRICS and v is not None and old not in (None, v):
+                cell += f" {_pct(old, v)}"
+            cells.append(f"{cell:>14}")
+        print(f"{name:<18}" + "".join(cells))
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="QuinLang benchmark runner")
+    ap.add_argument("--only", nargs="+", help="Benchmarks to run (default: all)")
+    ap.add_argument("--repeat", type=int, default=3, help="Timing runs per benchmark (best is kept)")
+    ap.add_argument("--json", type=Path, help="Write results to this file")
+    ap.add_argument("--baseline", type=Path, default=BASELINE, help="Baseline file")
+    ap.add_argument("--update-baseline", action="store_true", help="Store these results as the baseline")
+    ap.add_argument("--threshold", type=float, default=0.02,
+                    help="Allowed growth of instructions/bytes/cycles (fraction)")
+    ap.add_argument("--time-threshold", type=float, default=0.25,
+                    help="Allowed growth of compile time and memory (fraction)")
+    ap.add_argument("--check-compile", action="store_true",
+                    help="Also fail on compile time/memory regressions (same machine only)")
+    args = ap.parse_args(argv)
+
+    results = collect(args.only, args.repeat)
+    baseline: Dict[str, Dict[str, object]] = {}
+    if args.baseline.is_file():
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+    print_table(results, baseline)
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2, sort_keys=True) + "\n", encoding="utf-8")
+    if args.update_baseline:
+        merged = dict(baseline)
+        merged.update(results)
+        args.baseline.write_text(json.dumps(merged, indent=2, sort_keys=True) + "\n", encoding="utf-8")
+        print(f"Wrote {args.baseline}")
+        return
+    problems = compare(results, baseline, args.threshold, args.time_threshold, args.check_compile)
+    for p in problems:
+        print(f"REGRESSION {p}")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
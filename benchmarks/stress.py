@@ -0,0 +1,58 @@
+import argparse
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+from compiler.driver import compile_source
+from . import synth
+
+# Stress tests for very deep programs: each case is compiled at full depth and
+# at half of it. Compiling must not run into Python's recursion limit, and
+# doubling the depth may at most about double the time -- the front end,
+# analysis and code generation all have to stay linear in nesting depth.
+#
+#   python -m benchmarks.stress                    every case, 100k deep
+#   python -m benchmarks.stress --only parens --depth 20000
+
+CASES: Dict[str, Callable[[int], str]] = {
+    "nesting": lambda n: synth.deep_nesting(n, indent=False),
+    "expression": synth.long_expression,
+    "parens": synth.nested_parens,
+    "calls": synth.nested_calls,
+}
+
+# Allowed time(depth) / time(depth / 2); 2 is linear, with headroom for noise
+MAX_GROWTH = 3.0
+
+def compile_seconds(src: str) -> float:
+    start = time.perf_counter()
+    compile_source(src)
+    return time.perf_counter() - start
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Compile very deeply nested programs and check scaling")
+    ap.add_argument("--only", nargs="+", choices=sorted(CASES), help="Cases to run (default: all)")
+    ap.add_argument("--depth", type=int, default=100_000, help="Nesting depth of the largest program")
+    args = ap.parse_args(argv)
+
+    failed = 0
+    print(f"{'case':<12}{'depth':>10}{'half (s)':>12}{'full (s)':>12}{'growth':>9}")
+    for name, gen in CASES.items():
+        if args.only and name not in args.only:
+            continue
+        try:
+            half = compile_seconds(gen(args.depth // 2))
+            full = compile_seconds(gen(args.depth))
+        except RecursionError:
+            failed += 1
+            print(f"{name:<12}{args.depth:>10}  FAILED: recursion limit reached")
+            continue
+        growth = full / half if half else 0.0
+        verdict = "" if growth <= MAX_GROWTH else "  FAILED: superlinear"
+        failed += bool(verdict)
+        print(f"{name:<12}{args.depth:>10}{half:>12.2f}{full:>12.2f}{growth:>8.2f}x{verdict}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
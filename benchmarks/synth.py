@@ -0,0 +1,72 @@
+from typing import List
+
+# Generators for synthetic programs that stress compiler throughput rather than
+# generated-code speed. Each returns QuinLang source that compiles; the larger
+# sizes produce programs too big for a .COM image, so they are compile-only.
+
+def many_functions(count: int) -> str:
+    # A chain of small functions, each calling the previous one
+    out: List[str] = ["fn f0(x: int): int {", "    return x + 1;", "}", ""]
+    for i in range(1, count):
+        out.append(f"fn f{i}(x: int): int {{")
+        out.append(f"    let y = x * {i % 7 + 1};")
+        out.append(f"    if (y > {i}) {{")
+        out.append(f"        return f{i - 1}(y - {i});")
+        out.append("    }")
+        out.append(f"    return f{i - 1}(x + {i % 5});")
+        out.append("}")
+        out.append("")
+    out.append("fn main() {")
+    out.append(f"    print(f{count - 1}(1));")
+    out.append("}")
+    return "\n".join(out)
+
+def deep_nesting(depth: int, indent: bool = True) -> str:
+    # Alternating if/while blocks nested `depth` levels deep. Indentation makes
+    # the source quadratic in `depth`, so very deep programs go without.
+    out: List[str] = ["fn main() {", "    let n = 0;"]
+    for level in range(depth):
+        pad = "    " * (level + 1) if indent else ""
+        if level % 2 == 0:
+            out.append(f"{pad}if (n >= 0) {{")
+        else:
+            out.append(f"{pad}while (n < {level}) {{")
+            out.append(f"{pad}    n = n + 1;")
+    out.append("    " * (depth + 1) * indent + "n = n + 1;")
+    for level in reversed(range(depth)):
+        out.append("    " * (level + 1) * indent + "}")
+    out.append("    print(n);")
+    out.append("}")
+    return "\n".join(out)
+
+def long_expression(terms: int) -> str:
+    # One left-leaning expression with `terms` operands over a few locals
+    ops = ["+", "-", "*", "+"]
+    expr = "a"
+    for i in range(1, terms):
+        operand = ("a", "b", "c", str(i % 100))[i % 4]
+        expr += f" {ops[i % 4]} {operand}"
+    return "\n".join([
+        "fn main() {",
+        "    let a = 3;",
+        "    let b = 5;",
+        "    let c = 7;",
+        f"    let x = {expr};",
+        "    print(x);",
+        "}",
+    ])
+
+def nested_parens(depth: int) -> str:
+    # One operand inside `depth` pairs of parentheses, each adding a term
+    expr = "n"
+    for i in range(depth):
+        expr = f"({expr} + {i % 10})" if i % 2 else f"({expr})"
+    return "\n".join(["fn main() {", "    let n = 1;", f"    print({expr});", "}"])
+
+def nested_calls(depth: int) -> str:
+    # Calls nested `depth` deep, alternating a user function and an intrinsic
+    expr = "1"
+    for i in range(depth):
+        expr = f"inc({expr})" if i % 2 else f"band({expr}, 255)"
+    return "\n".join(["fn inc(x: int): int {", "    return x + 1;", "}", "",
+                      "fn main() {", f"    print({expr});", "}"])
@@ -0,0 +1,1055 @@
+from __future__ import annotations
+import argparse
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+# In-process assembler for the NASM subset emitted by CodeGen8086 and used by
+# runtime/*.asm, producing flat .COM images. Encodings follow NASM's choices
+# (e.g. `op r/m, reg` for register pairs, sign-extended imm8 where it fits) so
+# output can be byte-compared against `nasm -f bin`. Out-of-range conditional
+# branches are relaxed to an inverted short jcc over a near jmp, which is valid
+# on the 8086; NASM would emit a 386-only near jcc there instead.
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# NASM's bin format aligns every section after .text to 4 bytes by default
+SECTION_ALIGN = 4
+
+class AsmError(Exception):
+    pass
+
+REG16 = {"ax": 0, "cx": 1, "dx": 2, "bx": 3, "sp": 4, "bp": 5, "si": 6, "di": 7}
+REG8 = {"al": 0, "cl": 1, "dl": 2, "bl": 3, "ah": 4, "ch": 5, "dh": 6, "bh": 7}
+SREG = {"es": 0, "cs": 1, "ss": 2, "ds": 3}
+
+# r/m field for each combination of base/index registers
+MEM_RM = {
+    frozenset({"bx", "si"}): 0, frozenset({"bx", "di"}): 1,
+    frozenset({"bp", "si"}): 2, frozenset({"bp", "di"}): 3,
+    frozenset({"si"}): 4, frozenset({"di"}): 5, frozenset({"bp"}): 6, frozenset({"bx"}): 7,
+}
+
+ALU_OPS = {"add": 0, "or": 1, "adc": 2, "sbb": 3, "and": 4, "sub": 5, "xor": 6, "cmp": 7}
+UNARY_OPS = {"not": 2, "neg": 3, "mul": 4, "imul": 5, "div": 6, "idiv": 7}
+SHIFT_OPS = {"rol": 0, "ror": 1, "rcl": 2, "rcr": 3, "shl": 4, "sal": 4, "shr": 5, "sar": 7}
+
+JCC = {
+    "jo": 0x0, "jno": 0x1, "jb": 0x2, "jc": 0x2, "jnae": 0x2, "jae": 0x3, "jnb": 0x3, "jnc": 0x3,
+    "je": 0x4, "jz": 0x4, "jne": 0x5, "jnz": 0x5, "jbe": 0x6, "jna": 0x6, "ja": 0x7, "jnbe": 0x7,
+    "js": 0x8, "jns": 0x9, "jp": 0xA, "jpe": 0xA, "jnp": 0xB, "jpo": 0xB,
+    "jl": 0xC, "jnge": 0xC, "jge": 0xD, "jnl": 0xD, "jle": 0xE, "jng": 0xE, "jg": 0xF, "jnle": 0xF,
+}
+LOOPS = {"loopne": 0xE0, "loopnz": 0xE0, "loope": 0xE1, "loopz": 0xE1, "loop": 0xE2, "jcxz": 0xE3}
+
+NO_OPERANDS = {
+    "cwd": 0x99, "cbw": 0x98, "cld": 0xFC, "std": 0xFD, "clc": 0xF8, "stc": 0xF9, "cmc": 0xF5,
+    "cli": 0xFA, "sti": 0xFB, "nop": 0x90, "hlt": 0xF4, "pushf": 0x9C, "popf": 0x9D,
+    "sahf": 0x9E, "lahf": 0x9F, "movsb": 0xA4, "movsw": 0xA5, "cmpsb": 0xA6, "cmpsw": 0xA7,
+    "stosb": 0xAA, "stosw": 0xAB, "lodsb": 0xAC, "lodsw": 0xAD, "scasb": 0xAE, "scasw": 0xAF,
+    "xlatb": 0xD7, "into": 0xCE, "iret": 0xCF, "retf": 0xCB,
+}
+PREFIXES = {"rep": 0xF3, "repe": 0xF3, "repz": 0xF3, "repne": 0xF2, "repnz": 0xF2, "lock": 0xF0}
+
+DATA_SIZES = {"db": 1, "dw": 2, "dd": 4}
+RES_SIZES = {"resb": 1, "resw": 2, "resd": 4}
+
+# Expressions: ('num', v) | ('sym', name) | ('here',) | (op, a, b) | ('neg', a)
+Expr = tuple
+
+@dataclass
+class Reg:
+    name: str
+    size: int
+    code: int
+
+@dataclass
+class SegReg:
+    name: str
+    code: int
+
+@dataclass
+class Mem:
+    regs: frozenset
+    disp: Optional[Expr]
+    size: Optional[int]
+
+@dataclass
+class Imm:
+    expr: Expr
+    size: Optional[int] = None  # from an explicit `byte`/`word`
+    jump: Optional[str] = None  # `short`/`near` on a branch target
+
+Operand = Union[Reg, SegReg, Mem, Imm]
+
+@dataclass
+class Line:
+    # Source position for diagnostics
+    path: str
+    lineno: int
+    text: str
+
+@dataclass
+class Item:
+    kind: str  # 'label', 'insn', 'branch', 'data', 'res', 'align'
+    line: Optional[Line] = None
+    name: str = ""
+    mnemonic: str = ""
+    prefix: Optional[int] = None
+    operands: List[Operand] = field(default_factory=list)
+    values: List[Union[bytes, Expr]] = field(default_factory=list)
+    width: int = 1
+    count: int = 0
+    long: bool = False  # relaxed branch form
+    forced: bool = False  # `short`/`near` given explicitly
+    addr: int = 0
+    size: int = 0
+
+@dataclass
+class Section:
+    name: str
+    items: List[Item] = field(default_factory=list)
+    nobits: bool = False
+    start: int = 0
+
+# ---------------------------------------------------------------- parsing
+
+_TOKEN = re.compile(r"\s*(?:(0x[0-9a-fA-F]+|0b[01]+|[0-9][0-9a-fA-F]*[hH]|[0-9]+)|('(?:[^']|'')*'|\"[^\"]*\")"
+                    r"|([A-Za-z_.?@$][A-Za-z0-9_.?@$#~]*)|(\S))")
+
+def _tokens(text: str) -> List[Tuple[str, str]]:
+    out: List[Tuple[str, str]] = []
+    pos = 0
+    while pos < len(text):
+        m = _TOKEN.match(text, pos)
+        if m is None:
+            break
+        pos = m.end()
+        if m.group(1):
+            out.append(("num", m.group(1)))
+        elif m.group(2):
+            out.append(("str", m.group(2)))
+        elif m.group(3):
+            out.append(("id", m.group(3)))
+        elif m.group(4):
+            out.append(("op", m.group(4)))
+    return out
+
+def _number(text: str) -> int:
+    t = text.lower()
+    if t.startswith("0x"):
+        return int(t[2:], 16)
+    if t.startswith("0b"):
+        return int(t[2:], 2)
+    if t.endswith("h"):
+        return int(t[:-1], 16)
+    return int(t, 10)
+
+def _string_bytes(lit: str) -> bytes:
+    body = lit[1:-1]
+    if lit[0] == "'":
+        body = body.replace("''", "'")
+    return body.encode("latin-1")
+
+class _ExprParser:
+    def __init__(self, toks: List[Tuple[str, str]], scope: str):
+        self.toks = toks
+        self.pos = 0
+        self.scope = scope
+
+    def parse(self) -> Expr:
+        e = self._sum()
+        if self.pos != len(self.toks):
+            raise AsmError(f"Unexpected '{self.toks[self.pos][1]}' in expression")
+        return e
+
+    def _peek(self) -> Optional[Tuple[str, str]]:
+        return self.toks[self.pos] if self.pos < len(self.toks) else None
+
+    def _sum(self) -> Expr:
+        e = self._product()
+        while self._peek() in (("op", "+"), ("op", "-")):
+            op = self.toks[self.pos][1]
+            self.pos += 1
+            e = (op, e, self._product())
+        return e
+
+    def _product(self) -> Expr:
+        e = self._unary()
+        while self._peek() in (("op", "*"), ("op", "/")):
+            op = self.toks[self.pos][1]
+            self.pos += 1
+            e = (op, e, self._unary())
+        return e
+
+    def _unary(self) -> Expr:
+        tok = self._peek()
+        if tok is None:
+            raise AsmError("Missing operand in expression")
+        self.pos += 1
+        kind, text = tok
+        if tok == ("op", "-"):
+            return ("neg", self._unary())
+        if tok == ("op", "+"):
+            return self._unary()
+        if tok == ("op", "("):
+            e = self._sum()
+            if self._peek() != ("op", ")"):
+                raise AsmError("Expected ')' in expression")
+            self.pos += 1
+            return e
+        if kind == "num":
+            return ("num", _number(text))
+        if kind == "str":
+            # Character constants are little-endian numbers
+            return ("num", int.from_bytes(_string_bytes(text), "little"))
+        if kind == "id":
+            if text == "$":
+                return ("here",)
+            return ("sym", qualify(text, self.scope))
+        raise AsmError(f"Unexpected '{text}' in expression")
+
+def qualify(name: str, scope: str) -> str:
+    # `.local` labels belong to the preceding non-local label
+    if name.startswith(".") and not name.startswith(".."):
+        return scope + name
+    return name
+
+def parse_expr(text: str, scope: str) -> Expr:
+    return _ExprParser(_tokens(text), scope).parse()
+
+def _split_operands(text: str) -> List[str]:
+    parts: List[str] = []
+    depth = 0
+    quote: Optional[str] = None
+    cur = ""
+    for ch in text:
+        if quote:
+            cur += ch
+            if ch == quote:
+                quote = None
+            continue
+        if ch in "'\"":
+            quote = ch
+        elif ch == "[":
+            depth += 1
+        elif ch == "]":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            parts.append(cur.strip())
+            cur = ""
+            continue
+        cur += ch
+    if cur.strip():
+        parts.append(cur.strip())
+    return parts
+
+def _strip_comment(text: str) -> str:
+    quote: Optional[str] = None
+    for i, ch in enumerate(text):
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in "'\"":
+            quote = ch
+        elif ch == ";":
+            return text[:i]
+    return text
+
+def parse_operand(text: str, scope: str) -> Operand:
+    size: Optional[int] = None
+    jump: Optional[str] = None
+    words = text.split(None, 1)
+    while words and words[0].lower() in ("byte", "word", "short", "near") and len(words) > 1:
+        kw = words[0].lower()
+        if kw == "byte":
+            size = 1
+        elif kw == "word":
+            size = 2
+        else:
+            jump = kw
+        text = words[1].strip()
+        words = text.split(None, 1)
+    low = text.lower()
+    if low in REG16:
+        return Reg(low, 2, REG16[low])
+    if low in REG8:
+        return Reg(low, 1, REG8[low])
+    if low in SREG:
+        return SegReg(low, SREG[low])
+    if text.startswith("[") and text.endswith("]"):
+        return _parse_mem(text[1:-1], size, scope)
+    return Imm(parse_expr(text, scope), size, jump)
+
+def _parse_mem(inner: str, size: Optional[int], scope: str) -> Mem:
+    regs = set()
+    rest: List[str] = []
+    # Split into signed terms at top level, pulling out base/index registers
+    for sign, term in re.findall(r"([+-]?)\s*([^+-]+)", inner):
+        t = term.strip()
+        if t.lower() in ("bx", "bp", "si", "di"):
+            if sign == "-":
+                raise AsmError(f"Register can't be subtracted in [{inner}]")
+            regs.add(t.lower())
+        else:
+            rest.append(f"{sign or '+'}{t}")
+    key = frozenset(regs)
+    if regs and key not in MEM_RM:
+        raise AsmError(f"Invalid 8086 addressing mode [{inner}]")
+    disp = parse_expr("".join(rest), scope) if rest else None
+    return Mem(key, disp, size)
+
+# ---------------------------------------------------------------- assembler
+
+class Assembler:
+    def __init__(self, include_dirs: Sequence[Path] = (ROOT,)):
+        self.include_dirs = [Path(d) for d in include_dirs]
+        self.origin = 0
+        self.sections: Dict[str, Section] = {}
+        self.section = self._get_section(".text")
+        self.scope = ""
+        self.symbols: Dict[str, int] = {}
+        self.equs: Dict[str, Expr] = {}
+
+    def _get_section(self, name: str) -> Section:
+        if name not in self.sections:
+            self.sections[name] = Section(name, nobits=name == ".bss")
+        return self.sections[name]
+
+    # -- source reading
+
+    def _read_lines(self, text: str, path: str, depth: int = 0) -> List[Line]:
+        if depth > 32:
+            raise AsmError("%include nested too deeply")
+        out: List[Line] = []
+        in_macro = False
+        for lineno, raw in enumerate(text.splitlines(), 1):
+            stripped = _strip_comment(raw).strip()
+            low = stripped.lower()
+            if in_macro:
+                # Macro definitions are skipped; invoking one is an error later
+                if low.startswith("%endmacro"):
+                    in_macro = False
+                continue
+            if low.startswith("%macro"):
+                in_macro = True
+                continue
+            if low.startswith("%include"):
+                target = stripped.split(None, 1)[1].strip().strip("'\"")
+                inc = self._find_include(target)
+                out.extend(self._read_lines(inc.read_text(encoding="utf-8"), str(inc), depth + 1))
+                continue
+            if stripped.startswith("%"):
+                raise AsmError(f"{path}:{lineno}: unsupported preprocessor directive '{stripped}'")
+            if stripped:
+                out.append(Line(path, lineno, stripped))
+        return out
+
+    def _find_include(self, target: str) -> Path:
+        for d in self.include_dirs:
+            cand = d / target
+            if cand.is_file():
+                return cand
+        raise AsmError(f"Include file '{target}' not found")
+
+    # -- pass 1: parse into items
+
+    def assemble(self, text: str, path: str = "<input>") -> bytes:
+        for line in self._read_lines(text, path):
+            try:
+                self._parse_line(line)
+            except AsmError as e:
+                raise AsmError(f"{line.path}:{line.lineno}: {e}") from None
+        self._relax()
+        return self._emit()
+
+    def _add(self, item: Item):
+        self.section.items.append(item)
+
+    def _parse_line(self, line: Line):
+        text = line.text
+        # `label:` prefix
+        m = re.match(r"^([A-Za-z_.?@$][A-Za-z0-9_.?@$#~]*)\s*:(.*)$", text)
+        if m and not m.group(1).lower() in REG16:
+            self._define_label(m.group(1), line)
+            text = m.group(2).strip()
+            if not text:
+                return
+        parts = text.split(None, 1)
+        head = parts[0].lower()
+        rest = parts[1].strip() if len(parts) > 1 else ""
+        # `name db ...` style label without a colon
+        if len(parts) > 1 and head not in DATA_SIZES and head not in RES_SIZES:
+            second = rest.split(None, 1)
+            if second and second[0].lower() in (*DATA_SIZES, *RES_SIZES, "equ"):
+                if second[0].lower() == "equ":
+                    self.equs[qualify(parts[0], self.scope)] = parse_expr(second[1], self.scope)
+                    return
+                self._define_label(parts[0], line)
+                head = second[0].lower()
+                rest = second[1].strip() if len(second) > 1 else ""
+        if head == "org":
+            self.origin = self._const(parse_expr(rest, self.scope))
+            return
+        if head in ("section", "segment"):
+            self.section = self._get_section(rest.split()[0])
+            return
+        if head in ("global", "extern", "bits", "cpu", "default"):
+            return
+        if head in DATA_SIZES:
+            values: List[Union[bytes, Expr]] = []
+            for op in _split_operands(rest):
+                if op[0] in "'\"" and op[-1] == op[0] and (DATA_SIZES[head] > 1 or len(op) != 3):
+                    values.append(_string_bytes(op))
+                else:
+                    values.append(parse_expr(op, self.scope))
+            self._add(Item("data", line, values=values, width=DATA_SIZES[head]))
+            return
+        if head in RES_SIZES:
+            n = self._const(parse_expr(rest, self.scope))
+            self._add(Item("res", line, count=n * RES_SIZES[head]))
+            return
+        if head == "align":
+            self._add(Item("align", line, count=self._const(parse_expr(rest, self.scope))))
+            return
+        prefix = None
+        if head in PREFIXES:
+            prefix = PREFIXES[head]
+            parts = rest.split(None, 1)
+            head = parts[0].lower()
+            rest = parts[1].strip() if len(parts) > 1 else ""
+        operands = [parse_operand(op, self.scope) for op in _split_operands(rest)]
+        kind = "branch" if head == "jmp" or head in JCC or head in LOOPS else "insn"
+        item = Item(kind, line, mnemonic=head, prefix=prefix, operands=operands)
+        if kind == "branch":
+            if len(operands) != 1:
+                raise AsmError(f"'{head}' takes one operand")
+            target = operands[0]
+            if head == "jmp" and not isinstance(target, Imm):
+                item.kind = "insn"  # indirect jump
+            elif isinstance(target, Imm) and target.jump:
+                item.forced = True
+                item.long = target.jump == "near"
+        if item.kind == "insn":
+            # Encoded length never depends on symbol values, so fix it now; this
+            # also reports encoding errors against the right line
+            item.size = len(self._encode(item, lambda e: self._eval(e, strict=False)))
+        self._add(item)
+
+    def _define_label(self, name: str, line: Line):
+        if not name.startswith("."):
+            self.scope = name
+        full = qualify(name, self.scope)
+        self._add(Item("label", line, name=full))
+
+    def _const(self, e: Expr) -> int:
+        value, symbolic = self._eval(e, strict=True)
+        if symbolic and _has_symbol(e):
+            raise AsmError("Expression must be a constant")
+        return value
+
+    def _eval(self, e: Expr, strict: bool = True, here: int = 0) -> Tuple[int, bool]:
+        # Returns (value, mentions_a_symbol); unresolved symbols raise only when strict
+        kind = e[0]
+        if kind == "num":
+            return e[1], False
+        if kind == "here":
+            return here, True
+        if kind == "sym":
+            if e[1] in self.equs:
+                return self._eval(self.equs[e[1]], strict, here)
+            if e[1] in self.symbols:
+                return self.symbols[e[1]], True
+            if strict:
+                raise AsmError(f"Undefined symbol '{e[1]}'")
+            return 0, True
+        if kind == "neg":
+            v, s = self._eval(e[1], strict, here)
+            return -v, s
+        a, sa = self._eval(e[1], strict, here)
+        b, sb = self._eval(e[2], strict, here)
+        if kind == "+":
+            return a + b, sa or sb
+        if kind == "-":
+            return a - b, sa or sb
+        if kind == "*":
+            return a * b, sa or sb
+        if kind == "/":
+            if b == 0:
+                raise AsmError("Division by zero in expression")
+            return int(a / b), sa or sb
+        raise AsmError(f"Bad expression {e!r}")
+
+    # -- pass 2: layout and branch relaxation
+
+    def _layout(self):
+        addr = self.origin
+        order = sorted(self.sections.values(), key=lambda s: (s.name != ".text", s.nobits))
+        for i, sec in enumerate(order):
+            if i > 0:
+                addr = -(-addr // SECTION_ALIGN) * SECTION_ALIGN
+            sec.start = addr
+            for item in sec.items:
+                item.addr = addr
+                if item.kind == "label":
+                    self.symbols[item.name] = addr
+                elif item.kind == "align":
+                    item.size = (-(addr - sec.start)) % item.count if item.count else 0
+                else:
+                    item.size = self._size(item)
+                addr += item.size
+        return order
+
+    def _size(self, item: Item) -> int:
+        if item.kind == "data":
+            total = 0
+            for v in item.values:
+                n = len(v) if isinstance(v, bytes) else item.width
+                total += -(-n // item.width) * item.width
+            return total
+        if item.kind == "res":
+            return item.count
+        if item.kind == "branch":
+            return _branch_size(item)
+        return item.size
+
+    def _relax(self):
+        # Start every branch short and lengthen the ones that don't reach; sizes
+        # only grow, so this converges
+        while True:
+            self._layout()
+            changed = False
+            for sec in self.sections.values():
+                for item in sec.items:
+                    if item.kind != "branch" or item.long or item.forced:
+                        continue
+                    target = self._branch_target(item)
+                    disp = target - (item.addr + 2)
+                    if not -128 <= disp <= 127:
+                        item.long = True
+                        changed = True
+            if not changed:
+                return
+
+    def _branch_target(self, item: Item) -> int:
+        target = item.operands[0]
+        try:
+            return self._eval(target.expr, strict=True, here=item.addr)[0]
+        except AsmError as e:
+            raise AsmError(f"{item.line.path}:{item.line.lineno}: {e}") from None
+
+    # -- pass 3: encoding
+
+    def _emit(self) -> bytes:
+        order = self._layout()
+        out = bytearray()
+        for sec in order:
+            if sec.nobits:
+                continue
+            out.extend(b"\0" * (sec.start - self.origin - len(out)))
+            for item in sec.items:
+                try:
+                    data = self._final_bytes(item)
+                except AsmError as e:
+                    raise AsmError(f"{item.line.path}:{item.line.lineno}: {e}") from None
+                if len(data) != item.size:
+                    raise AsmError(f"{item.line.path}:{item.line.lineno}: size changed between passes")
+                out.extend(data)
+        return bytes(out)
+
+    def _final_bytes(self, item: Item) -> bytes:
+        if item.kind == "label":
+            return b""
+        if item.kind in ("res", "align"):
+            return b"\0" * item.size
+        if item.kind == "data":
+            out = bytearray()
+            for v in item.values:
+                if isinstance(v, bytes):
+                    out.extend(v + b"\0" * ((-len(v)) % item.width))
+                else:
+                    value = self._eval(v, here=item.addr)[0]
+                    out.extend(_le(value, item.width))
+            return bytes(out)
+        if item.kind == "branch":
+            return self._encode_branch(item)
+        return self._encode(item, lambda e: self._eval(e, here=item.addr))
+
+    def _encode_branch(self, item: Item) -> bytes:
+        target = self._branch_target(item)
+        m = item.mnemonic
+        end = item.addr + _branch_size(item)
+        if not item.long:
+            disp = target - end
+            if not -128 <= disp <= 127:
+                raise AsmError(f"Short jump out of range ({disp})")
+            op = 0xEB if m == "jmp" else (0x70 | JCC[m]) if m in JCC else LOOPS[m]
+            return bytes([op]) + _le(disp, 1)
+        rel16 = _le(target - end, 2)
+        if m == "jmp":
+            return b"\xE9" + rel16
+        if m in JCC:
+            # Inverted condition skips the 3-byte near jmp
+            return bytes([0x70 | (JCC[m] ^ 1), 3, 0xE9]) + rel16
+        # loop/jcxz have no near form: branch over a short jmp to a near jmp
+        return bytes([LOOPS[m], 2, 0xEB, 3, 0xE9]) + rel16
+
+    def _encode(self, item: Item, ev: Callable[[Expr], Tuple[int, bool]]) -> bytes:
+        out = _encode_insn(item.mnemonic, item.operands, ev, item.addr)
+        if item.prefix is not None:
+            out = bytes([item.prefix]) + out
+        return out
+
+def _branch_size(item: Item) -> int:
+    if not item.long:
+        return 2
+    if item.mnemonic == "jmp":
+        return 3
+    if item.mnemonic in JCC:
+        return 5
+    return 7
+
+def _has_symbol(e: Optional[Expr]) -> bool:
+    if e is None:
+        return False
+    if e[0] in ("sym", "here"):
+        return True
+    return any(isinstance(x, tuple) and _has_symbol(x) for x in e[1:])
+
+def _le(value: int, width: int) -> bytes:
+    lo = -(1 << (8 * width - 1))
+    hi = (1 << (8 * width)) - 1
+    if not lo <= value <= hi:
+        raise AsmError(f"Value {value} doesn't fit in {width} byte(s)")
+    return (value & hi).to_bytes(width, "little")
+
+def _fits_sbyte(value: int) -> bool:
+    v = value & 0xFFFF
+    return v <= 0x7F or v >= 0xFF80
+
+def _modrm_rm(op: Operand, reg: int, ev: Callable[[Expr], Tuple[int, bool]]) -> bytes:
+    if isinstance(op, Reg):
+        return bytes([0xC0 | (reg << 3) | op.code])
+    assert isinstance(op, Mem)
+    if op.disp is not None:
+        disp, symbolic = ev(op.disp)
+    else:
+        disp, symbolic = 0, False
+    if not op.regs:
+        return bytes([(reg << 3) | 6]) + _le(disp, 2)
+    rm = MEM_RM[op.regs]
+    if symbolic:
+        return bytes([0x80 | (reg << 3) | rm]) + _le(disp, 2)
+    if disp == 0 and rm != 6:
+        return bytes([(reg << 3) | rm])
+    if -128 <= disp <= 127:
+        return bytes([0x40 | (reg << 3) | rm]) + _le(disp, 1)
+    return bytes([0x80 | (reg << 3) | rm]) + _le(disp, 2)
+
+def _imm(op: Imm, width: int, ev: Callable[[Expr], Tuple[int, bool]]) -> bytes:
+    return _le(ev(op.expr)[0], width)
+
+def _size_of(dst: Operand, src: Optional[Operand] = None) -> int:
+    for op in (dst, src):
+        if isinstance(op, Reg):
+            return op.size
+    for op in (dst, src):
+        if isinstance(op, (Mem, Imm)) and op.size:
+            return op.size
+    raise AsmError("Operation size not specified")
+
+def _encode_insn(m: str, ops: List[Operand], ev: Callable[[Expr], Tuple[int, bool]], addr: int) -> bytes:
+    n = len(ops)
+    if m in NO_OPERANDS and n == 0:
+        return bytes([NO_OPERANDS[m]])
+    if m == "ret":
+        if n == 0:
+            return b"\xC3"
+        return b"\xC2" + _imm(ops[0], 2, ev)
+    if m == "int" and n == 1 and isinstance(ops[0], Imm):
+        return b"\xCD" + _imm(ops[0], 1, ev)
+    if m == "call" and n == 1:
+        if isinstance(ops[0], Imm):
+            target = ev(ops[0].expr)[0]
+            return b"\xE8" + _le((target - (addr + 3)) & 0xFFFF, 2)
+        if isinstance(ops[0], (Reg, Mem)):
+            return b"\xFF" + _modrm_rm(ops[0], 2, ev)
+    if m == "jmp" and n == 1 and isinstance(ops[0], (Reg, Mem)):
+        return b"\xFF" + _modrm_rm(ops[0], 4, ev)
+    if m in ALU_OPS and n == 2:
+        return _encode_alu(ALU_OPS[m], ops[0], ops[1], ev)
+    if m == "test" and n == 2:
+        return _encode_test(ops[0], ops[1], ev)
+    if m == "mov" and n == 2:
+        return _encode_mov(ops[0], ops[1], ev)
+    if m == "lea" and n == 2 and isinstance(ops[0], Reg) and ops[0].size == 2 and isinstance(ops[1], Mem):
+        return b"\x8D" + _modrm_rm(ops[1], ops[0].code, ev)
+    if m == "xchg" and n == 2:
+        return _encode_xchg(ops[0], ops[1], ev)
+    if m in ("inc", "dec") and n == 1:
+        sub = 0 if m == "inc" else 1
+        op = ops[0]
+        if isinstance(op, Reg) and op.size == 2:
+            return bytes([(0x40 if m == "inc" else 0x48) + op.code])
+        if isinstance(op, (Reg, Mem)):
+            w = _size_of(op)
+            return bytes([0xFE if w == 1 else 0xFF]) + _modrm_rm(op, sub, ev)
+    if m in ("push", "pop") and n == 1:
+        return _encode_stack(m, ops[0], ev)
+    if m in UNARY_OPS and n == 1 and isinstance(ops[0], (Reg, Mem)):
+        w = _size_of(ops[0])
+        return bytes([0xF6 if w == 1 else 0xF7]) + _modrm_rm(ops[0], UNARY_OPS[m], ev)
+    if m in SHIFT_OPS and n == 2 and isinstance(ops[0], (Reg, Mem)):
+        w = _size_of(ops[0])
+        count = ops[1]
+        if isinstance(count, Reg) and count.name == "cl":
+            return bytes([0xD2 if w == 1 else 0xD3]) + _modrm_rm(ops[0], SHIFT_OPS[m], ev)
+        if isinstance(count, Imm) and not _has_symbol(count.expr) and ev(count.expr)[0] == 1:
+            return bytes([0xD0 if w == 1 else 0xD1]) + _modrm_rm(ops[0], SHIFT_OPS[m], ev)
+        raise AsmError("Shift count must be 1 or CL on the 8086")
+    raise AsmError(f"Unsupported instruction '{m}' with {n} operand(s)")
+
+def _encode_alu(op: int, dst: Operand, src: Operand, ev) -> bytes:
+    if isinstance(dst, Reg) and isinstance(src, Reg):
+        if dst.size != src.size:
+            raise AsmError("Operand size mismatch")
+        return bytes([op * 8 + (dst.size - 1), 0xC0 | (src.code << 3) | dst.code])
+    if isinstance(dst, Reg) and isinstance(src, Mem):
+        return bytes([op * 8 + 2 + (dst.size - 1)]) + _modrm_rm(src, dst.code, ev)
+    if isinstance(dst, Mem) and isinstance(src, Reg):
+        return bytes([op * 8 + (src.size - 1)]) + _modrm_rm(dst, src.code, ev)
+    if isinstance(dst, (Reg, Mem)) and isinstance(src, Imm):
+        w = _size_of(dst, src)
+        value, symbolic = ev(src.expr)
+        if w == 1:
+            if isinstance(dst, Reg) and dst.code == 0:
+                return bytes([op * 8 + 4]) + _le(value, 1)
+            return b"\x80" + _modrm_rm(dst, op, ev) + _le(value, 1)
+        if not symbolic and _fits_sbyte(value):
+            return b"\x83" + _modrm_rm(dst, op, ev) + bytes([value & 0xFF])
+        if isinstance(dst, Reg) and dst.code == 0:
+            return bytes([op * 8 + 5]) + _le(value, 2)
+        return b"\x81" + _modrm_rm(dst, op, ev) + _le(value, 2)
+    raise AsmError("Invalid operands")
+
+def _encode_test(dst: Operand, src: Operand, ev) -> bytes:
+    if isinstance(src, Mem) and isinstance(dst, Reg):
+        dst, src = src, dst
+    if isinstance(dst, (Reg, Mem)) and isinstance(src, Reg):
+        return bytes([0x84 if src.size == 1 else 0x85]) + _modrm_rm(dst, src.code, ev)
+    if isinstance(dst, (Reg, Mem)) and isinstance(src, Imm):
+        w = _size_of(dst, src)
+        if isinstance(dst, Reg) and dst.code == 0:
+            return bytes([0xA8 if w == 1 else 0xA9]) + _imm(src, w, ev)
+        return bytes([0xF6 if w == 1 else 0xF7]) + _modrm_rm(dst, 0, ev) + _imm(src, w, ev)
+    raise AsmError("Invalid operands")
+
+def _encode_mov(dst: Operand, src: Operand, ev) -> bytes:
+    if isinstance(dst, SegReg) and isinstance(src, (Reg, Mem)):
+        return b"\x8E" + _modrm_rm(src, dst.code, ev)
+    if isinstance(dst, (Reg, Mem)) and isinstance(src, SegReg):
+        return b"\x8C" + _modrm_rm(dst, src.code, ev)
+    if isinstance(dst, Reg) and isinstance(src, Reg):
+        if dst.size != src.size:
+            raise AsmError("Operand size mismatch")
+        return bytes([0x88 + (dst.size - 1), 0xC0 | (src.code << 3) | dst.code])
+    if isinstance(dst, Reg) and isinstance(src, Mem):
+        if dst.code == 0 and not src.regs:
+            return bytes([0xA0 + (dst.size - 1)]) + _le(ev(src.disp)[0], 2)
+        return bytes([0x8A + (dst.size - 1)]) + _modrm_rm(src, dst.code, ev)
+    if isinstance(dst, Mem) and isinstance(src, Reg):
+        if src.code == 0 and not dst.regs:
+            return bytes([0xA2 + (src.size - 1)]) + _le(ev(dst.disp)[0], 2)
+        return bytes([0x88 + (src.size - 1)]) + _modrm_rm(dst, src.code, ev)
+    if isinstance(dst, Reg) and isinstance(src, Imm):
+        base = 0xB0 if dst.size == 1 else 0xB8
+        return bytes([base + dst.code]) + _imm(src, dst.size, ev)
+    if isinstance(dst, Mem) and isinstance(src, Imm):
+        w = _size_of(dst, src)
+        return bytes([0xC6 if w == 1 else 0xC7]) + _modrm_rm(dst, 0, ev) + _imm(src, w, ev)
+    raise AsmError("Invalid operands")
+
+def _encode_xchg(a: Operand, b: Operand, ev) -> bytes:
+    if isinstance(a, Reg) and isinstance(b, Reg) and a.size == b.size == 2:
+        if a.code == 0:
+            return bytes([0x90 + b.code])
+        if b.code == 0:
+            return bytes([0x90 + a.code])
+    if isinstance(a, Mem) and isinstance(b, Reg):
+        a, b = b, a
+    if isinstance(a, Reg) and isinstance(b, (Reg, Mem)):
+        return bytes([0x86 if a.size == 1 else 0x87]) + _modrm_rm(b, a.code, ev)
+    raise AsmError("Invalid operands")
+
+def _encode_stack(m: str, op: Operand, ev) -> bytes:
+    if isinstance(op, Reg) and op.size == 2:
+        return bytes([(0x50 if m == "push" else 0x58) + op.code])
+    if isinstance(op, SegReg):
+        if m == "pop" and op.name == "cs":
+            raise AsmError("Can't pop into CS")
+        return bytes([(op.code << 3) | (0x06 if m == "push" else 0x07)])
+    if isinstance(op, Mem):
+        if m == "push":
+            return b"\xFF" + _modrm_rm(op, 6, ev)
+        return b"\x8F" + _modrm_rm(op, 0, ev)
+    raise AsmError(f"Invalid operand for {m} on the 8086")
+
+def assemble(text: str, path: str = "<input>", include_dirs: Sequence[Path] = (ROOT,)) -> bytes:
+    return Assembler(include_dirs).assemble(text, path)
+
+def assemble_with_symbols(text: str, path: str = "<input>",
+                          include_dirs: Sequence[Path] = (ROOT,)) -> Tuple[bytes, Dict[str, int]]:
+    # Image plus every label's address, for tools that map addresses back to source
+    asm = Assembler(include_dirs)
+    image = asm.assemble(text, path)
+    return image, dict(asm.symbols)
+
+def assemble_with_lines(text: str, path: str = "<input>", include_dirs: Sequence[Path] = (ROOT,)
+                        ) -> Tuple[bytes, Dict[str, int], Dict[int, int]]:
+    # Also the line of `text` each instruction came from, by address; code
+    # from included files isn't listed
+    asm = Assembler(include_dirs)
+    image = asm.assemble(text, path)
+    lines = {item.addr: item.line.lineno for sec in asm.sections.values() for item in sec.items
+             if item.kind in ("insn", "branch") and item.line is not None and item.line.path == path}
+    return image, dict(asm.symbols), lines
+
+def assemble_file(path: Path, include_dirs: Sequence[Path] = (ROOT,)) -> bytes:
+    return assemble(path.read_text(encoding="utf-8"), str(path), include_dirs)
+
+def compare_with_nasm(paths: Sequence[Path], include_dirs: Sequence[Path] = (ROOT,)) -> bool:
+    # Assemble each file with both assemblers and report the first differing byte
+    nasm = shutil.which("nasm")
+    if nasm is None:
+        raise AsmError("nasm not found on PATH")
+    ok = True
+    for path in paths:
+        ours = assemble_file(path, include_dirs)
+        with tempfile.TemporaryDirectory() as tmp:
+            out = Path(tmp) / "out.com"
+            cmd = [nasm, "-f", "bin", "-o", str(out)] + [f"-i{d}/" for d in include_dirs] + [str(path)]
+            subprocess.run(cmd, check=True, cwd=include_dirs[0])
+            theirs = out.read_bytes()
+        if ours == theirs:
+            print(f"{path}: ok ({len(ours)} bytes)")
+            continue
+        ok = False
+        diff = next((i for i, (a, b) in enumerate(zip(ours, theirs)) if a != b), min(len(ours), len(theirs)))
+        print(f"{path}: differs at offset {diff:#06x} (ours {len(ours)} bytes, nasm {len(theirs)} bytes)")
+    return ok
+
+# ---------------------------------------------------------------- cross-checks
+
+# Where nasm isn't available, check_with_binutils checks the encodings with
+# the GNU tools instead. objdump decodes each instruction of the image, which
+# must start where ours does and agree with the source on mnemonic, operands
+# and operand size. GNU as then re-encodes objdump's text and must produce the
+# same bytes. For the forms used here it chooses as NASM does (sign-extended
+# imm8, the shortest displacement, `op r/m, reg` for register pairs), so a
+# wrong choice shows up too. Branches are checked by target only, since the
+# relaxed jcc form differs from both on purpose (see above).
+
+_OBJDUMP_LINE = re.compile(r"\s*([0-9a-f]+):\t([0-9a-f ]+?)\s*\t(.*)$")
+_DECODED_MEM = re.compile(r"(?:(BYTE|WORD) PTR )?(?:\[([^\]]*)\]|[cdes]s:(?:\[([^\]]*)\]|(0x[0-9a-f]+)))$")
+STRING_OPS = {"movs", "cmps", "stos", "lods", "scas"}
+
+# A decoded operand: register name, number or ('mem', regs, disp, size); text
+# that is none of these is kept as it is, and matches nothing
+Decoded = Union[str, int, tuple]
+
+def _objdump(objdump: str, image: bytes, origin: int, start: Optional[int] = None) -> Dict[int, Tuple[bytes, str]]:
+    # objdump's decoding of `image` from `start`: address -> (bytes, text)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "image.com"
+        path.write_bytes(image)
+        cmd = [objdump, "-D", "-b", "binary", "-m", "i8086", "-M", "intel", f"--adjust-vma={origin:#x}"]
+        if start is not None:
+            cmd.append(f"--start-address={start:#x}")
+        out = subprocess.run(cmd + [str(path)], check=True, capture_output=True, text=True).stdout
+    found: Dict[int, Tuple[bytes, str]] = {}
+    for line in out.splitlines():
+        m = _OBJDUMP_LINE.match(line)
+        if m:
+            found[int(m.group(1), 16)] = (bytes.fromhex(m.group(2)), " ".join(m.group(3).split()))
+    return found
+
+def _decoded_number(text: str) -> Union[int, str]:
+    try:
+        return int(text, 0) if not text.startswith("-") else -int(text[1:], 0)
+    except ValueError:
+        return text
+
+def _decoded_operand(text: str) -> Decoded:
+    if text in REG16 or text in REG8 or text in SREG:
+        return text
+    m = _DECODED_MEM.match(text)
+    if m is None:
+        return _decoded_number(text)
+    size = {"BYTE": 1, "WORD": 2}.get(m.group(1) or "")
+    if m.group(4) is not None:
+        return ("mem", frozenset(), int(m.group(4), 16), size)
+    regs, disp = [], 0
+    for sign, term in re.findall(r"([+-]?)([^+-]+)", m.group(2) or m.group(3)):
+        if term in REG16:
+            regs.append(term)
+        else:
+            value = _decoded_number(sign + term)
+            if not isinstance(value, int):
+                return text
+            disp += value
+    return ("mem", frozenset(regs), disp & 0xFFFF, size)
+
+def _decoded(text: str) -> Tuple[Optional[int], str, List[Decoded]]:
+    # (prefix byte, mnemonic, operands) of an instruction as objdump prints it
+    words = text.split(" ", 1)
+    prefix = None
+    if words[0] in PREFIXES and len(words) > 1:
+        prefix = PREFIXES[words[0]]
+        words = words[1].split(" ", 1)
+    ops = [_decoded_operand(op) for op in words[1].split(",")] if len(words) > 1 else []
+    return prefix, words[0], ops
+
+def _insn_mismatch(asm: Assembler, item: Item, text: str) -> Optional[str]:
+    # Why objdump's `text` isn't the instruction `item` assembles, if it isn't
+    ev = lambda e: asm._eval(e, here=item.addr)[0]
+    prefix, m, ops = _decoded(text)
+    if prefix != item.prefix:
+        return "prefix differs"
+    ours = item.mnemonic
+    if ours[:-1] in STRING_OPS or ours == "xlatb":
+        # objdump spells out the implicit operands; only their size matters
+        sizes = [op[3] for op in ops if isinstance(op, tuple)]
+        if m != ours[:-1] or sizes[:1] != [1 if ours.endswith("b") else 2]:
+            return "different string instruction"
+        return None
+    if m != {"sal": "shl"}.get(ours, ours) or len(ops) != len(item.operands):
+        return "different instruction"
+    if m == "xchg" and ops[-1] != getattr(item.operands[-1], "name", None):
+        # The operands commute, and objdump prints the short forms with AX last
+        ops.reverse()
+    try:
+        size = _size_of(*item.operands[:2])
+    except (AsmError, TypeError):
+        size = 2
+    mask = 0xFF if size == 1 else 0xFFFF
+    for op, theirs in zip(item.operands, ops):
+        if isinstance(op, (Reg, SegReg)):
+            same = op.name == theirs
+        elif isinstance(op, Imm):
+            same = isinstance(theirs, int) and (ev(op.expr) - theirs) & mask == 0
+        else:
+            disp = ev(op.disp) if op.disp is not None else 0
+            same = (isinstance(theirs, tuple) and theirs[1] == op.regs and theirs[2] == disp & 0xFFFF
+                    and theirs[3] in (None, size))
+        if not same:
+            return "operands differ"
+    return None
+
+def _branch_mismatch(asm: Assembler, item: Item, decoded: Dict[int, Tuple[bytes, str]]) -> Optional[str]:
+    # The instructions objdump sees at a branch must reach its target: one
+    # jmp/jcc/loop, or for a relaxed branch the sequence _encode_branch emits
+    target = asm._branch_target(item)
+    m, a = item.mnemonic, item.addr
+    if not item.long:
+        expect = [(a, m, target)]
+    elif m == "jmp":
+        expect = [(a, "jmp", target)]
+    elif m in JCC:
+        expect = [(a, ("invert", m), a + 5), (a + 2, "jmp", target)]
+    else:
+        expect = [(a, m, a + 4), (a + 2, "jmp", a + 7), (a + 4, "jmp", target)]
+    for addr, want, dest in expect:
+        if addr not in decoded:
+            return "not decoded at its address"
+        _, got, ops = _decoded(decoded[addr][1])
+        if isinstance(want, tuple):
+            ok = got in JCC and JCC[got] == JCC[want[1]] ^ 1
+        elif want in JCC:
+            ok = got in JCC and JCC[got] == JCC[want]
+        elif want in LOOPS:
+            ok = got in LOOPS and LOOPS[got] == LOOPS[want]
+        else:
+            ok = got == want
+        if not ok or ops != [dest]:
+            return f"objdump reads `{decoded[addr][1]}` at {addr:#06x}"
+    return None
+
+def _gas_bytes(gas: str, objdump: str, texts: List[str]) -> List[bytes]:
+    # GNU as's encoding of each instruction in `texts`, in 16-bit mode
+    with tempfile.TemporaryDirectory() as tmp:
+        src, obj = Path(tmp) / "in.s", Path(tmp) / "out.o"
+        src.write_text(".code16\n.intel_syntax noprefix\n" + "".join(t + "\n" for t in texts), encoding="utf-8")
+        subprocess.run([gas, "--32", "-o", str(obj), str(src)], check=True, capture_output=True)
+        out = subprocess.run([objdump, "-d", "-m", "i8086", "-M", "intel", str(obj)],
+                             check=True, capture_output=True, text=True).stdout
+    return [bytes.fromhex(m.group(2)) for m in map(_OBJDUMP_LINE.match, out.splitlines()) if m]
+
+def check_with_binutils(paths: Sequence[Path], include_dirs: Sequence[Path] = (ROOT,)) -> bool:
+    # Check every instruction of each file against objdump and GNU as
+    objdump, gas = shutil.which("objdump"), shutil.which("as")
+    if objdump is None or gas is None:
+        raise AsmError("objdump and as (GNU binutils) not found on PATH")
+    ok = True
+    for path in paths:
+        asm = Assembler(include_dirs)
+        image = asm.assemble(path.read_text(encoding="utf-8"), str(path))
+        decoded = _objdump(objdump, image, asm.origin)
+        problems: List[str] = []
+        reencode: Dict[str, bytes] = {}  # objdump text -> our bytes
+        items = [item for sec in asm.sections.values() if not sec.nobits for item in sec.items
+                 if item.kind in ("insn", "branch")]
+        for item in items:
+            ours = image[item.addr - asm.origin:item.addr - asm.origin + item.size]
+            if item.addr not in decoded:
+                # Data in .text put objdump out of step; decode again from here
+                decoded.update(_objdump(objdump, image, asm.origin, item.addr))
+            where = f"{item.line.path}:{item.line.lineno}: `{item.line.text.strip()}`"
+            if item.kind == "branch":
+                problem = _branch_mismatch(asm, item, decoded)
+            elif decoded[item.addr][0] != ours:
+                problem = f"objdump decodes {decoded[item.addr][0].hex()} of {ours.hex()}"
+            else:
+                problem = _insn_mismatch(asm, item, decoded[item.addr][1])
+                if problem is None and item.mnemonic != "call":
+                    reencode[decoded[item.addr][1]] = ours
+            if problem is not None:
+                problems.append(f"{where}: {problem}")
+        texts = sorted(reencode)
+        for text, theirs in zip(texts, _gas_bytes(gas, objdump, texts)):
+            if theirs != reencode[text]:
+                problems.append(f"`{text}`: ours {reencode[text].hex()}, GNU as {theirs.hex()}")
+        for problem in problems:
+            print(f"{path}: {problem}")
+        if problems:
+            ok = False
+        else:
+            print(f"{path}: ok ({len(items)} instructions)")
+    return ok
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="8086 assembler for QuinLang output")
+    ap.add_argument("sources", type=Path, nargs="+", help="Input .asm files")
+    ap.add_argument("-o", "--out", type=Path, help="Output .COM file (single input)")
+    ap.add_argument("--compare-nasm", action="store_true", help="Byte-compare each input against nasm -f bin")
+    ap.add_argument("--check-binutils", action="store_true",
+                    help="Check each input's encodings against objdump and GNU as")
+    args = ap.parse_args(argv)
+    if args.compare_nasm:
+        sys.exit(0 if compare_with_nasm(args.sources) else 1)
+    if args.check_binutils:
+        sys.exit(0 if check_with_binutils(args.sources) else 1)
+    if len(args.sources) != 1 or args.out is None:
+        ap.error("assembling needs exactly one source and -o")
+    image = assemble_file(args.sources[0])
+    args.out.parent.mkdir(parents=True, exist_ok=True)
+    args.out.write_bytes(image)
+    print(f"Wrote {args.out} ({len(image)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,17 @@
 from __future__ import annotations
-from dataclasses import dataclass, field
-from typing import List, Optional, Union
+from dataclasses import dataclass, field, fields
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+class Node:
+    # Source position of the node's first token (operators for Binary/Unary),
+    # set by the parser. Plain attributes rather than dataclass fields, so they
+    # take no part in equality or repr, nor in the hashes keying cached code.
+    line = 0
+    col = 0
 
 # Expressions
 @dataclass
-class Expr:
+class Expr(Node):
     pass
 
 @dataclass
@@ -31,9 +38,14 @@ class Call(Expr):
     callee: str
     args: List[Expr]
 
+@dataclass
+class Index(Expr):
+    name: str
+    index: Expr
+
 # Statements
 @dataclass
-class Stmt:
+class Stmt(Node):
     pass
 
 @dataclass
@@ -51,6 +63,12 @@ class Assign(Stmt):
     name: str
     value: Expr
 
+@dataclass
+class IndexAssign(Stmt):
+    name: str
+    index: Expr
+    value: Expr
+
 @dataclass
 class Print(Stmt):
     value: Expr
@@ -70,22 +88,167 @@ class While(Stmt):
     cond: Expr
     body: List[Stmt]
 
+@dataclass
+class For(Stmt):
+    # Counted loop over the half-open range [start, end); bounds are evaluated once
+    var: str
+    start: Expr
+    end: Expr
+    body: List[Stmt]
+
 @dataclass
 class Block(Stmt):
     stmts: List[Stmt] = field(default_factory=list)
 
 @dataclass
-class Param:
+class Param(Node):
     name: str
     type_name: str
 
 @dataclass
-class Function:
+class Function(Node):
     name: str
     params: List[Param]
     return_type: Optional[str]
     body: List[Stmt]
+    # Extern declarations have no body and are implemented in `asm_source`
+    extern: bool = False
+    asm_source: Optional[str] = None
+    # Line of the closing brace, and the line of every statement relative to
+    # `line`: the shape of the function's line table
+    end_line = 0
+    layout = ()
 
 @dataclass
 class Program:
-    functions: List[Function]
\ No newline at end of file
+    functions: List[Function]
+    # Modules named by `import name;`, in source order
+    imports: List[str] = field(default_factory=list)
+
+def walk(*roots: object) -> Iterator[object]:
+    # Yield every AST node reachable from `roots` (nodes or lists of nodes), pre-order
+    stack: List[object] = list(reversed(roots))
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(reversed(node))
+            continue
+        if node is None or not hasattr(node, "__dataclass_fields__"):
+            continue
+        yield node
+        children = [getattr(node, f.name) for f in fields(node)]
+        stack.extend(reversed(children))
+
+def statements(body: List[Stmt]) -> Iterator[Stmt]:
+    # Every statement of `body` and the blocks nested in it, pre-order; cheaper
+    # than walk() where expressions don't matter
+    stack: List[Stmt] = list(reversed(body))
+    while stack:
+        st = stack.pop()
+        yield st
+        if isinstance(st, If):
+            stack.extend(reversed(st.then_block + (st.else_block or [])))
+        elif isinstance(st, (While, For)):
+            stack.extend(reversed(st.body))
+        elif isinstance(st, Block):
+            stack.extend(reversed(st.stmts))
+
+_field_names: Dict[type, Tuple[str, ...]] = {}
+
+def transform(root: object, fn: Callable[[object, object], object]) -> object:
+    # Rebuild `root` bottom-up: every node, once its children are done, is
+    # replaced by fn(node, original), where `node` is a copy of `original`
+    # with new children if any child was replaced (else `original` itself).
+    # Only the path to a replaced node is copied, so trees shared between
+    # compilations are never modified.
+    done: List[object] = []
+    stack: List[Tuple[object, bool]] = [(root, False)]
+    while stack:
+        item, ready = stack.pop()
+        if isinstance(item, list):
+            if not ready:
+                stack.append((item, True))
+                stack.extend((x, False) for x in reversed(item))
+                continue
+            new = done[len(done) - len(item):]
+            del done[len(done) - len(item):]
+            done.append(new if any(a is not b for a, b in zip(new, item)) else item)
+        elif hasattr(item, "__dataclass_fields__"):
+            names = _field_names.get(type(item))
+            if names is None:
+                names = _field_names[type(item)] = tuple(f.name for f in fields(item))
+            if not ready:
+                stack.append((item, True))
+                stack.extend((getattr(item, n), False) for n in reversed(names))
+                continue
+            values = done[len(done) - len(names):]
+            del done[len(done) - len(names):]
+            node = item
+            if any(v is not getattr(item, n) for v, n in zip(values, names)):
+                node = type(item)(**dict(zip(names, values)))
+                # Positions and other plain attributes carry over
+                for key, v in vars(item).items():
+                    if key not in names:
+                        setattr(node, key, v)
+            done.append(fn(node, item))
+        else:
+            done.append(item)
+    return done[0]
+
+def depth(root: object) -> int:
+    # Nesting depth of the AST nodes under `root`, which counts as 1
+    deepest = 0
+    stack: List[Tuple[object, int]] = [(root, 1)]
+    while stack:
+        node, d = stack.pop()
+        if isinstance(node, list):
+            stack.extend((n, d) for n in node)
+        elif hasattr(node, "__dataclass_fields__"):
+            deepest = max(deepest, d)
+            stack.extend((getattr(node, f.name), d + 1) for f in fields(node))
+    return deepest
+
+class _Raw(str):
+    # Text emitted as is by dump(), as opposed to a str value from the AST
+    pass
+
+_repr_names: Dict[type, Tuple[str, ...]] = {}
+
+def dump(root: object) -> str:
+    # Same text as repr(root), for any nesting depth: repr is quicker but
+    # recursive, so deep trees are printed with an explicit stack instead
+    try:
+        return repr(root)
+    except RecursionError:
+        return _dump(root)
+
+def _dump(root: object) -> str:
+    out: List[str] = []
+    stack: List[object] = [root]
+    while stack:
+        item = stack.pop()
+        if type(item) is _Raw:
+            out.append(item)
+        elif isinstance(item, list):
+            if not item:
+                out.append("[]")
+                continue
+            stack.append(_Raw("]"))
+            for i in range(len(item) - 1, 0, -1):
+                stack.append(item[i])
+                stack.append(_Raw(", "))
+            stack.append(item[0])
+            out.append("[")
+        elif hasattr(item, "__dataclass_fields__"):
+            cls = type(item)
+            names = _repr_names.get(cls)
+            if names is None:
+                names = _repr_names[cls] = tuple(f.name for f in fields(cls) if f.repr)
+            stack.append(_Raw(")"))
+            for i in range(len(names) - 1, -1, -1):
+                stack.append(getattr(item, names[i]))
+                stack.append(_Raw(f"{', ' if i else ''}{names[i]}="))
+            out.append(f"{cls.__qualname__}(")
+        else:
+            out.append(repr(item))
+    return "".join(out)
@@ -0,0 +1,158 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .parser import ParseError
+from .sema import SemanticError
+from .assembler_8086 import AsmError
+from .linker import LinkError
+from .cache import CompileCache, write_atomic
+from .driver import add_cache_arguments, add_opt_argument, build_output, cache_from_args, write_asm
+from .passes import DEFAULT_OPT_LEVEL
+
+# Batch mode: `quinc build a.ql dir/ -m manifest.txt -j 8` compiles every input
+# in one interpreter, spreading files over a process pool. Each worker imports
+# the compiler once and is reused for many files.
+
+@dataclass
+class Job:
+    source: Path
+    out: Path
+    cache_dir: Optional[Path] = None
+    cache_max_bytes: int = 0
+    opt: str = DEFAULT_OPT_LEVEL
+
+@dataclass
+class JobResult:
+    source: str
+    out: str
+    ok: bool
+    error: Optional[str] = None
+    seconds: float = 0.0
+    source_bytes: int = 0
+    out_bytes: int = 0
+    cached: bool = False
+
+# One cache object per worker process, so its size bookkeeping spans many jobs
+_caches: Dict[Tuple[Path, int], CompileCache] = {}
+
+def _cache_for(job: Job) -> Optional[CompileCache]:
+    if job.cache_dir is None:
+        return None
+    key = (job.cache_dir, job.cache_max_bytes)
+    if key not in _caches:
+        _caches[key] = CompileCache(job.cache_dir, job.cache_max_bytes)
+    return _caches[key]
+
+def compile_job(job: Job) -> JobResult:
+    start = time.perf_counter()
+    result = JobResult(str(job.source), str(job.out), ok=False)
+    try:
+        src = job.source.read_bytes()
+        result.source_bytes = len(src)
+        if job.out.suffix.lower() == ".com":
+            data, result.cached = build_output(src, str(job.source), "com", _cache_for(job), opt=job.opt)
+            write_atomic(job.out, data)
+        else:
+            result.cached = write_asm(src, str(job.source), job.out, _cache_for(job), opt=job.opt)
+        result.out_bytes = job.out.stat().st_size
+        result.ok = True
+    except (ParseError, SemanticError, AsmError, LinkError) as e:
+        result.error = str(e)
+    except (OSError, UnicodeDecodeError) as e:
+        result.error = f"cannot read or write: {e}"
+    except RecursionError:
+        result.error = "program nested too deeply to compile"
+    except Exception as e:
+        result.error = f"internal compiler error: {type(e).__name__}: {e}"
+    result.seconds = time.perf_counter() - start
+    return result
+
+def collect_inputs(paths: Sequence[Path], manifest: Optional[Path]) -> List[Tuple[Path, Path]]:
+    # (source, path relative to its input root) for every .ql named by a file
+    # argument, found under a directory argument, or listed in the manifest
+    found: List[Tuple[Path, Path]] = []
+    entries = list(paths)
+    if manifest is not None:
+        for line in manifest.read_text(encoding="utf-8").splitlines():
+            line = line.split("#", 1)[0].strip()
+            if line:
+                entries.append(manifest.parent / line)
+    for p in entries:
+        if p.is_dir():
+            found.extend((f, f.relative_to(p)) for f in sorted(p.rglob("*.ql")))
+        else:
+            found.append((p, Path(p.name)))
+    return found
+
+def plan_jobs(inputs: List[Tuple[Path, Path]], out_dir: Path, suffix: str,
+              cache: Optional[CompileCache] = None, opt: str = DEFAULT_OPT_LEVEL) -> List[Job]:
+    jobs: List[Job] = []
+    seen: Dict[Path, Path] = {}
+    for source, rel in inputs:
+        out = out_dir / rel.with_suffix(suffix)
+        if out in seen:
+            if seen[out].resolve() == source.resolve():
+                continue
+            raise ValueError(f"{source} and {seen[out]} would both be written to {out}")
+        seen[out] = source
+        if cache is None:
+            jobs.append(Job(source, out, opt=opt))
+        else:
+            jobs.append(Job(source, out, cache.root, cache.max_bytes, opt))
+    return jobs
+
+def run_jobs(jobs: List[Job], workers: int) -> List[JobResult]:
+    if workers <= 1 or len(jobs) <= 1:
+        return [compile_job(job) for job in jobs]
+    # Large chunks keep pickling overhead low for many small files
+    chunk = max(1, len(jobs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(compile_job, jobs, chunksize=chunk))
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(prog="quinc build", description="Compile many QuinLang files in one run")
+    ap.add_argument("inputs", type=Path, nargs="*", help=".ql files or directories to search")
+    ap.add_argument("-m", "--manifest", type=Path, help="File listing inputs, one per line ('#' comments)")
+    ap.add_argument("-o", "--out-dir", type=Path, default=Path("build"), help="Output directory")
+    ap.add_argument("--format", choices=("asm", "com"), default="asm", help="Output .asm text or .COM images")
+    ap.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="Worker processes")
+    ap.add_argument("-q", "--quiet", action="store_true", help="Only print failures and the summary")
+    add_opt_argument(ap)
+    add_cache_arguments(ap)
+    args = ap.parse_args(argv)
+
+    inputs = collect_inputs(args.inputs, args.manifest)
+    if not inputs:
+        ap.error("no input files")
+    try:
+        jobs = plan_jobs(inputs, args.out_dir, f".{args.format}", cache_from_args(args), args.opt)
+    except ValueError as e:
+        ap.error(str(e))
+
+    start = time.perf_counter()
+    results = run_jobs(jobs, args.jobs)
+    elapsed = time.perf_counter() - start
+
+    failed = 0
+    for r in results:
+        if r.ok:
+            if not args.quiet:
+                note = "cached" if r.cached else f"{r.seconds * 1000:.1f} ms"
+                print(f"{r.source} -> {r.out} ({note})")
+        else:
+            failed += 1
+            print(f"{r.source}: error: {r.error}", file=sys.stderr)
+    src_kib = sum(r.source_bytes for r in results) / 1024
+    print(f"{len(results) - failed}/{len(results)} files compiled in {elapsed:.2f}s "
+          f"with {min(args.jobs, len(jobs))} worker(s): "
+          f"{len(results) / elapsed:.1f} files/s, {src_kib / elapsed:.1f} KiB/s of source")
+    if jobs and jobs[0].cache_dir is not None:
+        hits = sum(1 for r in results if r.cached)
+        print(f"cache: {hits} hits, {len(results) - hits} misses")
+    sys.exit(1 if failed else 0)
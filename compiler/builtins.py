@@ -1,7 +1,60 @@
-from typing import Dict
-from .types import Type
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Tuple
+from .types import Type, Int, Str, Void
 
-# Placeholder for future built-in functions/types registration
+# Built-in intrinsics: typed like ordinary functions, but expanded inline by the
+# code generator instead of going through call/prologue/epilogue.
 
-def get_builtins() -> Dict[str, Type]:
-    return {}
\ No newline at end of file
+@dataclass(frozen=True)
+class Intrinsic:
+    name: str
+    params: Tuple[Type, ...]
+    ret: Type
+    # Register each argument ends up in; the last one is evaluated straight into AX
+    regs: Tuple[str, ...]
+    # Instruction templates; `{skip}` is replaced with a fresh local label
+    body: Tuple[str, ...]
+    clobbers: FrozenSet[str] = frozenset()
+
+_INTRINSICS = [
+    # Branchless |x|: DX = sign mask
+    Intrinsic("abs", (Int,), Int, ("ax",),
+              ("cwd", "xor ax, dx", "sub ax, dx"), frozenset({"dx"})),
+    Intrinsic("min", (Int, Int), Int, ("bx", "ax"),
+              ("cmp ax, bx", "jle {skip}", "mov ax, bx", "{skip}:"), frozenset({"bx"})),
+    Intrinsic("max", (Int, Int), Int, ("bx", "ax"),
+              ("cmp ax, bx", "jge {skip}", "mov ax, bx", "{skip}:"), frozenset({"bx"})),
+    # clamp(x, lo, hi)
+    Intrinsic("clamp", (Int, Int, Int), Int, ("bx", "dx", "ax"),
+              ("cmp bx, dx", "jge {skip}", "mov bx, dx", "{skip}:",
+               "cmp bx, ax", "jle {skip}_hi", "mov bx, ax", "{skip}_hi:", "mov ax, bx"),
+              frozenset({"bx", "dx"})),
+    # Logical shifts; the count goes through CL unless it is a small constant
+    Intrinsic("shl", (Int, Int), Int, ("ax", "cx"), ("shl ax, cl",), frozenset({"cx"})),
+    Intrinsic("shr", (Int, Int), Int, ("ax", "cx"), ("shr ax, cl",), frozenset({"cx"})),
+    Intrinsic("band", (Int, Int), Int, ("bx", "ax"), ("and ax, bx",), frozenset({"bx"})),
+    Intrinsic("bor", (Int, Int), Int, ("bx", "ax"), ("or ax, bx",), frozenset({"bx"})),
+    Intrinsic("bxor", (Int, Int), Int, ("bx", "ax"), ("xor ax, bx",), frozenset({"bx"})),
+    # Byte access through DS
+    Intrinsic("peekb", (Int,), Int, ("bx",),
+              ("mov al, [bx]", "xor ah, ah"), frozenset({"bx"})),
+    Intrinsic("pokeb", (Int, Int), Void, ("bx", "ax"),
+              ("mov [bx], al",), frozenset({"bx"})),
+    # memset(dst, value, count) / memcpy(dst, src, count): word moves plus an odd
+    # trailing byte. crt0 establishes ES = DS and DF = 0.
+    Intrinsic("memset", (Int, Int, Int), Void, ("di", "ax", "cx"),
+              ("mov ah, al", "shr cx, 1", "rep stosw", "adc cx, cx", "rep stosb"),
+              frozenset({"cx", "di"})),
+    Intrinsic("memcpy", (Int, Int, Int), Void, ("di", "si", "cx"),
+              ("shr cx, 1", "rep movsw", "adc cx, cx", "rep movsb"),
+              frozenset({"cx", "si", "di"})),
+    # Length of a '$'-terminated string
+    Intrinsic("strlen", (Str,), Int, ("di",),
+              ("mov al, '$'", "mov cx, 0xFFFF", "repne scasb", "mov ax, 0xFFFE", "sub ax, cx"),
+              frozenset({"cx", "di"})),
+]
+
+INTRINSICS: Dict[str, Intrinsic] = {i.name: i for i in _INTRINSICS}
+
+def get_builtins() -> Dict[str, Intrinsic]:
+    return dict(INTRINSICS)
@@ -0,0 +1,247 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Mapping, Optional, Tuple
+
+# Persistent content-addressed compilation cache. An entry is keyed by the
+# source bytes, a fingerprint of the compiler (its own code plus the runtime
+# and std library it embeds) and the codegen options, and holds the emitted
+# .asm and, once one has been assembled, the .COM image. Functions are cached
+# individually as well, for incremental recompilation of changed programs.
+#
+# Entries are plain files written by atomic rename, so concurrent builds can
+# share a cache directory: a reader sees a whole entry or none. Eviction is
+# least recently used by mtime, which a hit refreshes.
+
+ROOT = Path(__file__).resolve().parent.parent
+CACHE_ENV = "QUINC_CACHE_DIR"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# Whole-program .asm and .COM, per-function fragments (see incremental.py)
+# and compiled imported modules (see linker.py)
+ARTIFACT_KINDS = ("asm", "com", "fn", "obj")
+
+# Everything whose contents can change compiler output
+_FINGERPRINT_GLOBS = ("compiler/*.py", "runtime/*.asm", "runtime/*.inc", "std/*.ql")
+
+def default_cache_dir() -> Path:
+    env = os.environ.get(CACHE_ENV)
+    if env:
+        return Path(env)
+    base = os.environ.get("XDG_CACHE_HOME") or os.environ.get("LOCALAPPDATA")
+    return (Path(base) if base else Path.home() / ".cache") / "quinc"
+
+def write_atomic(path: Path, data: bytes):
+    with open_atomic(path) as f:
+        f.write(data)
+
+@contextmanager
+def open_atomic(path: Path) -> Iterator[BinaryIO]:
+    # Write to a temporary file in the same directory, then rename over the
+    # target, so readers never see a partial file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+@lru_cache(maxsize=None)
+def compiler_fingerprint() -> str:
+    h = hashlib.sha256()
+    for pattern in _FINGERPRINT_GLOBS:
+        for path in sorted(ROOT.glob(pattern)):
+            h.update(path.relative_to(ROOT).as_posix().encode("utf-8") + b"\0")
+            h.update(path.read_bytes() + b"\0")
+    return h.hexdigest()
+
+def cache_key(source: bytes, options: Optional[Mapping[str, object]] = None) -> str:
+    h = hashlib.sha256()
+    h.update(compiler_fingerprint().encode("ascii") + b"\0")
+    h.update(json.dumps(dict(options or {}), sort_keys=True).encode("utf-8") + b"\0")
+    h.update(source)
+    return h.hexdigest()
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+
+class CompileCache:
+    def __init__(self, root: Path, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        # Bytes stored since the last size check; trimming rescans the directory
+        self._written = 0
+        self._checked = False
+
+    def _path(self, key: str, kind: str) -> Path:
+        if kind not in ARTIFACT_KINDS:
+            raise ValueError(f"Unknown cache artifact '{kind}'")
+        return self.root / key[:2] / f"{key}.{kind}"
+
+    def get(self, key: str, kind: str) -> Optional[bytes]:
+        path = self._path(key, kind)
+        try:
+            data = path.read_bytes()
+        except OSError:
+            # Missing, or evicted by another build since we looked
+            self.stats.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.stats.hits += 1
+        return data
+
+    def get_into(self, key: str, kind: str, out: BinaryIO) -> bool:
+        # Like get, but copies the artifact to `out` rather than into memory
+        path = self._path(key, kind)
+        try:
+            f = path.open("rb")
+        except OSError:
+            self.stats.misses += 1
+            return False
+        with f:
+            shutil.copyfileobj(f, out)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.stats.hits += 1
+        return True
+
+    def put(self, key: str, kind: str, data: bytes):
+        try:
+            write_atomic(self._path(key, kind), data)
+        except OSError:
+            # A cache that can't be written is just a slower build
+            return
+        self._stored(len(data))
+
+    def put_file(self, key: str, kind: str, src: Path):
+        # Like put, for an artifact already written to `src`
+        try:
+            with src.open("rb") as f, open_atomic(self._path(key, kind)) as out:
+                shutil.copyfileobj(f, out)
+            size = src.stat().st_size
+        except OSError:
+            return
+        self._stored(size)
+
+    def _stored(self, size: int):
+        self.stats.stores += 1
+        self._written += size
+        if not self._checked or self._written > self.max_bytes // 8:
+            self.trim()
+
+    def entries(self) -> List[Tuple[float, int, Path]]:
+        # (mtime, size, path) of every artifact
+        out: List[Tuple[float, int, Path]] = []
+        if not self.root.is_dir():
+            return out
+        for path in self.root.glob("*/*"):
+            if path.name.startswith("."):
+                continue
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            out.append((st.st_mtime, st.st_size, path))
+        return out
+
+    def trim(self):
+        # Drop least recently used artifacts until the cache fits its budget
+        self._checked = True
+        self._written = 0
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+                self.stats.evictions += 1
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+class MemoryCache:
+    # Same interface as CompileCache, held in the process; used by the warm
+    # server (serve.py) so repeated requests never touch the disk
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES // 4):
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self._entries: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+        self._size = 0
+
+    def get(self, key: str, kind: str) -> Optional[bytes]:
+        data = self._entries.get((key, kind))
+        if data is None:
+            self.stats.misses += 1
+            return None
+        self._entries.move_to_end((key, kind))
+        self.stats.hits += 1
+        return data
+
+    def put(self, key: str, kind: str, data: bytes):
+        if kind not in ARTIFACT_KINDS:
+            raise ValueError(f"Unknown cache artifact '{kind}'")
+        old = self._entries.pop((key, kind), None)
+        if old is not None:
+            self._size -= len(old)
+        self._entries[(key, kind)] = data
+        self._size += len(data)
+        self.stats.stores += 1
+        while self._size > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+            self.stats.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Inspect or clear the QuinLang compilation cache")
+    ap.add_argument("--cache-dir", type=Path, default=None, help=f"Cache directory (default: ${CACHE_ENV} or ~/.cache/quinc)")
+    ap.add_argument("--clear", action="store_true", help="Remove every cached artifact")
+    args = ap.parse_args(argv)
+    cache = CompileCache(args.cache_dir or default_cache_dir())
+    if args.clear:
+        cache.clear()
+    entries = cache.entries()
+    size = sum(s for _, s, _ in entries)
+    print(f"{cache.root}: {len(entries)} artifacts, {size / 1024:.1f} KiB "
+          f"of {cache.max_bytes // (1024 * 1024)} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,365 @@
-from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import AbstractSet, Any, Callable, Dict, Generator, List, Optional, Sequence, Tuple
 from . import ast as A
-from .emitter import Emitter
-from .sema import Context
-from .layout import LayoutBuilder
-from .types import Int, Str, Bool
+from .emitter import Emitter, Fragment
+from .sema import Context, FunctionSig, SemanticAnalyzer, EXTERN_ARG_REGS, extern_symbol
+from .layout import LayoutBuilder, StackLayout
+from .types import ArrayType, Int, Str, Bool, ELEM_STRIDE
+from .builtins import INTRINSICS
+from .pgo import Profile, ProfileMap
+from .cost_8086 import cheapest
+from .passes import DEFAULT_OPT_LEVEL
+
+# Signed conditional jumps taken when `left op right` holds, and their inverses
+JCC = {'==': 'je', '!=': 'jne', '<': 'jl', '<=': 'jle', '>': 'jg', '>=': 'jge'}
+INV_JCC = {'==': 'jne', '!=': 'je', '<': 'jge', '<=': 'jg', '>': 'jle', '>=': 'jl'}
+
+# Constant shifts up to this count are unrolled as `shl ax, 1` rather than using
+# CL at -O0; above it the cost model decides, for counts up to MAX_SHIFT_COUNT
+MAX_UNROLLED_SHIFT = 4
+MAX_SHIFT_COUNT = 15
+
+# `x + k` is also tried as up to this many inc/dec; longer runs never beat an add
+MAX_INCDEC = 4
+
+# `a op b` is `b SWAPPED[op] a`, for evaluating a constant or variable `a` last
+SWAPPED = {'+': '+', '*': '*', '==': '==', '!=': '!=', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+# Arrays up to this many elements are zeroed with inline stores instead of a call
+MAX_INLINE_ZERO_ELEMS = 4
+
+# `loop` only takes a short displacement; 21 worst-case 6-byte instructions still fit
+LOOP_MAX_BODY_INSNS = 21
+
+# Workers receive functions pickled, which recurses through the AST: deeper
+# functions are generated in-process
+PARALLEL_MAX_DEPTH = 100
+
+# Code for a statement or expression is emitted by a generator, which yields the
+# generators of its operands and nested statements to have them run in place;
+# CodeGen8086._run keeps the suspended ones on an explicit stack, so nesting
+# depth isn't limited by Python's recursion limit
+Emit = Generator[Any, Any, None]
+
+# A profiled while loop is rotated (tested at the bottom) once its body runs at
+# least this many times per entry
+ROTATE_MIN_TRIPS = 2
 
 class CodeGen8086:
-    def __init__(self):
+    def __init__(self, instrument: Optional[ProfileMap] = None, profile: Optional[Profile] = None,
+                 opt: str = DEFAULT_OPT_LEVEL):
+        # `instrument` collects the counters of an instrumented build; `profile`
+        # holds counts from a training run to lay code out by. `opt` is the
+        # optimisation level instruction selection works to.
+        self.instrument = instrument
+        self.profile = profile
+        self.opt = opt
         self.em = Emitter()
-        self.fn_locals = {}  # name -> offset
+        self.fn_layout = StackLayout(0, {})
+        self.fn_locals = {}  # name -> offset of the variable it names here
+        self.fn_loops = {}  # id of each For -> offsets of its counter and end bound
+        self.reg_vars = {}  # name -> register, for variables not kept in the frame
+        self.cx_live = False  # CX holds a `loop` trip count
+        self.fn_arrays = {}  # name -> ArrayType, for names of arrays here
+        self.fn_statics = {}  # array name -> data label
+        self.shadowed: List[Tuple[Dict[str, Any], str, Any]] = []  # bindings to restore
+        self.var_ranges = {}  # name -> (lo, hi) proven bounds of a loop counter
+        self.bounds_lbl = None  # shared bounds-failure stub of the current function
+        self.frame_sizes = {}  # function name -> bytes reserved below BP
+        self.fragments: Dict[str, Fragment] = {}  # output of each function generated here
+        self.fn_name = ""
+        self.block_ordinals: Dict[str, int] = {}  # construct kind -> last ordinal used
+        self.fn_counts: Optional[Dict[str, int]] = None  # profile of the current function
+        self.cold_text: List[str] = []  # rarely run blocks, placed after the function
+        self.cold_lines: List[int] = []
+        # Functions whose source lines go in the line map; None for all
+        self.positioned: Optional[AbstractSet[str]] = None
+        # Called with each function's fragment once it is in the output
+        self.on_fragment: Optional[Callable[[str, Fragment], None]] = None
 
-    def generate(self, program: A.Program, ctx: Context) -> str:
-        for fn in program.functions:
-            self._emit_function(fn, ctx)
+    def generate(self, program: A.Program, ctx: Context,
+                 reuse: Optional[Dict[str, Fragment]] = None, jobs: int = 1) -> str:
+        self.emit(program, ctx, reuse, jobs)
         return self.em.render()
 
+    def emit(self, program: A.Program, ctx: Context,
+             reuse: Optional[Dict[str, Fragment]] = None, jobs: int = 1):
+        # Generate into the emitter without rendering, as before linking.
+        # Functions with a fragment in `reuse` are spliced in instead of generated.
+        # With `jobs` > 1 the rest are generated by a process pool; fragments are
+        # spliced in program order either way, so the output doesn't change.
+        reuse = reuse or {}
+        pending = [fn for fn in program.functions if not fn.extern and fn.name not in reuse]
+        if jobs > 1:
+            pending = [fn for fn in pending if A.depth(fn) <= PARALLEL_MAX_DEPTH]
+        if jobs > 1 and len(pending) > 1:
+            self.fragments.update(zip((fn.name for fn in pending),
+                                      generate_fragments(pending, [self._fn_line(fn) for fn in pending],
+                                                         ctx.functions, jobs, self.opt)))
+        for fn in program.functions:
+            if fn.extern:
+                continue
+            frag = reuse.get(fn.name) or self.fragments.get(fn.name)
+            if frag is not None:
+                self.em.splice(frag, self._fn_line(fn))
+                self.frame_sizes[fn.name] = frag.frame
+            else:
+                self.em.begin_function(self._fn_line(fn))
+                self._emit_function(fn, ctx)
+                self.fragments[fn.name] = frag = self.em.end_function()
+                frag.frame = self.frame_sizes[fn.name]
+            if self.on_fragment is not None:
+                self.on_fragment(fn.name, frag)
+        if self.instrument is not None:
+            self._emit_counter_table()
+
+    def _fn_line(self, fn: A.Function) -> int:
+        # Line code of `fn` is attributed from, 0 for none (std functions)
+        return fn.line if self.positioned is None or fn.name in self.positioned else 0
+
+    def _emit_counter_table(self):
+        n = len(self.instrument.counters)
+        self.em.add_include("runtime/profile.asm")
+        self.em.data.append(f"PGO_NCOUNTERS equ {n}")
+        for i in range(0, n, 16):
+            zeros = ", ".join("0" * min(16, n - i))
+            self.em.data.append(f"{'PGO_COUNTS ' if i == 0 else ''}dd {zeros}")
+
     def _emit_function(self, fn: A.Function, ctx: Context):
         # Prologue
         lb = LayoutBuilder()
-        layout = lb.build_for_function(fn)
-        self.fn_locals = layout.offsets
+        layout = lb.build_for_function(fn, ctx.functions[fn.name].recursive)
+        self.fn_layout = layout
+        self.fn_locals = dict(layout.offsets)
+        self.fn_loops = layout.loops
+        self.reg_vars = {}
+        self.cx_live = False
+        self.fn_arrays = {}
+        self.fn_statics = {}
+        self.shadowed = []
+        self.var_ranges = {}
+        self.bounds_lbl = None
+        self.fn_name = fn.name
+        self.block_ordinals = {}
+        self.fn_counts = self.profile.counts_for(fn) if self.profile is not None else None
+        self.cold_text, self.cold_lines = [], []
+        if self.instrument is not None:
+            self.instrument.add_function(fn)
+        self.frame_sizes[fn.name] = layout.size
+        for key, label in layout.statics.items():
+            self.em.add_bss(label, layout.arrays[key].size)
         self.em.emit(f"global {fn.name}")
         self.em.label(fn.name)
         self.em.emit("push bp")
         self.em.emit("mov bp, sp")
         if layout.size > 0:
             self.em.emit(f"sub sp, {layout.size}")
+        self._count("entry")
         # Body
         for st in fn.body:
-            self._emit_stmt(st, ctx)
+            self._run(self._emit_stmt(st, ctx))
         # Epilogue (implicit return)
+        if self.em.line:
+            self.em.line = fn.end_line
         self._emit_epilogue()
+        if self.bounds_lbl is not None:
+            self.em.label(self.bounds_lbl)
+            self.em.emit("jmp rt_bounds_fail")
+        self.em.paste(self.cold_text, self.cold_lines)
+
+    def _run(self, task: Generator[Any, Any, Any]) -> Any:
+        # Run `task` to completion: each generator it yields runs before it
+        # resumes, receiving that generator's return value
+        stack = [task]
+        value = None
+        while stack:
+            try:
+                sub = stack[-1].send(value)
+            except StopIteration as done:
+                stack.pop()
+                value = done.value
+                continue
+            stack.append(sub)
+            value = None
+        return value
+
+    def _bind_var(self, name: str, slot: Optional[int], arr: Optional[ArrayType] = None,
+                  label: Optional[str] = None):
+        # Make `name` refer to the variable in `slot` (or static `label`),
+        # which may shadow an outer one of another type
+        for names, value in ((self.fn_locals, slot), (self.fn_arrays, arr), (self.fn_statics, label)):
+            self.shadowed.append((names, name, names.get(name)))
+            _bind(names, name, value)
+
+    def _declare(self, st: A.VarDecl):
+        key = id(st)
+        layout = self.fn_layout
+        self._bind_var(st.name, layout.slots.get(key), layout.arrays.get(key), layout.statics.get(key))
+
+    def _emit_block(self, stmts: List[A.Stmt], ctx: Context, loop: Optional[A.For] = None) -> Emit:
+        # Names declared in a block go out of scope at its end. In the body of
+        # a for `loop` the counter's own slot stands for its name, which may
+        # also be a variable outside the loop.
+        mark = len(self.shadowed)
+        if loop is not None:
+            self._bind_var(loop.var, self.fn_loops[id(loop)][0])
+        for s in stmts:
+            yield self._emit_stmt(s, ctx)
+        while len(self.shadowed) > mark:
+            _bind(*self.shadowed.pop())
+
+    def _local(self, name: str, disp: int = 0) -> str:
+        # Frame operand of a local (below BP) or parameter (above BP)
+        return _frame(self.fn_locals[name], disp)
+
+    def _block(self, kind: str) -> str:
+        # Profile name of the next `kind` construct in the function, e.g. "if2"
+        n = self.block_ordinals.get(kind, 0) + 1
+        self.block_ordinals[kind] = n
+        return f"{kind}{n}"
+
+    def _count(self, block: str):
+        # Instrumented builds count each time control reaches this point
+        if self.instrument is None:
+            return
+        i = self.instrument.counter(self.fn_name, block)
+        self.em.emit(f"add word [PGO_COUNTS+{4 * i}], 1")
+        self.em.emit(f"adc word [PGO_COUNTS+{4 * i + 2}], 0")
+
+    def _hits(self, block: str) -> Optional[int]:
+        return None if self.fn_counts is None else self.fn_counts.get(block)
+
+    def _select(self, *alternatives: Sequence[str]) -> Sequence[str]:
+        # The instruction sequence the cost model prefers at this level; at
+        # -O0 the first, which callers make the fixed lowering
+        if self.opt == "0":
+            return alternatives[0]
+        return cheapest(self.opt, alternatives)
+
+    def _emit_lines(self, lines: Sequence[str]):
+        for line in lines:
+            self.em.emit(line)
+
+    def _emit_load_ax(self, value: int):
+        self._emit_lines(self._select([f"mov ax, {value}"], ["xor ax, ax"]) if value == 0
+                         else [f"mov ax, {value}"])
+
+    def _emit_test_ax(self):
+        # Flags for comparing AX with 0
+        self._emit_lines(self._select(["cmp ax, 0"], ["test ax, ax"]))
+
+    def _operand(self, e: A.Expr) -> Optional[str]:
+        # `e` as an instruction operand, if it is a constant or a variable that
+        # needn't be loaded into AX first: an immediate, CX or a frame slot
+        if isinstance(e, A.Literal) and isinstance(e.value, int):
+            return str(int(e.value))
+        if isinstance(e, A.Identifier):
+            if e.name in self.reg_vars:
+                return self.reg_vars[e.name]
+            if e.name in self.fn_locals and e.name not in self.fn_arrays:
+                return f"word {self._local(e.name)}"
+        return None
+
+    def _split(self, e: A.Binary) -> Optional[Tuple[A.Expr, A.Expr, str]]:
+        # (operand to evaluate into AX, operand to use in place, operator) for
+        # an int operation above -O0, when one side can be used in place
+        if self.opt == "0":
+            return None
+        if self._operand(e.right) is not None:
+            return e.left, e.right, e.op
+        if e.op in SWAPPED and self._operand(e.left) is not None:
+            # Constants and variables read the same before or after the other side
+            return e.right, e.left, SWAPPED[e.op]
+        return None
+
+    def _arith(self, op: str, e: A.Expr) -> List[List[str]]:
+        # Alternatives computing AX = AX op e, for an `e` that _operand accepts
+        x = self._operand(e)
+        k = int(e.value) if isinstance(e, A.Literal) else None
+        if op in ('+', '-'):
+            alts = [[f"{'add' if op == '+' else 'sub'} ax, {x}"]]
+            if k is not None:
+                n = k if op == '+' else -k
+                if abs(n) <= MAX_INCDEC:
+                    alts.append([f"{'inc' if n > 0 else 'dec'} ax"] * abs(n))
+            return alts
+        if op == '*':
+            if k is None:
+                alts = [[f"imul {x}"]]
+                if x.startswith("word"):
+                    alts.append([f"mov bx, {x}", "imul bx"])
+                return alts
+            alts = [[f"mov bx, {k}", "imul bx"]]
+            if k == 0:
+                alts.append(["xor ax, ax"])
+            elif k > 0 and k & (k - 1) == 0:
+                alts.append(["shl ax, 1"] * (k.bit_length() - 1))
+            return alts
+        # '/'; idiv truncates like the generic code
+        if k is None:
+            alts = [["cwd", f"idiv {x}"]]
+            if x.startswith("word"):
+                alts.append([f"mov bx, {x}", "cwd", "idiv bx"])
+            return alts
+        return [[f"mov bx, {k}", "cwd", "idiv bx"]] + ([[]] if k == 1 else [])
+
+    def _compare(self, e: A.Expr) -> List[List[str]]:
+        # Alternatives setting flags for comparing AX with e
+        alts = [[f"cmp ax, {self._operand(e)}"]]
+        if isinstance(e, A.Literal) and int(e.value) == 0:
+            alts.append(["test ax, ax"])
+        return alts
+
+    def _update_in_place(self, st: A.Assign) -> Optional[Sequence[str]]:
+        # Code for `x = x + e` or `x = x - e` with x in the frame and e an
+        # operand, which may add to the slot directly rather than loading and
+        # storing x; None for other assignments and at -O0
+        e = st.value
+        if (self.opt == "0" or st.name not in self.fn_locals or st.name in self.reg_vars
+                or not isinstance(e, A.Binary) or e.op not in ('+', '-')):
+            return None
+        if isinstance(e.left, A.Identifier) and e.left.name == st.name:
+            other = e.right
+        elif e.op == '+' and isinstance(e.right, A.Identifier) and e.right.name == st.name:
+            other = e.left
+        else:
+            return None
+        x = self._operand(other)
+        if x is None:
+            return None
+        slot = f"word {self._local(st.name)}"
+        op = 'add' if e.op == '+' else 'sub'
+        alts = [[f"mov ax, {slot}", *seq, f"mov {slot}, ax"] for seq in self._arith(e.op, other)]
+        if isinstance(other, A.Literal):
+            n = int(other.value) if e.op == '+' else -int(other.value)
+            alts.append([f"{op} {slot}, {int(other.value)}"])
+            if 0 < abs(n) <= MAX_INCDEC:
+                alts.append([f"{'inc' if n > 0 else 'dec'} {slot}"] * abs(n))
+        elif x.startswith("word"):
+            alts.append([f"mov ax, {x}", f"{op} {slot}, ax"])
+        else:
+            alts.append([f"{op} {slot}, {x}"])
+        return self._select(*alts)
 
     def _emit_epilogue(self):
+        if self.instrument is not None and self.fn_name == "main":
+            # The program exits as soon as main returns
+            self.em.emit("call rt_profile_dump")
         self.em.emit("mov sp, bp")
         self.em.emit("pop bp")
         self.em.emit("ret")
 
-    def _emit_stmt(self, st: A.Stmt, ctx: Context):
+    def _emit_stmt(self, st: A.Stmt, ctx: Context) -> Emit:
+        # Code is attributed to the innermost statement it was generated for
+        outer = self.em.line
+        self.em.line = (st.line or outer) if outer else 0
+        yield self._emit_stmt_code(st, ctx)
+        self.em.line = outer
+
+    def _emit_stmt_code(self, st: A.Stmt, ctx: Context) -> Emit:
         if isinstance(st, A.Print):
-            self._emit_expr(st.value, ctx)
+            yield self._emit_expr(st.value, ctx)
             t = ctx.get_type(st.value)
             if t == Str:
                 # AX holds pointer to '$' string
@@ -49,75 +369,476 @@ class CodeGen8086:
                 self.em.emit("call rt_print_num16")
         elif isinstance(st, A.Return):
             if st.value:
-                self._emit_expr(st.value, ctx)
+                yield self._emit_expr(st.value, ctx)
             self._emit_epilogue()
         elif isinstance(st, A.ExprStmt):
-            self._emit_expr(st.expr, ctx)
+            yield self._emit_expr(st.expr, ctx)
         elif isinstance(st, A.VarDecl):
-            # initialize or zero
+            # The initializer still sees an outer variable of the same name
             if st.init:
-                self._emit_expr(st.init, ctx)
-            else:
+                yield self._emit_expr(st.init, ctx)
+            self._declare(st)
+            if st.name in self.fn_arrays:
+                if st.init:
+                    self._emit_array_copy(st.name)
+                else:
+                    self._emit_array_zero(st.name)
+                return
+            if not st.init:
                 self.em.emit("xor ax, ax")
-            if st.name in self.fn_locals:
-                off = self.fn_locals[st.name]
-                self.em.emit(f"mov [bp-{off}], ax")
+            self.em.emit(f"mov {self._local(st.name)}, ax")
+        elif isinstance(st, A.Assign) and st.name in self.fn_arrays:
+            yield self._emit_expr(st.value, ctx)
+            self._emit_array_copy(st.name)
+        elif isinstance(st, A.IndexAssign):
+            operand = yield self._emit_elem_operand(st.name, st.index, ctx)
+            if 'si' in operand and not isinstance(st.value, (A.Literal, A.Identifier)):
+                # The value may index arrays or call routines that reuse SI
+                self.em.emit("push si")
+                yield self._emit_expr(st.value, ctx)
+                self.em.emit("pop si")
+            else:
+                yield self._emit_expr(st.value, ctx)
+            self.em.emit(f"mov {operand}, ax")
         elif isinstance(st, A.Assign):
-            self._emit_expr(st.value, ctx)
-            off = self.fn_locals.get(st.name)
-            if off is not None:
-                self.em.emit(f"mov [bp-{off}], ax")
+            update = self._update_in_place(st)
+            if update is not None:
+                self._emit_lines(update)
+                return
+            yield self._emit_expr(st.value, ctx)
+            if st.name in self.fn_locals:
+                self.em.emit(f"mov {self._local(st.name)}, ax")
         elif isinstance(st, A.If):
+            blk = self._block("if")
+            then_hits, else_hits = self._hits(f"{blk}.then"), self._hits(f"{blk}.else")
+            if then_hits is not None and else_hits is not None and then_hits != else_hits:
+                yield self._emit_profiled_if(st, then_hits > else_hits, ctx)
+                return
             else_lbl = self.em.unique_label("ELSE")
             end_lbl = self.em.unique_label("ENDIF")
-            self._emit_expr(st.cond, ctx)
-            self.em.emit("cmp ax, 0")
-            self.em.emit(f"je {else_lbl}")
-            for s in st.then_block:
-                self._emit_stmt(s, ctx)
+            yield self._emit_branch(st.cond, else_lbl, False, ctx)
+            self._count(f"{blk}.then")
+            yield self._emit_block(st.then_block, ctx)
             self.em.emit(f"jmp {end_lbl}")
             self.em.label(else_lbl)
+            self._count(f"{blk}.else")
             if st.else_block:
-                for s in st.else_block:
-                    self._emit_stmt(s, ctx)
+                yield self._emit_block(st.else_block, ctx)
             self.em.label(end_lbl)
         elif isinstance(st, A.While):
+            blk = self._block("while")
+            self._count(blk)
+            entries, trips = self._hits(blk), self._hits(f"{blk}.body")
+            if entries and trips is not None and trips >= ROTATE_MIN_TRIPS * entries:
+                # Hot loop: test at the bottom, so an iteration takes one branch
+                top = self.em.unique_label("WHL")
+                test = self.em.unique_label("WTST")
+                self.em.emit(f"jmp {test}")
+                self.em.label(top)
+                self._count(f"{blk}.body")
+                yield self._emit_block(st.body, ctx)
+                self.em.label(test)
+                yield self._emit_branch(st.cond, top, True, ctx)
+                return
             top = self.em.unique_label("WHL")
             end = self.em.unique_label("ENDW")
             self.em.label(top)
-            self._emit_expr(st.cond, ctx)
-            self.em.emit("cmp ax, 0")
-            self.em.emit(f"je {end}")
-            for s in st.body:
-                self._emit_stmt(s, ctx)
+            yield self._emit_branch(st.cond, end, False, ctx)
+            self._count(f"{blk}.body")
+            yield self._emit_block(st.body, ctx)
             self.em.emit(f"jmp {top}")
             self.em.label(end)
+        elif isinstance(st, A.For):
+            yield self._emit_for(st, ctx)
+
+    def _emit_profiled_if(self, st: A.If, then_hot: bool, ctx: Context) -> Emit:
+        # The arm the training run took more often falls through; the other is
+        # moved after the function and jumps back
+        else_block = st.else_block or []
+        hot, cold = (st.then_block, else_block) if then_hot else (else_block, st.then_block)
+        end_lbl = self.em.unique_label("ENDIF")
+        if not cold:
+            yield self._emit_branch(st.cond, end_lbl, not then_hot, ctx)
+            yield self._emit_block(hot, ctx)
+            self.em.label(end_lbl)
+            return
+        cold_lbl = self.em.unique_label("COLD")
+        yield self._emit_branch(st.cond, cold_lbl, not then_hot, ctx)
+        yield self._emit_block(hot, ctx)
+        self.em.label(end_lbl)
+        start = len(self.em.text)
+        self.em.label(cold_lbl)
+        yield self._emit_block(cold, ctx)
+        self.em.emit(f"jmp {end_lbl}")
+        text, lines = self.em.cut(start)
+        self.cold_text.extend(text)
+        self.cold_lines.extend(lines)
+
+    def _emit_for(self, st: A.For, ctx: Context) -> Emit:
+        counter_slot, end_slot = self.fn_loops[id(st)]
+        blk = self._block("for")
+        top = self.em.unique_label("FOR")
+        end = self.em.unique_label("ENDF")
+        body_nodes = list(A.walk(st.body))
+        reads_var = any(isinstance(n, A.Identifier) and n.name == st.var for n in body_nodes)
+        writes_var = any(isinstance(n, (A.Assign, A.VarDecl)) and n.name == st.var for n in body_nodes)
+        # Runtime routines preserve CX; user calls and nested loops don't
+        clobbers_cx = any(self._clobbers_cx(n, ctx) for n in body_nodes)
+        if not reads_var and not clobbers_cx and not writes_var:
+            # Pure trip count: CX = end - start, counted down by `loop`
+            if isinstance(st.start, A.Literal) and isinstance(st.end, A.Literal):
+                count = st.end.value - st.start.value
+                if count <= 0:
+                    return
+                self.em.emit(f"mov cx, {count}")
+            else:
+                yield self._emit_expr(st.start, ctx)
+                self.em.emit("push ax")
+                yield self._emit_expr(st.end, ctx)
+                self.em.emit("pop bx")
+                self.em.emit("mov cx, ax")
+                self.em.emit("sub cx, bx")
+                self.em.emit(f"jle {end}")
+            self.em.label(top)
+            body_start = len(self.em.text)
+            self._count(f"{blk}.body")
+            outer_cx_live, self.cx_live = self.cx_live, True
+            yield self._emit_block(st.body, ctx, st)
+            self.cx_live = outer_cx_live
+            body_insns = sum(1 for line in self.em.text[body_start:] if not line.endswith(':'))
+            if body_insns <= LOOP_MAX_BODY_INSNS:
+                self.em.emit(f"loop {top}")
+            else:
+                self.em.emit("dec cx")
+                self.em.emit(f"jnz {top}")
+            self.em.label(end)
+            return
+        in_cx = not clobbers_cx and not writes_var
+        const_range = isinstance(st.start, A.Literal) and isinstance(st.end, A.Literal)
+        if in_cx and const_range:
+            if st.start.value >= st.end.value:
+                return
+            self.em.emit(f"mov cx, {st.start.value}")
+            bound = str(st.end.value)
+        else:
+            # Bounds are evaluated once, start before end
+            yield self._emit_expr(st.start, ctx)
+            self.em.emit("push ax")
+            yield self._emit_expr(st.end, ctx)
+            if end_slot is not None:
+                self.em.emit(f"mov {_frame(end_slot)}, ax")
+                bound = f"word {_frame(end_slot)}"
+            else:
+                bound = str(st.end.value)
+            counter = "cx" if in_cx else "bx"
+            self.em.emit(f"pop {counter}")
+            if not in_cx:
+                self.em.emit(f"mov {_frame(counter_slot)}, bx")
+            self.em.emit(f"cmp {counter}, ax")
+            self.em.emit(f"jge {end}")
+        outer_range = self.var_ranges.pop(st.var, None)
+        if const_range and not writes_var:
+            # Known counter range lets array indexing skip bounds checks
+            self.var_ranges[st.var] = (st.start.value, st.end.value - 1)
+        self.em.label(top)
+        if in_cx:
+            # Induction variable lives in CX for the whole loop
+            self.reg_vars[st.var] = "cx"
+            self._count(f"{blk}.body")
+            yield self._emit_block(st.body, ctx, st)
+            del self.reg_vars[st.var]
+            self.em.emit("inc cx")
+            self.em.emit(f"cmp cx, {bound}")
+        else:
+            # Fallback: counter kept in its frame slot
+            self._count(f"{blk}.body")
+            yield self._emit_block(st.body, ctx, st)
+            self.em.emit(f"mov ax, {_frame(counter_slot)}")
+            self.em.emit("inc ax")
+            self.em.emit(f"mov {_frame(counter_slot)}, ax")
+            self.em.emit(f"cmp ax, {bound}")
+        self.em.emit(f"jl {top}")
+        self.em.label(end)
+        self.var_ranges.pop(st.var, None)
+        if outer_range is not None:
+            self.var_ranges[st.var] = outer_range
+
+    def _clobbers_cx(self, n: object, ctx: Context) -> bool:
+        if isinstance(n, A.For):
+            return True
+        if isinstance(n, (A.VarDecl, A.Assign)):
+            # Array zeroing and copying go through `rep` with a CX count
+            return n.name in self.fn_layout.array_names
+        if isinstance(n, A.Call):
+            if n.callee not in INTRINSICS:
+                # Externs preserve everything but AX, though CX may carry an argument
+                sig = ctx.functions[n.callee]
+                return not sig.extern or "cx" in EXTERN_ARG_REGS[:len(sig.params)]
+            if self._unrolled_shift(n, cx_live=True) is not None:
+                return False
+            return "cx" in INTRINSICS[n.callee].clobbers
+        return False
 
-    def _emit_expr(self, e: A.Expr, ctx: Context):
+    def _shift_count(self, e: A.Call) -> Optional[int]:
+        if e.callee in ('shl', 'shr'):
+            n = e.args[1]
+            if isinstance(n, A.Literal) and not isinstance(n.value, bool) and 0 <= n.value <= MAX_SHIFT_COUNT:
+                return n.value
+        return None
+
+    def _unrolled_shift(self, e: A.Call, cx_live: bool = False) -> Optional[int]:
+        # Count for a shift by a constant that is unrolled, which needs no CL.
+        # Above -O0 that is every constant shift while CX holds a loop
+        # variable or trip count, else those the cost model prefers unrolled.
+        n = self._shift_count(e)
+        if n is None or self.opt == "0":
+            return n if n is not None and n <= MAX_UNROLLED_SHIFT else None
+        if cx_live or self.cx_live or self.reg_vars:
+            return n
+        unrolled = [f"{e.callee} ax, 1"] * n
+        return n if self._select(unrolled, [f"mov cl, {n}", f"{e.callee} ax, cl"]) is unrolled else None
+
+    def _emit_args_to_regs(self, args: List[A.Expr], regs: Sequence[str], ctx: Context) -> Emit:
+        # Arguments are evaluated left to right; all but the last wait on the stack
+        if not args:
+            return
+        for a in args[:-1]:
+            yield self._emit_expr(a, ctx)
+            self.em.emit("push ax")
+        yield self._emit_expr(args[-1], ctx)
+        if regs[-1] != "ax":
+            self.em.emit(f"mov {regs[-1]}, ax")
+        for reg in reversed(regs[:-1]):
+            self.em.emit(f"pop {reg}")
+
+    def _emit_intrinsic(self, e: A.Call, ctx: Context) -> Emit:
+        intr = INTRINSICS[e.callee]
+        count = self._unrolled_shift(e)
+        if count is not None:
+            yield self._emit_expr(e.args[0], ctx)
+            for _ in range(count):
+                self.em.emit(f"{e.callee} ax, 1")
+            return
+        count = self._shift_count(e)
+        if count is not None and self.opt != "0":
+            yield self._emit_expr(e.args[0], ctx)
+            self.em.emit(f"mov cl, {count}")
+            self.em.emit(f"{e.callee} ax, cl")
+            return
+        yield self._emit_args_to_regs(e.args, intr.regs, ctx)
+        skip = self.em.unique_label("SKP") if any("{skip}" in line for line in intr.body) else ""
+        for line in intr.body:
+            line = line.format(skip=skip)
+            if line.endswith(':'):
+                self.em.label(line[:-1])
+            else:
+                self.em.emit(line)
+
+    def _range_of(self, e: A.Expr) -> Optional[Tuple[int, int]]:
+        # Conservative inclusive value range of an int expression, if provable.
+        # Post-order with an explicit stack; `ranges` holds the operands' ranges.
+        ranges: List[Optional[Tuple[int, int]]] = []
+        stack: List[Tuple[A.Expr, bool]] = [(e, False)]
+        while stack:
+            node, ready = stack.pop()
+            operands = self._range_operands(node)
+            if not operands:
+                ranges.append(self._leaf_range(node))
+            elif not ready:
+                stack.append((node, True))
+                stack.extend((a, False) for a in reversed(operands))
+            else:
+                rs = ranges[len(ranges) - len(operands):]
+                del ranges[len(ranges) - len(operands):]
+                ranges.append(self._combine_ranges(node, rs))
+        return ranges[0]
+
+    def _range_operands(self, e: A.Expr) -> List[A.Expr]:
+        # Operands whose ranges bound that of `e`
+        if isinstance(e, A.Binary) and e.op in ('+', '-'):
+            return [e.left, e.right]
+        if isinstance(e, A.Call) and e.callee == 'band':
+            return e.args
+        if isinstance(e, A.Call) and e.callee == 'clamp':
+            return e.args[1:3]
+        return []
+
+    def _leaf_range(self, e: A.Expr) -> Optional[Tuple[int, int]]:
+        if isinstance(e, A.Literal) and isinstance(e.value, int) and not isinstance(e.value, bool):
+            return (e.value, e.value)
+        if isinstance(e, A.Identifier):
+            return self.var_ranges.get(e.name)
+        return None
+
+    def _combine_ranges(self, e: A.Expr, rs: List[Optional[Tuple[int, int]]]) -> Optional[Tuple[int, int]]:
+        if isinstance(e, A.Binary):
+            lr, rr = rs
+            if lr is None or rr is None:
+                return None
+            if e.op == '+':
+                lo, hi = lr[0] + rr[0], lr[1] + rr[1]
+            else:
+                lo, hi = lr[0] - rr[1], lr[1] - rr[0]
+            # Give up if 16-bit wraparound is possible
+            if lo < -32768 or hi > 32767:
+                return None
+            return (lo, hi)
+        if e.callee == 'band':
+            # x & m with a non-negative constant mask lies in [0, m]
+            for r in rs:
+                if r is not None and r[0] == r[1] and r[0] >= 0:
+                    return (0, r[0])
+            return None
+        # clamp(x, lo, hi) applies lo first, so it returns hi when hi < lo
+        lo, hi = rs
+        if lo is not None and hi is not None:
+            return (min(lo[0], hi[0]), hi[1])
+        return None
+
+    def _emit_elem_operand(self, name: str, index: A.Expr, ctx: Context) -> Generator[Emit, Any, str]:
+        # Emit index computation and bounds check; return the element's memory operand
+        arr = self.fn_arrays[name]
+        label = self.fn_statics.get(name)
+        r = self._range_of(index)
+        if r is not None and r[0] == r[1] and 0 <= r[0] < arr.length:
+            k = r[0] * ELEM_STRIDE
+            if label is not None:
+                return f"word [{label}+{k}]"
+            return f"word {self._local(name, k)}"
+        if isinstance(index, A.Identifier) and index.name in self.reg_vars:
+            self.em.emit(f"mov si, {self.reg_vars[index.name]}")
+        elif isinstance(index, A.Identifier) and index.name in self.fn_locals:
+            self.em.emit(f"mov si, {self._local(index.name)}")
+        else:
+            yield self._emit_expr(index, ctx)
+            self.em.emit("mov si, ax")
+        if r is None or r[0] < 0 or r[1] >= arr.length:
+            if self.bounds_lbl is None:
+                self.bounds_lbl = self.em.unique_label("BND")
+            # Unsigned compare also rejects negative indices
+            self.em.emit(f"cmp si, {arr.length}")
+            self.em.emit(f"jae {self.bounds_lbl}")
+        self.em.emit("shl si, 1")
+        if label is not None:
+            return f"word [si+{label}]"
+        return f"word [bp+si{-self.fn_locals[name]:+d}]"
+
+    def _emit_array_addr(self, name: str, reg: str):
+        label = self.fn_statics.get(name)
+        if label is not None:
+            self.em.emit(f"mov {reg}, {label}")
+        else:
+            self.em.emit(f"lea {reg}, {self._local(name)}")
+
+    def _emit_array_zero(self, name: str):
+        arr = self.fn_arrays[name]
+        if arr.length <= MAX_INLINE_ZERO_ELEMS and name not in self.fn_statics:
+            self.em.emit("xor ax, ax")
+            for k in range(arr.length):
+                self.em.emit(f"mov {self._local(name, k * ELEM_STRIDE)}, ax")
+            return
+        self._emit_array_addr(name, "di")
+        self.em.emit(f"mov cx, {arr.length}")
+        self.em.emit("call rt_mem_zero16")
+
+    def _emit_array_copy(self, name: str):
+        # AX holds the source array's address
+        self.em.emit("mov si, ax")
+        self._emit_array_addr(name, "di")
+        self.em.emit(f"mov cx, {self.fn_arrays[name].length}")
+        self.em.emit("call rt_mem_copy16")
+
+    def _emit_branch(self, e: A.Expr, target: str, when: bool, ctx: Context) -> Emit:
+        # Jump to `target` if `e` evaluates to `when`, otherwise fall through.
+        # Logical operators short-circuit and comparisons jump on flags directly,
+        # so no 0/1 value is materialised in condition context.
+        if isinstance(e, A.Literal) and isinstance(e.value, bool):
+            if e.value == when:
+                self.em.emit(f"jmp {target}")
+            return
+        if isinstance(e, A.Unary) and e.op == '!':
+            yield self._emit_branch(e.right, target, not when, ctx)
+            return
+        if isinstance(e, A.Binary) and e.op in ('&&', '||'):
+            # `a && b` is false as soon as `a` is; `a || b` is true as soon as `a` is
+            short = e.op == '||'
+            if when == short:
+                yield self._emit_branch(e.left, target, when, ctx)
+                yield self._emit_branch(e.right, target, when, ctx)
+            else:
+                skip = self.em.unique_label("SC")
+                yield self._emit_branch(e.left, skip, short, ctx)
+                yield self._emit_branch(e.right, target, when, ctx)
+                self.em.label(skip)
+            return
+        if isinstance(e, A.Binary) and e.op in JCC:
+            jcc = JCC[e.op] if when else INV_JCC[e.op]
+            split = self._split(e)
+            if ctx.get_type(e.left) == Str and ctx.get_type(e.right) == Str:
+                yield self._emit_str_cmp(e, ctx)
+                self._emit_test_ax()
+            elif split is not None:
+                first, operand, op = split
+                jcc = JCC[op] if when else INV_JCC[op]
+                yield self._emit_expr(first, ctx)
+                self._emit_lines(self._select(*self._compare(operand)))
+            else:
+                yield self._emit_expr(e.left, ctx)
+                self.em.emit("push ax")
+                yield self._emit_expr(e.right, ctx)
+                self.em.emit("pop bx")
+                self.em.emit("cmp bx, ax")
+            self.em.emit(f"{jcc} {target}")
+            return
+        yield self._emit_expr(e, ctx)
+        self._emit_test_ax()
+        self.em.emit(f"{'jne' if when else 'je'} {target}")
+
+    def _emit_str_cmp(self, e: A.Binary, ctx: Context) -> Emit:
+        yield self._emit_expr(e.left, ctx)   # AX = left
+        self.em.emit("push ax")
+        yield self._emit_expr(e.right, ctx)  # AX = right
+        self.em.emit("mov di, ax")
+        self.em.emit("pop si")
+        self.em.emit("call rt_str_cmp")  # AX <0, =0, >0
+
+    def _emit_expr(self, e: A.Expr, ctx: Context) -> Emit:
         if isinstance(e, A.Literal):
+            # bool is a subclass of int, so test it first
+            if isinstance(e.value, bool):
+                self._emit_load_ax(1 if e.value else 0)
+                return
             if isinstance(e.value, int):
-                self.em.emit(f"mov ax, {e.value}")
+                self._emit_load_ax(e.value)
                 return
             if isinstance(e.value, str):
                 lbl = self.em.add_string(e.value)
                 self.em.emit(f"mov ax, {lbl}")
                 return
-            if isinstance(e.value, bool):
-                self.em.emit(f"mov ax, {1 if e.value else 0}")
-                return
+        if isinstance(e, A.Identifier) and e.name in self.fn_arrays:
+            # An array used as a value is its address
+            self._emit_array_addr(e.name, "ax")
+            return
+        if isinstance(e, A.Index):
+            operand = yield self._emit_elem_operand(e.name, e.index, ctx)
+            self.em.emit(f"mov ax, {operand}")
+            return
         if isinstance(e, A.Identifier):
-            off = self.fn_locals.get(e.name)
-            if off is not None:
-                self.em.emit(f"mov ax, [bp-{off}]")
+            reg = self.reg_vars.get(e.name)
+            if reg is not None:
+                self.em.emit(f"mov ax, {reg}")
+                return
+            if e.name in self.fn_locals:
+                self.em.emit(f"mov ax, {self._local(e.name)}")
             else:
                 self.em.emit("xor ax, ax")
             return
         if isinstance(e, A.Unary):
-            self._emit_expr(e.right, ctx)
+            yield self._emit_expr(e.right, ctx)
             if e.op == '-':
                 self.em.emit("neg ax")
             elif e.op == '!':
-                self.em.emit("cmp ax, 0")
+                self._emit_test_ax()
                 t_lbl = self.em.unique_label("T")
                 e_lbl = self.em.unique_label("E")
                 self.em.emit(f"je {t_lbl}")
@@ -130,33 +851,38 @@ class CodeGen8086:
         if isinstance(e, A.Binary):
             lt = ctx.get_type(e.left)
             rt = ctx.get_type(e.right)
+            if e.op in ('&&', '||'):
+                f_lbl = self.em.unique_label("F")
+                e_lbl = self.em.unique_label("E")
+                yield self._emit_branch(e, f_lbl, False, ctx)
+                self.em.emit("mov ax, 1")
+                self.em.emit(f"jmp {e_lbl}")
+                self.em.label(f_lbl)
+                self.em.emit("xor ax, ax")
+                self.em.label(e_lbl)
+                return
             if lt == Str and rt == Str and e.op in ('==', '!=', '<', '<=', '>', '>='):
                 # string compare
-                self._emit_expr(e.left, ctx)   # AX = left
-                self.em.emit("push ax")
-                self._emit_expr(e.right, ctx)  # AX = right
-                self.em.emit("mov di, ax")
-                self.em.emit("pop si")
-                self.em.emit("call rt_str_cmp")  # AX <0, =0, >0
+                yield self._emit_str_cmp(e, ctx)
                 t = self.em.unique_label("T")
                 e_lbl = self.em.unique_label("E")
                 if e.op == '==':
-                    self.em.emit("cmp ax, 0")
+                    self._emit_test_ax()
                     self.em.emit(f"je {t}")
                 elif e.op == '!=':
-                    self.em.emit("cmp ax, 0")
+                    self._emit_test_ax()
                     self.em.emit(f"jne {t}")
                 elif e.op == '<':
-                    self.em.emit("cmp ax, 0")
+                    self._emit_test_ax()
                     self.em.emit(f"jl {t}")
                 elif e.op == '<=':
-                    self.em.emit("cmp ax, 0")
+                    self._emit_test_ax()
                     self.em.emit(f"jle {t}")
                 elif e.op == '>':
-                    self.em.emit("cmp ax, 0")
+                    self._emit_test_ax()
                     self.em.emit(f"jg {t}")
                 elif e.op == '>=':
-                    self.em.emit("cmp ax, 0")
+                    self._emit_test_ax()
                     self.em.emit(f"jge {t}")
                 self.em.emit("xor ax, ax")
                 self.em.emit(f"jmp {e_lbl}")
@@ -165,9 +891,26 @@ class CodeGen8086:
                 self.em.label(e_lbl)
                 return
             # integer ops
-            self._emit_expr(e.left, ctx)
+            split = self._split(e)
+            if split is not None:
+                first, operand, op = split
+                yield self._emit_expr(first, ctx)
+                if op in JCC:
+                    self._emit_lines(self._select(*self._compare(operand)))
+                    t = self.em.unique_label("T")
+                    e_lbl = self.em.unique_label("E")
+                    self.em.emit(f"{JCC[op]} {t}")
+                    self.em.emit("xor ax, ax")
+                    self.em.emit(f"jmp {e_lbl}")
+                    self.em.label(t)
+                    self.em.emit("mov ax, 1")
+                    self.em.label(e_lbl)
+                else:
+                    self._emit_lines(self._select(*self._arith(op, operand)))
+                return
+            yield self._emit_expr(e.left, ctx)
             self.em.emit("push ax")
-            self._emit_expr(e.right, ctx)
+            yield self._emit_expr(e.right, ctx)
             self.em.emit("pop bx")
             if e.op == '+':
                 self.em.emit("add ax, bx")
@@ -177,6 +920,7 @@ class CodeGen8086:
             elif e.op == '*':
                 self.em.emit("imul bx")
             elif e.op == '/':
+                self.em.emit("xchg ax, bx")
                 self.em.emit("cwd")
                 self.em.emit("idiv bx")
             elif e.op in ('==', '!=', '<', '<=', '>', '>='):
@@ -202,7 +946,59 @@ class CodeGen8086:
                 self.em.label(e_lbl)
             return
         if isinstance(e, A.Call):
-            # Zero-arg calls only for now
+            if e.callee in INTRINSICS:
+                yield self._emit_intrinsic(e, ctx)
+                return
+            sig = ctx.functions[e.callee]
+            if sig.extern:
+                # Runtime routines take arguments in registers and preserve all but AX
+                yield self._emit_args_to_regs(e.args, EXTERN_ARG_REGS[:len(e.args)], ctx)
+                if sig.asm_source:
+                    self.em.add_include(sig.asm_source)
+                self._count(self._block("call"))
+                self.em.emit(f"call {extern_symbol(e.callee)}")
+                return
+            # Arguments are pushed right to left and popped by the caller
+            for a in reversed(e.args):
+                yield self._emit_expr(a, ctx)
+                self.em.emit("push ax")
+            self.em.add_call(e.callee)
+            self._count(self._block("call"))
             self.em.emit(f"call {e.callee}")
+            if e.args:
+                self.em.emit(f"add sp, {2 * len(e.args)}")
             return
         self.em.emit("xor ax, ax")
+
+
+def _bind(names: Dict[str, Any], name: str, value: Any):
+    if value is None:
+        names.pop(name, None)
+    else:
+        names[name] = value
+
+def _frame(offset: int, disp: int = 0) -> str:
+    # Frame operand at `offset` below BP (above it when negative)
+    return f"[bp{disp - offset:+d}]"
+
+def generate_fragment(fn: A.Function, line: int, functions: Dict[str, FunctionSig],
+                      opt: str = DEFAULT_OPT_LEVEL) -> Fragment:
+    # Analyse and generate one function on its own emitter. Expression types
+    # are keyed by node identity, which doesn't survive pickling, so a worker
+    # re-runs the (cheap) body analysis on its copy of the function.
+    sa = SemanticAnalyzer()
+    sa.ctx.functions = functions
+    ctx = sa.analyze_bodies(A.Program([fn]))
+    cg = CodeGen8086(opt=opt)
+    cg.em.begin_function(line)
+    cg._emit_function(fn, ctx)
+    frag = cg.em.end_function()
+    frag.frame = cg.frame_sizes[fn.name]
+    return frag
+
+def generate_fragments(fns: List[A.Function], lines: List[int], functions: Dict[str, FunctionSig],
+                       jobs: int, opt: str = DEFAULT_OPT_LEVEL) -> List[Fragment]:
+    # Large chunks keep pickling overhead low for many small functions
+    chunk = max(1, len(fns) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(partial(generate_fragment, functions=functions, opt=opt), fns, lines, chunksize=chunk))
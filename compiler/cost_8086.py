@@ -0,0 +1,197 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .assembler_8086 import Imm, Mem, Reg, MEM_RM, UNARY_OPS, AsmError, parse_operand
+from .sim_8086 import EA_CYCLES, MULDIV_CYCLES, MULDIV_MEM_EXTRA
+
+# 8086 cost model for instruction selection: the clock cycles and encoded
+# size of the straight-line instructions CodeGen8086 chooses between. Cycles
+# are the Intel timing-table figures sim_8086 charges, plus effective-address
+# calculation for a memory operand; sizes are opcode and ModRM bytes plus the
+# displacement and immediate, encoded as assembler_8086 does (sign-extended
+# imm8 where it fits, disp8 for small frame offsets).
+
+@dataclass(frozen=True)
+class Cost:
+    cycles: int
+    size: int
+
+    def __add__(self, other: "Cost") -> "Cost":
+        return Cost(self.cycles + other.cycles, self.size + other.size)
+
+# (mnemonic or group, operand form) -> (cycles excluding EA, bytes excluding
+# displacement and immediate). Forms: r register, a AX/AL, d direct memory
+# operand ([label]) with AX/AL, m memory, i immediate, 1 and cl shift counts.
+# A mnemonic's own entry is preferred to its group's.
+TIMINGS: Dict[Tuple[str, str], Tuple[int, int]] = {
+    ("mov", "r,r"): (2, 2), ("mov", "r,m"): (8, 2), ("mov", "m,r"): (9, 2),
+    ("mov", "a,d"): (10, 1), ("mov", "d,a"): (10, 1),
+    ("mov", "r,i"): (4, 1), ("mov", "m,i"): (10, 2),
+    ("alu", "r,r"): (3, 2), ("alu", "r,m"): (9, 2), ("alu", "m,r"): (16, 2),
+    ("alu", "a,i"): (4, 1), ("alu", "r,i"): (4, 2), ("alu", "m,i"): (17, 2),
+    # cmp reads its destination without writing it back
+    ("cmp", "m,r"): (9, 2), ("cmp", "m,i"): (10, 2),
+    ("test", "r,r"): (3, 2), ("test", "r,m"): (9, 2), ("test", "m,r"): (9, 2),
+    ("test", "a,i"): (4, 1), ("test", "r,i"): (5, 2), ("test", "m,i"): (11, 2),
+    ("incdec", "r"): (2, 1), ("incdec", "r8"): (3, 2), ("incdec", "m"): (15, 2),
+    ("negnot", "r"): (3, 2), ("negnot", "m"): (16, 2),
+    # Plus 4 cycles per bit shifted by CL
+    ("shift", "r,1"): (2, 2), ("shift", "m,1"): (15, 2),
+    ("shift", "r,cl"): (8, 2), ("shift", "m,cl"): (20, 2),
+    ("push", "r"): (11, 1), ("push", "m"): (16, 2),
+    ("pop", "r"): (8, 1), ("pop", "m"): (17, 2),
+    ("xchg", "a,r"): (3, 1), ("xchg", "r,r"): (4, 2), ("xchg", "r,m"): (17, 2), ("xchg", "m,r"): (17, 2),
+    ("lea", "r,m"): (2, 2),
+    ("cwd", ""): (5, 1), ("cbw", ""): (2, 1),
+}
+SHIFT_CYCLES_PER_BIT = 4
+
+GROUPS = {
+    **{m: "alu" for m in ("add", "or", "adc", "sbb", "and", "sub", "xor", "cmp")},
+    "inc": "incdec", "dec": "incdec", "neg": "negnot", "not": "negnot",
+    **{m: "shift" for m in ("rol", "ror", "rcl", "rcr", "shl", "sal", "shr", "sar")},
+}
+
+# What instruction selection minimises at each optimisation level. The timing
+# tables assume the prefetch queue keeps up; it doesn't in straight-line code,
+# where the 8086 needs about 2 cycles of bus time per instruction byte, so -O1
+# charges that too and only spends code size where it buys clear speed. -O2
+# minimises the table cycles (what the simulator measures), -Os the bytes.
+FETCH_CYCLES_PER_BYTE = 2
+
+def score(cost: Cost, level: str) -> Tuple[int, int]:
+    if level == "s":
+        return (cost.size, cost.cycles)
+    if level == "2":
+        return (cost.cycles, cost.size)
+    return (cost.cycles + FETCH_CYCLES_PER_BYTE * cost.size, cost.size)
+
+def cheapest(level: str, alternatives: Sequence[Sequence[str]]) -> Sequence[str]:
+    # The alternative instruction sequence preferred at `level`; the earliest
+    # of equally good ones
+    return min(alternatives, key=lambda seq: score(sequence_cost(seq), level))
+
+def sequence_cost(lines: Sequence[str]) -> Cost:
+    # A shift by CL counts the bits loaded into CL or CX earlier in `lines`, else 1
+    total = Cost(0, 0)
+    count = 1
+    for line in lines:
+        total += instruction_cost(line, count)
+        mnemonic, _, rest = line.strip().partition(" ")
+        dst, _, src = rest.partition(",")
+        if mnemonic == "mov" and dst.strip() in ("cl", "cx"):
+            count = _number(src.strip()) or 1
+    return total
+
+def instruction_cost(line: str, cl: int = 1) -> Cost:
+    # Cost of one instruction; `cl` is the count of a shift by CL
+    mnemonic, _, rest = line.strip().lower().partition(" ")
+    try:
+        ops = [parse_operand(text.strip(), "") for text in rest.split(",")] if rest.strip() else []
+    except AsmError as e:
+        raise ValueError(f"No cost for '{line}': {e}")
+    if mnemonic in UNARY_OPS and mnemonic not in GROUPS and len(ops) == 1:
+        # mul/imul/div/idiv, timed by the simulator's midpoint figures
+        op = ops[0]
+        w = 1 if _width(op) == 2 else 0
+        cycles = MULDIV_CYCLES[(UNARY_OPS[mnemonic], w)]
+        if isinstance(op, Mem):
+            ea, disp = _ea(op)
+            return Cost(cycles + MULDIV_MEM_EXTRA + ea, 2 + disp)
+        return Cost(cycles, 2)
+    form, ea, extra = _form(mnemonic, ops)
+    group = GROUPS.get(mnemonic, mnemonic)
+    entry = TIMINGS.get((mnemonic, form)) or TIMINGS.get((group, form))
+    if entry is None:
+        raise ValueError(f"No cost for '{line}'")
+    cycles, size = entry
+    if group == "shift" and form.endswith("cl"):
+        cycles += SHIFT_CYCLES_PER_BIT * cl
+    return Cost(cycles + ea, size + extra)
+
+def _form(mnemonic: str, ops: List[object]) -> Tuple[str, int, int]:
+    # (operand form, EA cycles, displacement and immediate bytes)
+    kinds: List[str] = []
+    ea = extra = 0
+    for i, op in enumerate(ops):
+        if isinstance(op, Reg):
+            if op.name == "cl" and i == 1 and GROUPS.get(mnemonic) == "shift":
+                kinds.append("cl")
+            elif mnemonic in ("inc", "dec") and op.size == 1:
+                kinds.append("r8")
+            else:
+                kinds.append("r")
+        elif isinstance(op, Mem):
+            op_ea, disp = _ea(op)
+            ea += op_ea
+            extra += disp
+            kinds.append("m")
+        elif isinstance(op, Imm):
+            value = _value(op.expr)
+            if GROUPS.get(mnemonic) == "shift":
+                kinds.append("1")
+                continue
+            kinds.append("i")
+            width = _width(ops[0]) if ops else 2
+            if GROUPS.get(mnemonic) == "alu" and width == 2 and value is not None and -128 <= value <= 127:
+                extra += 1
+            else:
+                extra += width
+                if GROUPS.get(mnemonic) == "alu" and isinstance(ops[0], Reg) and ops[0].code == 0:
+                    kinds[0] = "a"
+            if mnemonic == "test" and isinstance(ops[0], Reg) and ops[0].code == 0:
+                kinds[0] = "a"
+    form = ",".join(kinds)
+    if mnemonic == "mov" and len(ops) == 2:
+        # AX/AL to or from a fixed address has a short form without ModRM
+        dst, src = ops
+        if isinstance(dst, Reg) and dst.code == 0 and isinstance(src, Mem) and not src.regs:
+            return "a,d", 0, extra
+        if isinstance(src, Reg) and src.code == 0 and isinstance(dst, Mem) and not dst.regs:
+            return "d,a", 0, extra
+    if mnemonic == "xchg" and form == "r,r" and any(op.code == 0 and op.size == 2 for op in ops):
+        form = "a,r"
+    return form, ea, extra
+
+def _ea(mem: Mem) -> Tuple[int, int]:
+    # (effective-address cycles, displacement bytes), as sim_8086 charges them
+    if not mem.regs:
+        return 6, 2
+    rm = MEM_RM[mem.regs]
+    if mem.disp is None:
+        disp: Optional[int] = 0
+    else:
+        disp = _value(mem.disp)
+    if disp is None:
+        return EA_CYCLES[rm] + 4, 2
+    if disp == 0 and rm != 6:
+        return EA_CYCLES[rm], 0
+    return EA_CYCLES[rm] + 4, 1 if -128 <= disp <= 127 else 2
+
+def _width(op: object) -> int:
+    if isinstance(op, Reg):
+        return op.size
+    if isinstance(op, (Mem, Imm)) and op.size:
+        return op.size
+    return 2
+
+def _value(e: tuple) -> Optional[int]:
+    # Value of a constant operand expression; None if it names a symbol
+    kind = e[0]
+    if kind == "num":
+        return e[1]
+    if kind == "neg":
+        v = _value(e[1])
+        return None if v is None else -v
+    if kind in ("+", "-", "*"):
+        a, b = _value(e[1]), _value(e[2])
+        if a is None or b is None:
+            return None
+        return a + b if kind == "+" else a - b if kind == "-" else a * b
+    return None
+
+def _number(text: str) -> Optional[int]:
+    try:
+        return int(text, 0)
+    except ValueError:
+        return None
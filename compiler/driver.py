@@ -1,27 +1,414 @@
 import argparse
+import hashlib
+import io
+import re
+import sys
 from pathlib import Path
+from typing import AbstractSet, Dict, List, Optional, TextIO, Tuple
 from .lexer import Lexer
 from .parser import Parser
-from .sema import SemanticAnalyzer
+from .sema import SemanticAnalyzer, SemanticError
 from .codegen_8086 import CodeGen8086
+from .emitter import Fragment, LineMap
+from .assembler_8086 import assemble
+from .passes import DEFAULT_OPT_LEVEL, OPT_LEVELS, PassManager, passes_for
+from . import fold  # registers the constant-folding pass
+from .cache import CompileCache, DEFAULT_MAX_BYTES, cache_key, default_cache_dir, open_atomic, write_atomic
+from .incremental import find_fragments, store_fragments
+from .linker import LinkError, ObjectModule, dump_object, interface_digest, link, load_object
+from .pgo import Profile, ProfileError, ProfileMap
+from . import ast as A
+
+STD_DIR = Path(__file__).resolve().parent.parent / "std"
+
+
+# path -> (mtime, parsed functions); std modules are parsed once per process
+_std_modules: Dict[Path, Tuple[int, List[A.Function]]] = {}
+
+
+def std_functions(path: Path) -> List[A.Function]:
+    # The returned nodes are shared between compilations and never mutated
+    mtime = path.stat().st_mtime_ns
+    entry = _std_modules.get(path)
+    if entry is None or entry[0] != mtime:
+        tokens = Lexer(path.read_text(encoding="utf-8")).tokenize()
+        entry = _std_modules[path] = (mtime, Parser(tokens).parse().functions)
+    return entry[1]
+
+
+def with_std(program: A.Program, imported: AbstractSet[str] = frozenset()) -> A.Program:
+    # Append std/*.ql declarations the program doesn't define or import itself;
+    # externs only pull in their runtime file once something calls them
+    defined = {fn.name for fn in program.functions} | set(imported)
+    for path in sorted(STD_DIR.glob("*.ql")):
+        for fn in std_functions(path):
+            if fn.name not in defined:
+                defined.add(fn.name)
+                program.functions.append(fn)
+    return program
+
+
+# `import name;` lines, found without parsing to key the whole-program cache
+_IMPORT_RE = re.compile(rb"^[ \t]*import[ \t]+(\w+)[ \t]*;", re.MULTILINE)
+
+
+class ModuleLoader:
+    # Resolves `import name;` to name.ql, or a prebuilt name.qo object, in the
+    # importing file's directory and then std/, and compiles each module once.
+    # A name.qo next to name.ql is used while it matches the source.
+    def __init__(self, cache: Optional[CompileCache] = None, opt: str = DEFAULT_OPT_LEVEL):
+        self.cache = cache
+        self.opt = opt
+        self.modules: Dict[Path, ObjectModule] = {}
+        self._loading: List[Path] = []
+
+    def resolve(self, name: str, base_dir: Path) -> Path:
+        for d in (base_dir, STD_DIR):
+            for suffix in (".ql", ".qo"):
+                path = d / f"{name}{suffix}"
+                if path.is_file():
+                    return path.resolve()
+        raise SemanticError(f"Cannot find module '{name}' (looked in {base_dir} and {STD_DIR})")
+
+    def load(self, name: str, base_dir: Path) -> Tuple[Path, ObjectModule]:
+        path = self.resolve(name, base_dir)
+        if path in self.modules:
+            return path, self.modules[path]
+        if path in self._loading:
+            cycle = " -> ".join(p.stem for p in self._loading[self._loading.index(path):] + [path])
+            raise SemanticError(f"Import cycle: {cycle}")
+        self._loading.append(path)
+        try:
+            data = path.read_bytes()
+            if path.suffix == ".qo":
+                obj = load_object(data, str(path))
+            else:
+                obj = self._prebuilt(path, data) or self.compile_module(data, path)
+        finally:
+            self._loading.pop()
+        self.modules[path] = obj
+        return path, obj
+
+    def _prebuilt(self, path: Path, source: bytes) -> Optional[ObjectModule]:
+        qo = path.with_suffix(".qo")
+        if not qo.is_file():
+            return None
+        try:
+            obj = load_object(qo.read_bytes(), str(qo))
+        except (OSError, LinkError):
+            return None
+        return obj if obj.source_sha256 == hashlib.sha256(source).hexdigest() else None
+
+    def closure(self, names: List[str], base_dir: Path) -> List[ObjectModule]:
+        # Every module reachable through imports, each once, dependencies first
+        out: List[ObjectModule] = []
+        seen = set()
+        def visit(name: str, base: Path):
+            path, obj = self.load(name, base)
+            if path in seen:
+                return
+            seen.add(path)
+            for dep in obj.imports:
+                visit(dep, path.parent)
+            out.append(obj)
+        for name in names:
+            visit(name, base_dir)
+        return out
+
+    def compile_module(self, source: bytes, path: Path) -> ObjectModule:
+        program = Parser(Lexer(source.decode("utf-8")).tokenize()).parse()
+        deps = [self.load(name, path.parent)[1] for name in program.imports]
+        key = ""
+        if self.cache is not None:
+            key = cache_key(source, {"module": path.stem, "imports": [interface_digest(d) for d in deps],
+                                     "opt": self.opt})
+            data = self.cache.get(key, "obj")
+            if data is not None:
+                return load_object(data, str(path))
+        own = [fn.name for fn in program.functions]
+        imported = [sig for d in deps for sig in d.interface]
+        program = with_std(program, {sig.name for sig in imported})
+        sa = SemanticAnalyzer()
+        ctx = sa.collect_signatures(program, imported, require_main=False)
+        sa.analyze_bodies(program)
+        for p in passes_for("ast", self.opt):
+            program = p.fn(program, ctx)
+        cg = CodeGen8086(opt=self.opt)
+        cg.emit(program, ctx)
+        obj = ObjectModule(path.stem, hashlib.sha256(source).hexdigest(), program.imports,
+                           [ctx.functions[name] for name in own],
+                           {name: cg.fragments[name] for name in own if name in cg.fragments})
+        if self.cache is not None:
+            self.cache.put(key, "obj", dump_object(obj))
+        return obj
+
+
+def import_digest(source: bytes, path: str) -> str:
+    # Hash of every module `source` imports, directly or not, or "" if none
+    h = hashlib.sha256()
+    loader = ModuleLoader()
+    seen = set()
+    work = [(m.decode("ascii"), Path(path).parent) for m in _IMPORT_RE.findall(source)]
+    while work:
+        name, base = work.pop()
+        try:
+            dep = loader.resolve(name, base)
+        except SemanticError:
+            continue  # reported by the compilation itself
+        if dep in seen:
+            continue
+        seen.add(dep)
+        data = dep.read_bytes()
+        h.update(str(dep).encode("utf-8") + b"\0" + hashlib.sha256(data).digest())
+        if dep.suffix == ".ql":
+            work.extend((m.decode("ascii"), dep.parent) for m in _IMPORT_RE.findall(data))
+    return h.hexdigest() if seen else ""
+
+
+def compile_source(src_text: str, pm: Optional[PassManager] = None,
+                   cache: Optional[CompileCache] = None, jobs: int = 1,
+                   path: Optional[str] = None, instrument: Optional[ProfileMap] = None,
+                   profile: Optional[Profile] = None, line_map: Optional[LineMap] = None,
+                   opt: str = DEFAULT_OPT_LEVEL, out: Optional[TextIO] = None) -> str:
+    # With a cache, functions unchanged since an earlier compilation are neither
+    # analysed nor generated again (see incremental.py). `jobs` > 1 generates
+    # functions in that many worker processes. Imports are resolved relative
+    # to `path`. `instrument` and `profile` select profile-guided builds
+    # (see pgo.py), which always generate every function in-process. A
+    # `line_map` is filled in with the source line of each line of output.
+    # `opt` is the optimisation level (see passes.OPT_LEVELS). With `out`,
+    # the program is written there as it is generated and "" is returned:
+    # unless asm passes need the whole text, only one function's code is
+    # held in memory at a time.
+    if instrument is not None or profile is not None:
+        cache, jobs = None, 1
+    pm = pm or PassManager()
+    tokens = pm.run("lex", Lexer(src_text).tokenize)
+    program = pm.run("parse", Parser(tokens).parse)
+    own = {fn.name for fn in program.functions}
+    modules: List[ObjectModule] = []
+    imported = []
+    if program.imports:
+        loader = ModuleLoader(cache, opt)
+        base = Path(path).parent if path else Path.cwd()
+        modules = pm.run("imports", loader.closure, program.imports, base)
+        imported = [sig for name in program.imports for sig in loader.load(name, base)[1].interface]
+    program = with_std(program, {sig.name for sig in imported})
+    sa = SemanticAnalyzer()
+    ctx = pm.run("signatures", sa.collect_signatures, program, imported)
+    hashes: Dict[str, str] = {}
+    reuse: Dict[str, Fragment] = {}
+    if cache is not None:
+        hashes, reuse = pm.run("reuse", find_fragments, program, ctx, cache, opt)
+    pm.run("sema", sa.analyze_bodies, program, set(reuse))
+    for p in passes_for("ast", opt):
+        program = pm.run(p.name, p.fn, program, ctx)
+    cg = CodeGen8086(instrument, profile, opt)
+    cg.positioned = own
+    cg.em.line_map = line_map
+    asm_passes = passes_for("asm", opt)
+    stream = out is not None and not asm_passes
+    if stream:
+        cg.em.spool(out)
+        def release(name: str, frag: Fragment):
+            # Its code is in the output now; cache it, then let it go
+            if cache is not None and name not in reuse:
+                store_fragments({name: frag}, hashes, cache, opt)
+            frag.text, frag.lines = [], []
+        cg.on_fragment = release
+    if modules:
+        pm.run("codegen", cg.emit, program, ctx, reuse, jobs)
+        asm = pm.run("link", link, cg.em, {**reuse, **cg.fragments}, modules)
+    else:
+        asm = pm.run("codegen", cg.generate, program, ctx, reuse, jobs)
+    for p in asm_passes:
+        asm = pm.run(p.name, p.fn, asm)
+    if out is not None and not stream:
+        out.write(asm)
+        asm = ""
+    if cache is not None and not stream:
+        store_fragments(cg.fragments, hashes, cache, opt)
+    pm.finish()
+
+    pm.count("tokens", len(tokens))
+    pm.count("ast_nodes", sum(1 for _ in A.walk(program)))
+    pm.count("functions", sum(1 for fn in program.functions if not fn.extern))
+    pm.count("functions_reused", len(reuse))
+    pm.count("modules", len(modules))
+    pm.count("labels", cg.em.label_counter)
+    pm.count("instructions", cg.em.instruction_count())
+    pm.count("strings", len(cg.em.string_pool))
+    pm.count("frame_bytes_total", sum(cg.frame_sizes.values()))
+    pm.count("frame_bytes_max", max(cg.frame_sizes.values(), default=0))
+    return asm
+
+
+def build_output(source: bytes, path: str, kind: str, cache: Optional[CompileCache] = None,
+                 pm: Optional[PassManager] = None, reuse_output: bool = True,
+                 jobs: int = 1, instrument: Optional[ProfileMap] = None,
+                 profile: Optional[Profile] = None,
+                 line_map: Optional[LineMap] = None,
+                 opt: str = DEFAULT_OPT_LEVEL) -> Tuple[bytes, bool]:
+    # The "asm" or "com" artifact for `source`, and whether it came from the cache.
+    # Without `reuse_output` only per-function fragments are taken from the cache;
+    # filling in a `line_map` needs a compilation too.
+    key = _output_key(source, path, cache, line_map, opt)
+    reuse_output = reuse_output and line_map is None
+    if cache is not None and reuse_output:
+        data = cache.get(key, kind)
+        if data is not None:
+            return data, True
+    asm = cache.get(key, "asm") if cache is not None and reuse_output and kind == "com" else None
+    if asm is None:
+        asm = compile_source(source.decode("utf-8"), pm, cache, jobs, path, instrument, profile,
+                             line_map, opt).encode("utf-8")
+        if cache is not None:
+            cache.put(key, "asm", asm)
+    if kind == "asm":
+        return asm, False
+    image = assemble(asm.decode("utf-8"), path)
+    if cache is not None:
+        cache.put(key, "com", image)
+    return image, False
+
+
+def write_asm(source: bytes, path: str, out: Path, cache: Optional[CompileCache] = None,
+              pm: Optional[PassManager] = None, reuse_output: bool = True,
+              jobs: int = 1, instrument: Optional[ProfileMap] = None,
+              profile: Optional[Profile] = None, line_map: Optional[LineMap] = None,
+              opt: str = DEFAULT_OPT_LEVEL) -> bool:
+    # build_output's "asm" artifact, written to `out` atomically as it is
+    # generated rather than built up in memory; whether it came from the cache
+    key = _output_key(source, path, cache, line_map, opt)
+    reuse_output = reuse_output and line_map is None
+    with open_atomic(out) as f:
+        if cache is not None and reuse_output and cache.get_into(key, "asm", f):
+            return True
+        text = io.TextIOWrapper(f, encoding="utf-8", newline="")
+        compile_source(source.decode("utf-8"), pm, cache, jobs, path, instrument, profile,
+                       line_map, opt, text)
+        text.flush()
+        text.detach()
+    if cache is not None:
+        cache.put_file(key, "asm", out)
+    return False
+
+
+def _output_key(source: bytes, path: str, cache: Optional[CompileCache],
+                line_map: Optional[LineMap], opt: str) -> str:
+    # Imported modules are part of the program, so their contents key it too
+    if cache is None:
+        return ""
+    options: Dict[str, object] = {"opt": opt}
+    digest = import_digest(source, path)
+    if digest:
+        options["imports"] = digest
+    if line_map is not None and line_map.comments:
+        options["comments"] = True
+    return cache_key(source, options)
+
+
+def add_opt_argument(ap: argparse.ArgumentParser):
+    ap.add_argument("-O", dest="opt", choices=OPT_LEVELS, default=DEFAULT_OPT_LEVEL, metavar="LEVEL",
+                    help="Optimisation level: 0 fixed lowering, 1 balanced (default), "
+                         "2 fastest code, s smallest code")
+
+
+def add_cache_arguments(ap: argparse.ArgumentParser):
+    ap.add_argument("--cache-dir", type=Path, default=None,
+                    help="Compilation cache directory (default: $QUINC_CACHE_DIR or ~/.cache/quinc)")
+    ap.add_argument("--cache-max-mb", type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                    help="Cache size limit; least recently used entries are evicted")
+    ap.add_argument("--no-cache", action="store_true", help="Always compile from scratch")
+
+
+def cache_from_args(args: argparse.Namespace) -> Optional[CompileCache]:
+    if args.no_cache:
+        return None
+    return CompileCache(args.cache_dir or default_cache_dir(), args.cache_max_mb * 1024 * 1024)
 
 
 def main():
-    ap = argparse.ArgumentParser(description="QuinLang compiler")
+    if sys.argv[1:2] == ["build"]:
+        from .build import main as build_main
+        build_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["serve"]:
+        from .serve import main as serve_main
+        serve_main(sys.argv[2:])
+        return
+    ap = argparse.ArgumentParser(description="QuinLang compiler (`build` compiles many files at once, "
+                                             "`serve` runs a warm compile server)")
     ap.add_argument("source", type=Path, help="Source .ql file")
-    ap.add_argument("-o", "--out", type=Path, default=Path("build/out.asm"), help="Output .asm file")
+    ap.add_argument("-o", "--out", type=Path, default=Path("build/out.asm"),
+                    help="Output file: .asm text, a .COM image assembled in-process, "
+                         "or a .qo object for modules that others import")
+    ap.add_argument("--time-passes", action="store_true",
+                    help="Report wall time and tracemalloc peak per compiler pass")
+    ap.add_argument("--stats", action="store_true", help="Report compilation counters")
+    ap.add_argument("--stats-format", choices=("table", "json"), default="table",
+                    help="Format of --time-passes/--stats output (stderr)")
+    ap.add_argument("-j", "--jobs", type=int, default=1,
+                    help="Worker processes for function code generation (output is identical)")
+    pgo = ap.add_mutually_exclusive_group()
+    pgo.add_argument("--instrument", action="store_true",
+                     help="Count block executions into PGO.CNT; the counter map goes to OUT.pgomap")
+    pgo.add_argument("--profile-use", type=Path, metavar="PROFILE",
+                     help="Lay out code from a profile made by `python -m compiler.pgo`")
+    ap.add_argument("--line-map", action="store_true",
+                    help="Write the source line of each .asm line to OUT.lines, for hotspot attribution")
+    ap.add_argument("--asm-comments", action="store_true",
+                    help="Mark the code generated for each source line with a `; file:line` comment")
+    add_opt_argument(ap)
+    add_cache_arguments(ap)
     args = ap.parse_args()
 
-    src_text = args.source.read_text(encoding="utf-8")
-
-    tokens = Lexer(src_text).tokenize()
-    ast = Parser(tokens).parse()
-    ctx = SemanticAnalyzer().analyze(ast)
-    asm = CodeGen8086().generate(ast, ctx)
+    pm = PassManager(track_memory=args.time_passes)
+    # Instrumented runs always compile, so there is something to measure
+    instrumented = args.time_passes or args.stats
+    kind = args.out.suffix.lower().lstrip(".")
+    instrument = ProfileMap() if args.instrument else None
+    profile = None
+    if args.profile_use is not None:
+        try:
+            profile = Profile.loads(args.profile_use.read_text(encoding="utf-8"))
+        except (OSError, ProfileError) as e:
+            ap.error(f"--profile-use: {e}")
+    # Profile-guided builds depend on more than the source, so they bypass the cache
+    cache = None if instrument or profile else cache_from_args(args)
+    line_map = None
+    if args.line_map or args.asm_comments:
+        line_map = LineMap(args.source.name, comments=args.asm_comments)
+    if kind == "qo":
+        loader = ModuleLoader(cache, args.opt)
+        hit = False
+        write_atomic(args.out, dump_object(loader.compile_module(args.source.read_bytes(),
+                                                                 args.source.resolve())))
+    elif kind == "com":
+        # The assembler needs the whole program anyway
+        data, hit = build_output(args.source.read_bytes(), str(args.source), "com",
+                                 cache, pm, reuse_output=not instrumented, jobs=args.jobs,
+                                 instrument=instrument, profile=profile, line_map=line_map, opt=args.opt)
+        write_atomic(args.out, data)
+    else:
+        hit = write_asm(args.source.read_bytes(), str(args.source), args.out,
+                        cache, pm, reuse_output=not instrumented, jobs=args.jobs,
+                        instrument=instrument, profile=profile, line_map=line_map, opt=args.opt)
+    print(f"Wrote {args.out}" + (" (cached)" if hit else ""))
+    if instrument is not None:
+        write_atomic(args.out.with_suffix(".pgomap"), instrument.dumps().encode("utf-8"))
+        print(f"Wrote {args.out.with_suffix('.pgomap')} ({len(instrument.counters)} counters)")
+    if args.line_map and kind != "qo":
+        write_atomic(args.out.with_suffix(".lines"), line_map.dumps().encode("utf-8"))
+        print(f"Wrote {args.out.with_suffix('.lines')}")
 
-    args.out.parent.mkdir(parents=True, exist_ok=True)
-    args.out.write_text(asm, encoding="utf-8")
-    print(f"Wrote {args.out}")
+    if args.stats_format == "json" and (args.time_passes or args.stats):
+        print(pm.to_json(), file=sys.stderr)
+    else:
+        if args.time_passes:
+            print(pm.timing_table(), file=sys.stderr)
+        if args.stats:
+            print(pm.stats_table(), file=sys.stderr)
 
 
 if __name__ == "__main__":
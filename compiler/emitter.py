@@ -1,39 +1,268 @@
-from typing import List, Dict
+import hashlib
+import io
+import json
+import shutil
+import tempfile
+from dataclasses import dataclass, field
+from typing import List, Dict, Optional, TextIO, Tuple
+
+@dataclass
+class Fragment:
+    # Everything one function contributes to the output. A fragment only names
+    # its own local labels, content-addressed strings and per-function statics,
+    # so it can be cached and spliced into a later compilation unchanged.
+    text: List[str] = field(default_factory=list)
+    strings: List[str] = field(default_factory=list)
+    bss: List[str] = field(default_factory=list)
+    includes: List[str] = field(default_factory=list)
+    labels: int = 0
+    frame: int = 0  # bytes reserved below BP
+    calls: List[str] = field(default_factory=list)  # functions called, for the linker
+    # Source line of each text line, relative to the function's first line
+    # (-1 for none), so the fragment stays valid when the function moves
+    lines: List[int] = field(default_factory=list)
+
+LINE_MAP_VERSION = 1
+
+@dataclass
+class LineMap:
+    # Which .ql line each line of the rendered .asm was generated from, kept
+    # as runs: (first asm line, source line) wherever the source line changes.
+    # Source line 0 covers everything not generated from the program's own
+    # text: the header, runtime calls made by linked modules, data.
+    source: str = ""
+    rows: List[Tuple[int, int]] = field(default_factory=list)
+    comments: bool = False  # also mark each run in the .asm with `; file:line`
+
+    def source_line(self, asm_line: int) -> int:
+        lo, hi = 0, len(self.rows)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.rows[mid][0] <= asm_line:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.rows[lo - 1][1] if lo else 0
+
+    def dumps(self) -> str:
+        return json.dumps({"version": LINE_MAP_VERSION, "source": self.source,
+                           "rows": [list(r) for r in self.rows]})
+
+    @staticmethod
+    def loads(text: str) -> "LineMap":
+        d = json.loads(text)
+        if not isinstance(d, dict) or d.get("version") != LINE_MAP_VERSION:
+            raise ValueError(f"not a version {LINE_MAP_VERSION} line map")
+        return LineMap(d["source"], [(a, s) for a, s in d["rows"]])
 
 class Emitter:
     def __init__(self):
         self.text: List[str] = []
         self.data: List[str] = []
+        self.bss: List[str] = []
+        self.includes: List[str] = []
         self.string_pool: Dict[str, str] = {}
-        self.label_counter = 0
+        self.string_labels: Dict[str, str] = {}  # label -> string
+        self.label_counter = 0  # labels allocated over all functions
+        self.fragment: Optional[Fragment] = None  # function being emitted
+        self.fn_label_counter = 0
+        self.fn_text_start = 0
+        self.fn_bss_start = 0
+        self.fn_line = 0
+        self.line = 0  # source line of the code being emitted
+        self.lines: List[int] = []  # source line of each text line
+        self.line_map: Optional[LineMap] = None  # filled in by render() when set
+        # Streaming output (see spool): finished functions' text, data and
+        # bss wait in temporary files, and render() writes to `out`
+        self.out: Optional[TextIO] = None
+        self.spools: Optional[Tuple[TextIO, TextIO, TextIO]] = None
+        self.spooled_instructions = 0
+        self.spooled_bss = 0
+        # Text written so far: lines, the source line of the last, and the
+        # line-map runs as (line within .text, source line)
+        self.text_written = 0
+        self.text_line = 0
+        self.text_rows: List[Tuple[int, int]] = []
+
+    def begin_function(self, line: int = 0):
+        # Labels are numbered per function and emitted as NASM local labels
+        # (`.FOR1`), scoped to the function's own label
+        self.fragment = Fragment()
+        self.fn_label_counter = 0
+        self.fn_text_start = len(self.text)
+        self.fn_bss_start = len(self.bss)
+        self.fn_line = self.line = line
+
+    def end_function(self) -> Fragment:
+        frag = self.fragment
+        frag.text = self.text[self.fn_text_start:]
+        frag.lines = [n - self.fn_line if n else -1 for n in self.lines[self.fn_text_start:]]
+        frag.bss = self.bss[self.fn_bss_start:]
+        frag.labels = self.fn_label_counter
+        self.fragment = None
+        self.line = 0
+        if self.spools is not None:
+            self._flush()
+        return frag
+
+    def splice(self, frag: Fragment, line: int = 0):
+        # Add a previously emitted function's output, its first line now at
+        # `line` (0: positions unknown, as for functions of linked modules)
+        self.text.extend(frag.text)
+        if line and len(frag.lines) == len(frag.text):
+            self.lines.extend(line + n if n >= 0 else 0 for n in frag.lines)
+        else:
+            self.lines.extend([0] * len(frag.text))
+        self.bss.extend(frag.bss)
+        for s in frag.strings:
+            self.add_string(s)
+        for path in frag.includes:
+            self.add_include(path)
+        self.label_counter += frag.labels
+        if self.spools is not None and self.fragment is None:
+            self._flush()
 
     def unique_label(self, base: str = "L") -> str:
         self.label_counter += 1
-        return f"{base}{self.label_counter}"
+        self.fn_label_counter += 1
+        return f".{base}{self.fn_label_counter}"
 
     def emit(self, line: str):
         self.text.append(line)
+        self.lines.append(self.line)
 
     def label(self, name: str):
         self.text.append(f"{name}:")
+        self.lines.append(self.line)
+
+    def cut(self, start: int) -> Tuple[List[str], List[int]]:
+        # Remove and return the text from `start` on, with its source lines
+        cut = self.text[start:], self.lines[start:]
+        del self.text[start:], self.lines[start:]
+        return cut
+
+    def paste(self, text: List[str], lines: List[int]):
+        self.text.extend(text)
+        self.lines.extend(lines)
+
+    def instruction_count(self) -> int:
+        return self.spooled_instructions + _instructions(self.text)
 
     def add_string(self, s: str) -> str:
+        if self.fragment is not None and s not in self.fragment.strings:
+            self.fragment.strings.append(s)
         if s in self.string_pool:
             return self.string_pool[s]
-        label = f"STR_{len(self.string_pool)}"
+        # Named by content, so a function's code doesn't depend on which
+        # strings other functions used first
+        label = f"STR_{hashlib.sha1(s.encode('utf-8')).hexdigest()[:12]}"
+        while label in self.string_labels:
+            label += "_"
+        self.string_labels[label] = s
         # DOS function 09h expects '$' terminated strings
         escaped = s.replace('$', '$$')
         self.data.append(f"{label} db '{escaped}','$'")
         self.string_pool[s] = label
         return label
 
+    def add_call(self, name: str):
+        # A call to a user function, which the linker may have to resolve
+        if self.fragment is not None and name not in self.fragment.calls:
+            self.fragment.calls.append(name)
+
+    def add_include(self, path: str):
+        # Runtime file needed by the program beyond the core runtime.inc
+        if self.fragment is not None and path not in self.fragment.includes:
+            self.fragment.includes.append(path)
+        if path not in self.includes:
+            self.includes.append(path)
+
+    def add_bss(self, label: str, size: int):
+        # Uninitialised static storage; contents are undefined until written
+        self.bss.append(f"{label} resb {size}")
+
+    def spool(self, out: TextIO):
+        # Stream the program to `out`: from here on each function's output
+        # goes to temporary files once it is complete, so memory holds one
+        # function's code rather than the whole program, and render() writes
+        # to `out` (returning "") instead of building the text
+        self.out = out
+        self.spools = tuple(tempfile.TemporaryFile("w+", encoding="utf-8", newline="") for _ in range(3))
+        self._flush()
+
+    def _flush(self):
+        text, data, bss = self.spools
+        self._write_text(text, self.text, self.lines)
+        self.spooled_instructions += _instructions(self.text)
+        _write_lines(data, self.data)
+        _write_lines(bss, self.bss)
+        self.spooled_bss += len(self.bss)
+        del self.text[:], self.lines[:], self.data[:], self.bss[:]
+
+    def _write_text(self, out: TextIO, text: List[str], lines: List[int]):
+        if self.line_map is None:
+            _write_lines(out, text)
+            self.text_written += len(text)
+            return
+        source, comments = self.line_map.source, self.line_map.comments
+        for line_text, line in zip(text, lines):
+            if line != self.text_line:
+                self.text_line = line
+                self.text_rows.append((self.text_written, line))
+                if comments and line:
+                    out.write(f"\n; {source}:{line}")
+                    self.text_written += 1
+            out.write("\n")
+            out.write(line_text)
+            self.text_written += 1
+
     def render(self) -> str:
-        out: List[str] = []
-        out.append("; generated by QuinLang compiler")
-        out.append("org 0x100")
-        out.append("%include 'runtime/runtime.inc'")
-        out.append("section .text")
-        out.extend(self.text)
-        out.append("section .data")
-        out.extend(self.data)
-        return "\n".join(out)
+        if self.out is not None:
+            self.render_to(self.out)
+            return ""
+        out = io.StringIO()
+        self.render_to(out)
+        return out.getvalue()
+
+    def render_to(self, out: TextIO):
+        header = ["; generated by QuinLang compiler", "org 0x100", "%include 'runtime/runtime.inc'"]
+        header.extend(f"%include '{path}'" for path in self.includes)
+        header.append("section .text")
+        out.write("\n".join(header))
+        if self.spools is None:
+            self.text_written, self.text_line, self.text_rows = 0, 0, []
+            spools: Tuple[TextIO, ...] = ()
+        else:
+            spools = self.spools
+            self.spools = None
+            for f in spools:
+                f.seek(0)
+            shutil.copyfileobj(spools[0], out)
+        self._write_text(out, self.text, self.lines)
+        if self.line_map is not None:
+            rows = self.line_map.rows
+            rows.clear()
+            rows.append((1, 0))
+            rows.extend((len(header) + 1 + n, line) for n, line in self.text_rows)
+            if rows[-1][1] != 0:
+                rows.append((len(header) + 1 + self.text_written, 0))
+        out.write("\nsection .data")
+        if spools:
+            shutil.copyfileobj(spools[1], out)
+        _write_lines(out, self.data)
+        if self.bss or self.spooled_bss:
+            out.write("\nsection .bss")
+            if spools:
+                shutil.copyfileobj(spools[2], out)
+            _write_lines(out, self.bss)
+        for f in spools:
+            f.close()
+
+def _write_lines(out: TextIO, lines: List[str]):
+    # Lines are written after a newline: the output has no trailing one
+    if lines:
+        out.write("\n")
+        out.write("\n".join(lines))
+
+def _instructions(text: List[str]) -> int:
+    return sum(1 for line in text if not line.endswith(':') and not line.startswith('global '))
@@ -0,0 +1,75 @@
+from typing import Optional, Union
+from . import ast as A
+from .passes import register_pass
+from .sema import Context
+
+# Constant folding: operators whose operands are literals are evaluated at
+# compile time, with the 16-bit wraparound and truncating division of the
+# generated code. Folded comparisons and logic leave bool literals, which
+# branches test without code; `false && f()` folds to false, since f is never
+# called. Division by zero and -32768 / -1 are left to fault at run time.
+
+def wrap16(v: int) -> int:
+    return ((v + 0x8000) & 0xFFFF) - 0x8000
+
+def _int(e: A.Expr) -> Optional[int]:
+    if isinstance(e, A.Literal) and isinstance(e.value, int) and not isinstance(e.value, bool):
+        return wrap16(e.value)
+    return None
+
+def _bool(e: A.Expr) -> Optional[bool]:
+    if isinstance(e, A.Literal) and isinstance(e.value, bool):
+        return e.value
+    return None
+
+def fold_expr(e: A.Expr) -> Union[A.Expr, int, bool]:
+    # The value of `e` if its operands are constant, else `e` or the operand
+    # it reduces to
+    if isinstance(e, A.Unary):
+        if e.op == '-' and _int(e.right) is not None:
+            return wrap16(-_int(e.right))
+        if e.op == '!' and _bool(e.right) is not None:
+            return not _bool(e.right)
+        return e
+    if not isinstance(e, A.Binary):
+        return e
+    if e.op in ('&&', '||'):
+        # The left operand decides, or leaves the right one's value
+        short = e.op == '||'
+        left, right = _bool(e.left), _bool(e.right)
+        if left is not None:
+            return short if left == short else e.right
+        if right is not None and right != short:
+            return e.left
+        return e
+    a, b = _int(e.left), _int(e.right)
+    if a is None or b is None:
+        return e
+    if e.op == '+':
+        return wrap16(a + b)
+    if e.op == '-':
+        return wrap16(a - b)
+    if e.op == '*':
+        return wrap16(a * b)
+    if e.op == '/':
+        if b == 0 or (a == -0x8000 and b == -1):
+            return e
+        q = abs(a) // abs(b)
+        return q if (a < 0) == (b < 0) else -q
+    return {'==': a == b, '!=': a != b, '<': a < b, '<=': a <= b, '>': a > b, '>=': a >= b}[e.op]
+
+@register_pass("fold", "ast")
+def fold_constants(program: A.Program, ctx: Context) -> A.Program:
+    def visit(node: object, original: object) -> object:
+        if not isinstance(node, A.Expr):
+            return node
+        value = fold_expr(node)
+        if not isinstance(value, A.Expr):
+            value = A.Literal(value)
+            value.line, value.col = node.line, node.col
+        # Functions reused from the cache weren't analysed and have no types
+        t = ctx.node_type.get(id(original))
+        if t is not None and value is not original:
+            ctx.set_type(value, t)
+        return value
+    return A.transform(program, visit)
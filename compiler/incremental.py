@@ -0,0 +1,57 @@
+import hashlib
+import json
+import re
+from dataclasses import asdict
+from typing import Dict, Tuple
+from . import ast as A
+from .sema import Context
+from .emitter import Fragment
+from .cache import CompileCache, cache_key
+from .passes import DEFAULT_OPT_LEVEL
+
+# Per-function incremental recompilation. A function's generated code depends
+# only on its own AST, whether it is recursive and the signatures of the
+# functions it calls, so those are hashed and its emitted fragment is cached
+# under the hash. Recompiling a program then analyses and generates only the
+# functions whose hash changed; the others are spliced in from the cache.
+#
+# Source lines are recorded relative to the function's first line, so moving a
+# function keeps its fragment; its layout (the offsets of its statements) is
+# hashed, so the line map stays right when lines inside it are added or removed.
+
+# Callees are read off the repr, which is hashed anyway; walking the AST
+# again would cost more than the codegen it saves for small functions
+_CALLEE = re.compile(r"Call\(callee='(\w+)'")
+
+def function_hash(fn: A.Function, ctx: Context) -> str:
+    text = A.dump(fn)
+    h = hashlib.sha256(text.encode("utf-8"))
+    h.update(repr(fn.layout).encode("ascii"))
+    h.update(b"rec" if ctx.functions[fn.name].recursive else b"")
+    callees = sorted(set(_CALLEE.findall(text)))
+    for name in callees:
+        h.update(b"\0" + repr(ctx.functions.get(name)).encode("utf-8"))
+    return h.hexdigest()
+
+def _fragment_key(fn_hash: str, opt: str) -> str:
+    # Also covers the compiler fingerprint and codegen options
+    return cache_key(b"fn\0" + fn_hash.encode("ascii"), {"opt": opt})
+
+def find_fragments(program: A.Program, ctx: Context, cache: CompileCache,
+                   opt: str = DEFAULT_OPT_LEVEL) -> Tuple[Dict[str, str], Dict[str, Fragment]]:
+    # Hash of every function with a body, and the cached fragments among them
+    hashes: Dict[str, str] = {}
+    found: Dict[str, Fragment] = {}
+    for fn in program.functions:
+        if fn.extern:
+            continue
+        hashes[fn.name] = h = function_hash(fn, ctx)
+        data = cache.get(_fragment_key(h, opt), "fn")
+        if data is not None:
+            found[fn.name] = Fragment(**json.loads(data))
+    return hashes, found
+
+def store_fragments(fragments: Dict[str, Fragment], hashes: Dict[str, str], cache: CompileCache,
+                    opt: str = DEFAULT_OPT_LEVEL):
+    for name, frag in fragments.items():
+        cache.put(_fragment_key(hashes[name], opt), "fn", json.dumps(asdict(frag)).encode("utf-8"))
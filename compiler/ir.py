@@ -54,7 +54,7 @@ class IRBuilder:
             irf.instrs.append(Instr('STORE', st.name))
         elif isinstance(st, A.ExprStmt):
             irf.instrs.append(Instr('EVAL', st.expr))
-        elif isinstance(st, A.If) or isinstance(st, A.While):
+        elif isinstance(st, (A.If, A.While, A.For)):
             # Control flow omitted for brevity in this initial IR
             pass
         else:
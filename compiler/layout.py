@@ -1,54 +1,101 @@
-from dataclasses import dataclass
-from typing import Dict, List, Tuple
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
 from . import ast as A
-from .types import type_from_name, Int
+from .types import type_from_name, ArrayType, Int
+
+# Arrays larger than this many bytes get static storage instead of a frame slot,
+# unless the function is recursive: static arrays are shared between
+# activations, so only a function never re-entered can have them.
+STATIC_ARRAY_MIN = 256
 
 @dataclass
 class StackLayout:
     size: int
-    offsets: Dict[str, int]
+    offsets: Dict[str, int]  # parameter name -> offset
+    # Locals are keyed by the id of their VarDecl, as a block may declare a
+    # name again with another type; codegen binds names as it reaches them
+    slots: Dict[int, int] = field(default_factory=dict)
+    arrays: Dict[int, ArrayType] = field(default_factory=dict)
+    statics: Dict[int, str] = field(default_factory=dict)  # data label of a static array
+    array_names: Set[str] = field(default_factory=set)  # names any array is declared under
+    # id of each For -> offsets of its counter and of its end bound (None if
+    # constant). A counter is scoped to its loop, so these are the loop's own
+    # rather than looked up by name: it may share one with an outer variable.
+    loops: Dict[int, Tuple[int, Optional[int]]] = field(default_factory=dict)
 
     def offset_of(self, name: str) -> int:
         return self.offsets[name]
 
+def needs_end_slot(st: A.For) -> bool:
+    # Whether a `for` loop keeps its end bound in a hidden local
+    return not isinstance(st.end, A.Literal)
+
 class LayoutBuilder:
-    def build_for_function(self, fn: A.Function) -> StackLayout:
-        # Collect all local var decls (no shadowing handling for now)
-        names: List[Tuple[str, int]] = []  # (name, size)
-        seen: Dict[str, bool] = {}
-        def visit(st: A.Stmt):
+    def build_for_function(self, fn: A.Function, recursive: bool = False) -> StackLayout:
+        # Every declaration gets its own slot, even one shadowing another
+        names: List[Tuple[object, int]] = []  # (VarDecl, or (For, "var"/"end"), size)
+        arrays: Dict[int, ArrayType] = {}
+        statics: Dict[int, str] = {}
+        array_names: Set[str] = set()
+        def visit(st: A.Stmt) -> List[A.Stmt]:
+            # Allocates what `st` declares; returns the statements nested in it
             if isinstance(st, A.VarDecl):
-                if st.name not in seen:
-                    seen[st.name] = True
-                    t = type_from_name(st.type_name) if st.type_name else None
-                    if t is None and st.init is not None:
-                        # Fallback to 2-byte slot if unknown at layout time
-                        sz = 2
-                    else:
-                        sz = t.size if t is not None else 2
-                    # allocate at least 2 bytes for simplicity
-                    if sz == 1:
-                        sz = 2
-                    names.append((st.name, sz))
+                t = type_from_name(st.type_name) if st.type_name else None
+                if isinstance(t, ArrayType):
+                    arrays[id(st)] = t
+                    array_names.add(st.name)
+                    if t.size > STATIC_ARRAY_MIN and not recursive:
+                        label = base = f"ARR_{fn.name}_{st.name}"
+                        n = 1
+                        while label in statics.values():
+                            n += 1
+                            label = f"{base}_{n}"
+                        statics[id(st)] = label
+                        return []
+                if t is None and st.init is not None:
+                    # Fallback to 2-byte slot if unknown at layout time
+                    sz = 2
+                else:
+                    sz = t.size if t is not None else 2
+                # allocate at least 2 bytes for simplicity
+                if sz == 1:
+                    sz = 2
+                names.append((st, sz))
             elif isinstance(st, A.If):
-                for s in st.then_block:
-                    visit(s)
-                if st.else_block:
-                    for s in st.else_block:
-                        visit(s)
+                return st.then_block + (st.else_block or [])
             elif isinstance(st, A.While):
-                for s in st.body:
-                    visit(s)
+                return st.body
+            elif isinstance(st, A.For):
+                # Slot for the counter when it can't live in CX, plus one for a
+                # non-constant end bound, which is evaluated only once
+                names.append(((st, "var"), 2))
+                if needs_end_slot(st):
+                    names.append(((st, "end"), 2))
+                return st.body
             elif isinstance(st, A.Block):
-                for s in st.stmts:
-                    visit(s)
-        for st in fn.body:
-            visit(st)
-        # Assign offsets from BP downward
+                return st.stmts
+            return []
+        # Slots are allocated in source order; nested statements are visited
+        # from an explicit stack rather than by recursion
+        stack: List[A.Stmt] = list(reversed(fn.body))
+        while stack:
+            stack.extend(reversed(visit(stack.pop())))
+        # Parameters are pushed right to left above the return address: [bp+4], [bp+6], ...
         offsets: Dict[str, int] = {}
+        for i, p in enumerate(fn.params):
+            offsets[p.name] = -(4 + 2 * i)
+        # Assign locals offsets from BP downward
         offset = 0
-        for name, sz in names:
+        slots: Dict[int, int] = {}
+        loops: Dict[int, Tuple[int, Optional[int]]] = {}
+        for key, sz in names:
             offset += sz
-            offsets[name] = offset  # [bp - offset]
+            if isinstance(key, A.VarDecl):
+                slots[id(key)] = offset  # [bp - offset]; negative for parameters
+            elif key[1] == "var":
+                loops[id(key[0])] = (offset, None)
+            else:
+                loops[id(key[0])] = (loops[id(key[0])][0], offset)
         # Align to 2 bytes already enforced
-        return StackLayout(size=offset, offsets=offsets)
+        return StackLayout(size=offset, offsets=offsets, slots=slots, arrays=arrays, statics=statics,
+                           array_names=array_names, loops=loops)
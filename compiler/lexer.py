@@ -66,10 +66,14 @@ class Lexer:
             self._add_token(TokenType.LEFT_BRACE); return
         if c == '}':
             self._add_token(TokenType.RIGHT_BRACE); return
+        if c == '[':
+            self._add_token(TokenType.LEFT_BRACKET); return
+        if c == ']':
+            self._add_token(TokenType.RIGHT_BRACKET); return
         if c == ',':
             self._add_token(TokenType.COMMA); return
         if c == '.':
-            self._add_token(TokenType.DOT); return
+            self._add_token(TokenType.DOT_DOT if self._match('.') else TokenType.DOT); return
         if c == '-':
             self._add_token(TokenType.MINUS); return
         if c == '+':
@@ -95,6 +99,10 @@ class Lexer:
             self._add_token(TokenType.LESS_EQUAL if self._match('=') else TokenType.LESS); return
         if c == '>':
             self._add_token(TokenType.GREATER_EQUAL if self._match('=') else TokenType.GREATER); return
+        if c == '&' and self._match('&'):
+            self._add_token(TokenType.AMP_AMP); return
+        if c == '|' and self._match('|'):
+            self._add_token(TokenType.PIPE_PIPE); return
         if c == '"':
             self._string(); return
         if c.isdigit():
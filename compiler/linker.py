@@ -0,0 +1,99 @@
+import hashlib
+import json
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List
+from .emitter import Emitter, Fragment
+from .sema import FunctionSig
+from .types import type_from_name
+from .cache import compiler_fingerprint
+
+# Object modules and the link step. Compiling a module (a .ql file brought in
+# with `import name;`) produces an object: the interface of every function it
+# declares, as FunctionSigs, and the emitted fragment of every function it
+# defines. Importers only read the interface; the linker splices the fragments
+# of the functions a program can reach into its output, which also merges the
+# modules' string pools and runtime includes.
+
+OBJECT_FORMAT = "quinc-object"
+OBJECT_VERSION = 1
+
+class LinkError(Exception):
+    pass
+
+@dataclass
+class ObjectModule:
+    name: str
+    source_sha256: str
+    imports: List[str]
+    interface: List[FunctionSig]
+    fragments: Dict[str, Fragment]  # in source order
+
+def sig_to_json(sig: FunctionSig) -> Dict[str, Any]:
+    return {"name": sig.name, "params": [str(t) for t in sig.params], "ret": str(sig.ret),
+            "extern": sig.extern, "asm_source": sig.asm_source}
+
+def sig_from_json(d: Dict[str, Any]) -> FunctionSig:
+    return FunctionSig(d["name"], [type_from_name(t) for t in d["params"]], type_from_name(d["ret"]),
+                       d["extern"], d["asm_source"])
+
+def interface_digest(obj: ObjectModule) -> str:
+    # Changes exactly when code compiled against the module might
+    data = json.dumps([sig_to_json(s) for s in obj.interface], sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+def dump_object(obj: ObjectModule) -> bytes:
+    return json.dumps({
+        "format": OBJECT_FORMAT,
+        "version": OBJECT_VERSION,
+        "compiler": compiler_fingerprint(),
+        "module": obj.name,
+        "source_sha256": obj.source_sha256,
+        "imports": obj.imports,
+        "interface": [sig_to_json(s) for s in obj.interface],
+        "fragments": [dict(name=name, **asdict(frag)) for name, frag in obj.fragments.items()],
+    }).encode("utf-8")
+
+def load_object(data: bytes, origin: str) -> ObjectModule:
+    try:
+        d = json.loads(data)
+        if d.get("format") != OBJECT_FORMAT or d.get("version") != OBJECT_VERSION:
+            raise LinkError(f"{origin}: not a QuinLang object file")
+        # Fragments hold generated code, which is only compatible with the same compiler
+        if d.get("compiler") != compiler_fingerprint():
+            raise LinkError(f"{origin}: built by a different compiler version; rebuild it")
+        fragments: Dict[str, Fragment] = {}
+        for f in d["fragments"]:
+            f = dict(f)
+            name = f.pop("name")
+            fragments[name] = Fragment(**f)
+        return ObjectModule(d["module"], d["source_sha256"], list(d["imports"]),
+                            [sig_from_json(s) for s in d["interface"]], fragments)
+    except (ValueError, KeyError, TypeError) as e:
+        raise LinkError(f"{origin}: malformed object file ({e})")
+
+def link(em: Emitter, program: Dict[str, Fragment], modules: List[ObjectModule]) -> str:
+    # Add to `em`, which already holds the program's own functions (`program`),
+    # every module function reachable from them, and render the result
+    defined: Dict[str, ObjectModule] = {}
+    for obj in modules:
+        for name in obj.fragments:
+            if name in program:
+                raise LinkError(f"Function '{name}' is defined by the program and module '{obj.name}'")
+            if name in defined:
+                raise LinkError(f"Function '{name}' is defined by modules '{defined[name].name}' and '{obj.name}'")
+            defined[name] = obj
+    needed = set()
+    work = [call for frag in program.values() for call in frag.calls]
+    while work:
+        name = work.pop()
+        if name in program or name in needed:
+            continue
+        if name not in defined:
+            raise LinkError(f"Undefined function '{name}'")
+        needed.add(name)
+        work.extend(defined[name].fragments[name].calls)
+    for obj in modules:
+        for name, frag in obj.fragments.items():
+            if name in needed:
+                em.splice(frag)
+    return em.render()
@@ -1,20 +1,32 @@
-from typing import List, Optional
+from typing import List, Optional, Tuple, TypeVar, Union
 from .tokens import Token, TokenType
 from . import ast as A
 
 class ParseError(Exception):
     pass
 
+N = TypeVar("N", bound=A.Node)
+
 class Parser:
     def __init__(self, tokens: List[Token]):
         self.tokens = tokens
         self.current = 0
+        self.stmt_lines: List[int] = []  # lines of the statements of the current function
 
     def parse(self) -> A.Program:
         funcs: List[A.Function] = []
+        imports: List[str] = []
         while not self._is_at_end():
-            funcs.append(self._function())
-        return A.Program(funcs)
+            if self._match(TokenType.IMPORT):
+                name = self._consume(TokenType.IDENTIFIER, "Expected module name after 'import'").lexeme
+                self._consume(TokenType.SEMICOLON, "Expected ';' after import")
+                if name not in imports:
+                    imports.append(name)
+            elif self._match(TokenType.EXTERN):
+                funcs.append(self._extern())
+            else:
+                funcs.append(self._function())
+        return A.Program(funcs, imports)
 
     # Helpers
     def _match(self, *types: TokenType) -> bool:
@@ -27,7 +39,19 @@ class Parser:
     def _consume(self, type_: TokenType, msg: str) -> Token:
         if self._check(type_):
             return self._advance()
-        raise ParseError(msg)
+        raise self._error(msg)
+
+    def _error(self, msg: str) -> ParseError:
+        tok = self._peek()
+        return ParseError(f"{tok.line}:{tok.col}: {msg}")
+
+    def _at(self, node: N, tok: Token) -> N:
+        node.line, node.col = tok.line, tok.col
+        return node
+
+    def _at_node(self, node: N, other: A.Node) -> N:
+        node.line, node.col = other.line, other.col
+        return node
 
     def _check(self, type_: TokenType) -> bool:
         if self._is_at_end():
@@ -49,25 +73,45 @@ class Parser:
         return self.tokens[self.current - 1]
 
     # Grammar
+    def _extern(self) -> A.Function:
+        # extern ["runtime/file.asm"] fn name(params): ret;
+        start = self._previous()
+        asm_source: Optional[str] = None
+        if self._match(TokenType.STRING):
+            asm_source = self._previous().literal
+        fn = self._signature()
+        self._consume(TokenType.SEMICOLON, "Expected ';' after extern declaration")
+        fn.extern = True
+        fn.asm_source = asm_source
+        fn.end_line = self._previous().line
+        return self._at(fn, start)
+
     def _function(self) -> A.Function:
-        self._consume(TokenType.FN, "Expected 'fn' at function start")
+        fn = self._signature()
+        self.stmt_lines = []
+        fn.body = self._block()
+        fn.end_line = self._previous().line
+        fn.layout = tuple(line - fn.line for line in self.stmt_lines) + (fn.end_line - fn.line,)
+        return fn
+
+    def _signature(self) -> A.Function:
+        fn_tok = self._consume(TokenType.FN, "Expected 'fn' at function start")
         name_tok = self._consume(TokenType.IDENTIFIER, "Expected function name")
         self._consume(TokenType.LEFT_PAREN, "Expected '(' after function name")
         params: List[A.Param] = []
         if not self._check(TokenType.RIGHT_PAREN):
             while True:
-                p_name = self._consume(TokenType.IDENTIFIER, "Expected parameter name").lexeme
+                p_tok = self._consume(TokenType.IDENTIFIER, "Expected parameter name")
                 self._consume(TokenType.COLON, "Expected ':' after parameter name")
                 p_type = self._type_name()
-                params.append(A.Param(p_name, p_type))
+                params.append(self._at(A.Param(p_tok.lexeme, p_type), p_tok))
                 if not self._match(TokenType.COMMA):
                     break
         self._consume(TokenType.RIGHT_PAREN, "Expected ')' after parameters")
         ret_type: Optional[str] = None
         if self._match(TokenType.COLON):
             ret_type = self._type_name()
-        body = self._block()
-        return A.Function(name_tok.lexeme, params, ret_type, body)
+        return self._at(A.Function(name_tok.lexeme, params, ret_type, []), fn_tok)
 
     def _type_name(self) -> str:
         if self._match(TokenType.INT):
@@ -76,22 +120,56 @@ class Parser:
             return "str"
         if self._match(TokenType.VOID):
             return "void"
+        if self._match(TokenType.LEFT_BRACKET):
+            elem = self._type_name()
+            self._consume(TokenType.SEMICOLON, "Expected ';' in array type")
+            length = self._consume(TokenType.NUMBER, "Expected array length").literal
+            self._consume(TokenType.RIGHT_BRACKET, "Expected ']' after array length")
+            return f"[{elem}; {length}]"
         # allow identifiers for user-defined types in future
         tok = self._consume(TokenType.IDENTIFIER, "Expected type name")
         return tok.lexeme
 
     def _block(self) -> List[A.Stmt]:
+        # Statements nest through their blocks. Blocks still open are kept on
+        # an explicit stack, with the statement owning each, so nesting depth
+        # isn't limited by Python's recursion limit.
         self._consume(TokenType.LEFT_BRACE, "Expected '{' to start block")
         stmts: List[A.Stmt] = []
-        while not self._check(TokenType.RIGHT_BRACE):
-            stmts.append(self._declaration())
-        self._consume(TokenType.RIGHT_BRACE, "Expected '}' after block")
+        open_blocks: List[Tuple[Optional[A.Stmt], List[A.Stmt]]] = [(None, stmts)]
+        while open_blocks:
+            owner, block = open_blocks[-1]
+            if self._match(TokenType.RIGHT_BRACE):
+                open_blocks.pop()
+                if isinstance(owner, A.If) and block is owner.then_block and self._match(TokenType.ELSE):
+                    self._consume(TokenType.LEFT_BRACE, "Expected '{' to start block")
+                    owner.else_block = []
+                    open_blocks.append((owner, owner.else_block))
+                continue
+            if self._is_at_end():
+                raise self._error("Expected '}' after block")
+            st, body = self._declaration()
+            block.append(st)
+            if body is not None:
+                open_blocks.append((st, body))
         return stmts
 
-    def _declaration(self) -> A.Stmt:
+    def _declaration(self) -> Tuple[A.Stmt, Optional[List[A.Stmt]]]:
+        # A statement, and for if/while/for the (still empty) block it opened
+        tok = self._peek()
+        self.stmt_lines.append(tok.line)
         if self._match(TokenType.LET):
-            return self._var_decl()
-        return self._statement()
+            return self._at(self._var_decl(), tok), None
+        st = self._at(self._statement(), tok)
+        if isinstance(st, A.If):
+            return st, st.then_block
+        if isinstance(st, (A.While, A.For)):
+            return st, st.body
+        return st, None
+
+    def _open_block(self) -> List[A.Stmt]:
+        self._consume(TokenType.LEFT_BRACE, "Expected '{' to start block")
+        return []
 
     def _var_decl(self) -> A.VarDecl:
         name = self._consume(TokenType.IDENTIFIER, "Expected variable name").lexeme
@@ -121,17 +199,19 @@ class Parser:
             self._consume(TokenType.LEFT_PAREN, "Expected '(' after 'if'")
             cond = self._expression()
             self._consume(TokenType.RIGHT_PAREN, "Expected ')' after condition")
-            then_block = self._block()
-            else_block = None
-            if self._match(TokenType.ELSE):
-                else_block = self._block()
-            return A.If(cond, then_block, else_block)
+            return A.If(cond, self._open_block())
         if self._match(TokenType.WHILE):
             self._consume(TokenType.LEFT_PAREN, "Expected '(' after 'while'")
             cond = self._expression()
             self._consume(TokenType.RIGHT_PAREN, "Expected ')' after condition")
-            body = self._block()
-            return A.While(cond, body)
+            return A.While(cond, self._open_block())
+        if self._match(TokenType.FOR):
+            var = self._consume(TokenType.IDENTIFIER, "Expected loop variable after 'for'").lexeme
+            self._consume(TokenType.IN, "Expected 'in' after loop variable")
+            start = self._expression()
+            self._consume(TokenType.DOT_DOT, "Expected '..' in range")
+            end = self._expression()
+            return A.For(var, start, end, self._open_block())
         # assignment lookahead
         if self._check(TokenType.IDENTIFIER):
             # safe lookahead for '='
@@ -141,84 +221,106 @@ class Parser:
                 value = self._expression()
                 self._consume(TokenType.SEMICOLON, "Expected ';' after assignment")
                 return A.Assign(name, value)
-        # expression statement
+        # expression statement, or element assignment `a[i] = v;`
         expr = self._expression()
+        if isinstance(expr, A.Index) and self._match(TokenType.EQUAL):
+            value = self._expression()
+            self._consume(TokenType.SEMICOLON, "Expected ';' after assignment")
+            return A.IndexAssign(expr.name, expr.index, value)
         self._consume(TokenType.SEMICOLON, "Expected ';' after expression")
         return A.ExprStmt(expr)
 
     def _expression(self) -> A.Expr:
-        return self._assignment()
-
-    def _assignment(self) -> A.Expr:
-        # assignment handled at statement level for simplicity
-        return self._equality()
-
-    def _equality(self) -> A.Expr:
-        expr = self._comparison()
-        while self._match(TokenType.EQUAL_EQUAL, TokenType.BANG_EQUAL):
-            op = self._previous().lexeme
-            right = self._comparison()
-            expr = A.Binary(expr, op, right)
-        return expr
-
-    def _comparison(self) -> A.Expr:
-        expr = self._term()
-        while self._match(TokenType.GREATER, TokenType.GREATER_EQUAL, TokenType.LESS, TokenType.LESS_EQUAL):
-            op = self._previous().lexeme
-            right = self._term()
-            expr = A.Binary(expr, op, right)
-        return expr
-
-    def _term(self) -> A.Expr:
-        expr = self._factor()
-        while self._match(TokenType.PLUS, TokenType.MINUS):
-            op = self._previous().lexeme
-            right = self._factor()
-            expr = A.Binary(expr, op, right)
-        return expr
-
-    def _factor(self) -> A.Expr:
-        expr = self._unary()
-        while self._match(TokenType.STAR, TokenType.SLASH):
-            op = self._previous().lexeme
-            right = self._unary()
-            expr = A.Binary(expr, op, right)
-        return expr
-
-    def _unary(self) -> A.Expr:
-        if self._match(TokenType.BANG, TokenType.MINUS):
-            op = self._previous().lexeme
-            right = self._unary()
-            return A.Unary(op, right)
-        return self._call()
-
-    def _call(self) -> A.Expr:
-        expr = self._primary()
-        # Only support simple direct calls: IDENT '(' args? ')'
-        if isinstance(expr, A.Identifier) and self._match(TokenType.LEFT_PAREN):
-            args: List[A.Expr] = []
-            if not self._check(TokenType.RIGHT_PAREN):
-                while True:
-                    args.append(self._expression())
-                    if not self._match(TokenType.COMMA):
+        # Operator precedence parsing with explicit stacks: one frame per
+        # parenthesised expression, call argument or index still open
+        frames = [_ExprFrame()]
+        while True:
+            frame = frames[-1]
+            while self._match(TokenType.BANG, TokenType.MINUS):
+                frame.ops.append((self._previous(), UNARY_PRECEDENCE))
+            tok = self._peek()
+            if self._match(TokenType.LEFT_PAREN):
+                frames.append(_ExprFrame(tok, "paren"))
+                continue
+            if self._match(TokenType.FALSE):
+                operand: A.Expr = self._at(A.Literal(False), tok)
+            elif self._match(TokenType.TRUE):
+                operand = self._at(A.Literal(True), tok)
+            elif self._match(TokenType.NUMBER, TokenType.STRING):
+                operand = self._at(A.Literal(tok.literal), tok)
+            elif self._match(TokenType.IDENTIFIER):
+                operand = self._at(A.Identifier(tok.lexeme), tok)
+            else:
+                raise self._error("Expected expression")
+            # Operand in hand: apply postfix call/index syntax, continue with a
+            # binary operator, or close frames until one can
+            while True:
+                if isinstance(operand, A.Identifier) and self._match(TokenType.LEFT_PAREN):
+                    if not self._match(TokenType.RIGHT_PAREN):
+                        frames.append(_ExprFrame(operand, "call"))
                         break
-            self._consume(TokenType.RIGHT_PAREN, "Expected ')' after arguments")
-            return A.Call(expr.name, args)
-        return expr
-
-    def _primary(self) -> A.Expr:
-        if self._match(TokenType.FALSE):
-            return A.Literal(False)
-        if self._match(TokenType.TRUE):
-            return A.Literal(True)
-        if self._match(TokenType.NUMBER):
-            return A.Literal(self._previous().literal)
-        if self._match(TokenType.STRING):
-            return A.Literal(self._previous().literal)
-        if self._match(TokenType.IDENTIFIER):
-            return A.Identifier(self._previous().lexeme)
-        if self._match(TokenType.LEFT_PAREN):
-            expr = self._expression()
-            self._consume(TokenType.RIGHT_PAREN, "Expected ')' after expression")
-            return expr
-        raise ParseError("Expected expression")
\ No newline at end of file
+                    operand = self._at_node(A.Call(operand.name, []), operand)
+                elif isinstance(operand, A.Identifier) and self._match(TokenType.LEFT_BRACKET):
+                    frames.append(_ExprFrame(operand, "index"))
+                    break
+                frame = frames[-1]
+                frame.operands.append(operand)
+                prec = BINARY_PRECEDENCE.get(self._peek().type)
+                if prec is not None:
+                    frame.reduce(prec)
+                    frame.ops.append((self._advance(), prec))
+                    break
+                expr = frame.reduce(0)
+                if frame.kind == "call":
+                    frame.args.append(expr)
+                    if self._match(TokenType.COMMA):
+                        frame.operands.clear()
+                        break
+                    self._consume(TokenType.RIGHT_PAREN, "Expected ')' after arguments")
+                    operand = self._at_node(A.Call(frame.start.name, frame.args), frame.start)
+                elif frame.kind == "index":
+                    self._consume(TokenType.RIGHT_BRACKET, "Expected ']' after index")
+                    operand = self._at_node(A.Index(frame.start.name, expr), frame.start)
+                elif frame.kind == "paren":
+                    self._consume(TokenType.RIGHT_PAREN, "Expected ')' after expression")
+                    operand = expr
+                else:
+                    return expr
+                frames.pop()
+
+
+# Binding strength of the binary operators, all left associative; prefix
+# operators bind tighter than any of them
+BINARY_PRECEDENCE = {
+    TokenType.PIPE_PIPE: 1,
+    TokenType.AMP_AMP: 2,
+    TokenType.EQUAL_EQUAL: 3, TokenType.BANG_EQUAL: 3,
+    TokenType.GREATER: 4, TokenType.GREATER_EQUAL: 4, TokenType.LESS: 4, TokenType.LESS_EQUAL: 4,
+    TokenType.PLUS: 5, TokenType.MINUS: 5,
+    TokenType.STAR: 6, TokenType.SLASH: 6,
+}
+UNARY_PRECEDENCE = 7
+
+class _ExprFrame:
+    # An expression being parsed: operands and pending operators, and what
+    # opened it ("paren", "call" or "index", with its first token or callee)
+    def __init__(self, start: Optional[Union[Token, A.Identifier]] = None, kind: str = ""):
+        self.start = start
+        self.kind = kind
+        self.operands: List[A.Expr] = []
+        self.ops: List[Tuple[Token, int]] = []
+        self.args: List[A.Expr] = []
+
+    def reduce(self, prec: int) -> A.Expr:
+        # Apply pending operators binding at least as tightly as `prec`
+        ops, operands = self.ops, self.operands
+        while ops and ops[-1][1] >= prec:
+            op, op_prec = ops.pop()
+            right = operands.pop()
+            if op_prec == UNARY_PRECEDENCE:
+                node: A.Expr = A.Unary(op.lexeme, right)
+            else:
+                node = A.Binary(operands.pop(), op.lexeme, right)
+            node.line, node.col = op.line, op.col
+            operands.append(node)
+        return operands[-1]
@@ -0,0 +1,117 @@
+import json
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Pass manager: every compiler phase runs through `PassManager.run`, which
+# records its wall time and, when asked, the tracemalloc peak. Optimisation
+# passes registered with `register_pass` are run (and measured) automatically
+# by the driver at their stage, if the optimisation level includes them.
+
+# Stages a registered pass hooks into, and its signature there:
+#   "ast": fn(program, ctx) -> program, after semantic analysis
+#   "asm": fn(asm_text) -> asm_text, after code generation
+PASS_STAGES = ("ast", "asm")
+
+# Optimisation levels, `quinc -O0/-O1/-O2/-Os`. A level picks the registered
+# passes that run and what instruction selection minimises (see cost_8086.py);
+# -O0 runs no passes and keeps the fixed lowering of every construct.
+OPT_LEVELS = ("0", "1", "2", "s")
+DEFAULT_OPT_LEVEL = "1"
+
+@dataclass
+class RegisteredPass:
+    name: str
+    stage: str
+    fn: Callable[..., Any]
+    levels: Tuple[str, ...] = OPT_LEVELS[1:]
+
+REGISTERED_PASSES: List[RegisteredPass] = []
+
+def register_pass(name: str, stage: str, levels: Tuple[str, ...] = OPT_LEVELS[1:]):
+    # Decorator adding an optimisation pass to the pipelines of `levels`, in
+    # registration order
+    if stage not in PASS_STAGES:
+        raise ValueError(f"Unknown pass stage '{stage}'")
+    unknown = set(levels) - set(OPT_LEVELS)
+    if unknown:
+        raise ValueError(f"Unknown optimisation level(s) {sorted(unknown)}")
+    def deco(fn: Callable[..., Any]) -> Callable[..., Any]:
+        REGISTERED_PASSES.append(RegisteredPass(name, stage, fn, tuple(levels)))
+        return fn
+    return deco
+
+def passes_for(stage: str, level: str = DEFAULT_OPT_LEVEL) -> List[RegisteredPass]:
+    return [p for p in REGISTERED_PASSES if p.stage == stage and level in p.levels]
+
+class Cancelled(Exception):
+    # Raised by PassManager.run when the compilation is no longer wanted
+    pass
+
+@dataclass
+class PassTiming:
+    name: str
+    seconds: float
+    peak_bytes: Optional[int] = None  # tracemalloc peak while the pass ran
+
+@dataclass
+class PassManager:
+    track_memory: bool = False
+    timings: List[PassTiming] = field(default_factory=list)
+    stats: Dict[str, int] = field(default_factory=dict)
+    # Polled before each pass; a compilation is abandoned between passes
+    cancelled: Optional[Callable[[], bool]] = None
+    _tracing: bool = False
+
+    def run(self, name: str, fn: Callable[..., Any], *args: Any) -> Any:
+        if self.cancelled is not None and self.cancelled():
+            self.finish()
+            raise Cancelled(name)
+        if self.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if self.track_memory else None
+        self.timings.append(PassTiming(name, elapsed, peak))
+        return result
+
+    def finish(self):
+        # Stop tracing if this manager started it
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def count(self, key: str, value: int):
+        self.stats[key] = self.stats.get(key, 0) + value
+
+    def total_seconds(self) -> float:
+        return sum(t.seconds for t in self.timings)
+
+    def peak_bytes(self) -> Optional[int]:
+        peaks = [t.peak_bytes for t in self.timings if t.peak_bytes is not None]
+        return max(peaks) if peaks else None
+
+    def timing_table(self) -> str:
+        total = self.total_seconds() or 1e-12
+        out = [f"{'pass':<16}{'time (ms)':>12}{'%':>8}{'peak KiB':>12}"]
+        for t in self.timings:
+            peak = "-" if t.peak_bytes is None else str(t.peak_bytes // 1024)
+            out.append(f"{t.name:<16}{t.seconds * 1000:>12.3f}{100 * t.seconds / total:>7.1f}%{peak:>12}")
+        out.append(f"{'total':<16}{self.total_seconds() * 1000:>12.3f}")
+        return "\n".join(out)
+
+    def stats_table(self) -> str:
+        return "\n".join(f"{key:<24}{value:>12}" for key, value in self.stats.items())
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "passes": [{"name": t.name, "ms": round(t.seconds * 1000, 3),
+                        "peak_kib": None if t.peak_bytes is None else t.peak_bytes // 1024}
+                       for t in self.timings],
+            "stats": self.stats,
+        }, indent=2)
@@ -0,0 +1,118 @@
+import argparse
+import hashlib
+import json
+import struct
+import sys
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from . import ast as A
+
+# Profile-guided optimisation. An instrumented build (`quinc --instrument`)
+# counts executions of every basic block and call site in 32-bit counters, and
+# the program writes them to PGO.CNT when main returns. The counter layout is
+# written next to the output as a .pgomap; this module's CLI combines the two
+# into a profile, which `quinc --profile-use` reads back to lay out code.
+#
+# Counters are named per function by construct and ordinal ("if2.else",
+# "while1.body", "call3"), and each function's profile is tagged with a hash
+# of its AST: counts for a function edited since the training run are ignored.
+
+COUNTS_FILE = "PGO.CNT"
+PROFILE_VERSION = 1
+
+class ProfileError(Exception):
+    pass
+
+def source_hash(fn: A.Function) -> str:
+    return hashlib.sha256(A.dump(fn).encode("utf-8")).hexdigest()[:16]
+
+@dataclass
+class ProfileMap:
+    # Filled in by an instrumenting CodeGen8086
+    counters: List[Tuple[str, str]] = field(default_factory=list)  # index -> (function, block)
+    hashes: Dict[str, str] = field(default_factory=dict)
+
+    def add_function(self, fn: A.Function):
+        self.hashes[fn.name] = source_hash(fn)
+
+    def counter(self, fn_name: str, block: str) -> int:
+        self.counters.append((fn_name, block))
+        return len(self.counters) - 1
+
+    def dumps(self) -> str:
+        return json.dumps({"version": PROFILE_VERSION, "hashes": self.hashes,
+                           "counters": [list(c) for c in self.counters]}, indent=1)
+
+    @staticmethod
+    def loads(text: str) -> "ProfileMap":
+        d = _load_json(text, "profile map")
+        return ProfileMap([(fn, block) for fn, block in d["counters"]], dict(d["hashes"]))
+
+@dataclass
+class Profile:
+    counts: Dict[str, Dict[str, int]] = field(default_factory=dict)  # function -> block -> count
+    hashes: Dict[str, str] = field(default_factory=dict)
+
+    def counts_for(self, fn: A.Function) -> Optional[Dict[str, int]]:
+        # None when the function wasn't profiled or has changed since
+        if self.hashes.get(fn.name) != source_hash(fn):
+            return None
+        return self.counts.get(fn.name)
+
+    def add_run(self, pmap: ProfileMap, data: bytes):
+        # Accumulate one PGO.CNT dump taken from a build with layout `pmap`
+        if len(data) != 4 * len(pmap.counters):
+            raise ProfileError(f"counter dump has {len(data)} bytes, expected {4 * len(pmap.counters)}; "
+                               "was it written by this build?")
+        if self.hashes and self.hashes != pmap.hashes:
+            raise ProfileError("runs come from different builds")
+        self.hashes = dict(pmap.hashes)
+        for (fn, block), n in zip(pmap.counters, struct.unpack(f"<{len(pmap.counters)}I", data)):
+            blocks = self.counts.setdefault(fn, {})
+            blocks[block] = blocks.get(block, 0) + n
+
+    def hottest(self, top: int) -> List[Tuple[str, str, int]]:
+        rows = [(fn, block, n) for fn, blocks in self.counts.items() for block, n in blocks.items()]
+        return sorted(rows, key=lambda r: -r[2])[:top]
+
+    def dumps(self) -> str:
+        return json.dumps({"version": PROFILE_VERSION, "hashes": self.hashes, "counts": self.counts},
+                          indent=1, sort_keys=True)
+
+    @staticmethod
+    def loads(text: str) -> "Profile":
+        d = _load_json(text, "profile")
+        return Profile({fn: dict(blocks) for fn, blocks in d["counts"].items()}, dict(d["hashes"]))
+
+def _load_json(text: str, what: str) -> dict:
+    try:
+        d = json.loads(text)
+    except ValueError as e:
+        raise ProfileError(f"malformed {what}: {e}")
+    if not isinstance(d, dict) or d.get("version") != PROFILE_VERSION:
+        raise ProfileError(f"not a version {PROFILE_VERSION} {what}")
+    return d
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Turn PGO.CNT counter dumps into a profile for --profile-use")
+    ap.add_argument("map", type=Path, help=".pgomap written by the instrumented build")
+    ap.add_argument("counts", type=Path, nargs="+", help=f"{COUNTS_FILE} dumps from one or more runs")
+    ap.add_argument("-o", "--out", type=Path, required=True, help="Profile to write")
+    ap.add_argument("--top", type=int, default=10, help="Hottest blocks to list")
+    args = ap.parse_args(argv)
+    try:
+        pmap = ProfileMap.loads(args.map.read_text(encoding="utf-8"))
+        profile = Profile()
+        for path in args.counts:
+            profile.add_run(pmap, path.read_bytes())
+    except ProfileError as e:
+        sys.exit(f"error: {e}")
+    args.out.write_text(profile.dumps() + "\n", encoding="utf-8")
+    print(f"Wrote {args.out}")
+    for fn, block, n in profile.hottest(args.top):
+        print(f"{n:>12}  {fn}:{block}")
+
+
+if __name__ == "__main__":
+    main()
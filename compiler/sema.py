@@ -1,8 +1,9 @@
 from __future__ import annotations
 from dataclasses import dataclass
-from typing import Dict, List, Optional
+from typing import AbstractSet, Dict, Iterator, List, Optional, Sequence, Set, Tuple
 from . import ast as A
-from .types import Type, Int, Str, Void, Bool, type_from_name
+from .types import Type, ArrayType, Int, Str, Void, Bool, type_from_name
+from .builtins import get_builtins
 
 class SemanticError(Exception):
     pass
@@ -17,24 +18,71 @@ class FunctionSig:
     name: str
     params: List[Type]
     ret: Type
+    extern: bool = False
+    asm_source: Optional[str] = None  # runtime file defining an extern
+    # Whether the function can be called again while it runs. Only worked out
+    # for functions declaring arrays, the only code that depends on it.
+    recursive: bool = False
+
+# Extern routines take their arguments in registers, in this order
+EXTERN_ARG_REGS = ("ax", "bx", "cx", "dx")
+
+def extern_symbol(name: str) -> str:
+    # Assembly label implementing an extern function
+    return f"rt_{name}"
+
+def recursive_functions(program: A.Program, roots: Sequence[str]) -> Set[str]:
+    # Those of `roots` that can be called again while they run: a call in
+    # their body leads back to them. Imported modules can't call back into
+    # the program, since imports don't form cycles.
+    bodies = {fn.name: fn.body for fn in program.functions if not fn.extern}
+    calls: Dict[str, List[str]] = {}  # filled in as the search reaches functions
+    def callees(name: str) -> List[str]:
+        if name not in calls:
+            calls[name] = [n.callee for n in A.walk(bodies[name]) if isinstance(n, A.Call) and n.callee in bodies]
+        return calls[name]
+    found: Set[str] = set()
+    for root in roots:
+        seen: Set[str] = set()
+        work = list(callees(root))
+        while work:
+            name = work.pop()
+            if name == root:
+                found.add(root)
+                break
+            if name not in seen:
+                seen.add(name)
+                work.extend(callees(name))
+    return found
 
 class Scope:
+    # Block scopes of a function share one table of the innermost visible
+    # symbol per name, so lookups cost the same at any nesting depth. Scopes
+    # are strictly nested: a scope is closed before its parent continues.
     def __init__(self, parent: Optional[Scope] = None):
         self.parent = parent
         self.vars: Dict[str, Symbol] = {}
+        self.visible: Dict[str, Symbol] = parent.visible if parent is not None else {}
+        self.shadowed: List[Tuple[str, Optional[Symbol]]] = []
 
     def define(self, sym: Symbol):
         if sym.name in self.vars:
             raise SemanticError(f"Redeclaration of variable '{sym.name}'")
         self.vars[sym.name] = sym
+        self.shadowed.append((sym.name, self.visible.get(sym.name)))
+        self.visible[sym.name] = sym
 
     def resolve(self, name: str) -> Optional[Symbol]:
-        scope: Optional[Scope] = self
-        while scope is not None:
-            if name in scope.vars:
-                return scope.vars[name]
-            scope = scope.parent
-        return None
+        return self.visible.get(name)
+
+    def close(self):
+        # Make the enclosing scope's symbols visible again
+        for name, sym in reversed(self.shadowed):
+            if sym is None:
+                del self.visible[name]
+            else:
+                self.visible[name] = sym
+        self.shadowed.clear()
 
 class Context:
     def __init__(self):
@@ -52,18 +100,46 @@ class SemanticAnalyzer:
         self.ctx = Context()
 
     def analyze(self, program: A.Program) -> Context:
+        self.collect_signatures(program)
+        return self.analyze_bodies(program)
+
+    def collect_signatures(self, program: A.Program, imported: Sequence[FunctionSig] = (),
+                           require_main: bool = True) -> Context:
+        # Intrinsics are visible like ordinary functions and can't be redefined
+        for name, intr in get_builtins().items():
+            self.ctx.functions[name] = FunctionSig(name, list(intr.params), intr.ret)
+        # Interfaces of imported modules, defined elsewhere and linked in later
+        for sig in imported:
+            if sig.name in self.ctx.functions:
+                raise SemanticError(f"Redefinition of function '{sig.name}' by an imported module")
+            self.ctx.functions[sig.name] = sig
         # First pass: collect function signatures
         for fn in program.functions:
             param_types = [type_from_name(p.type_name) for p in fn.params]
             ret_type = type_from_name(fn.return_type) if fn.return_type else Void
+            if any(isinstance(t, ArrayType) for t in param_types + [ret_type]):
+                raise SemanticError(f"Function '{fn.name}' cannot take or return arrays")
             if fn.name in self.ctx.functions:
                 raise SemanticError(f"Redefinition of function '{fn.name}'")
-            self.ctx.functions[fn.name] = FunctionSig(fn.name, param_types, ret_type)
-        if 'main' not in self.ctx.functions:
+            if fn.extern and len(param_types) > len(EXTERN_ARG_REGS):
+                raise SemanticError(f"Extern function '{fn.name}' takes at most {len(EXTERN_ARG_REGS)} parameters")
+            self.ctx.functions[fn.name] = FunctionSig(fn.name, param_types, ret_type, fn.extern, fn.asm_source)
+        # Static storage for arrays needs functions that are never re-entered
+        holders = [fn.name for fn in program.functions if not fn.extern and any(
+            isinstance(st, A.VarDecl) and st.type_name is not None
+            and isinstance(type_from_name(st.type_name), ArrayType) for st in A.statements(fn.body))]
+        for name in recursive_functions(program, holders):
+            self.ctx.functions[name].recursive = True
+        if require_main and 'main' not in self.ctx.functions:
             raise SemanticError("Missing entry point 'main'")
-        # Second pass: analyze function bodies
+        return self.ctx
+
+    def analyze_bodies(self, program: A.Program, skip: AbstractSet[str] = frozenset()) -> Context:
+        # Second pass: analyze function bodies. Those in `skip` passed analysis in
+        # an earlier compilation and their code is being reused unchanged.
         for fn in program.functions:
-            self._analyze_function(fn)
+            if not fn.extern and fn.name not in skip:
+                self._analyze_function(fn)
         return self.ctx
 
     def _analyze_function(self, fn: A.Function):
@@ -71,16 +147,39 @@ class SemanticAnalyzer:
         scope = Scope()
         for p, t in zip(fn.params, sig.params):
             scope.define(Symbol(p.name, t))
-        saw_return = False
-        for st in fn.body:
-            self._analyze_stmt(st, scope)
-            if isinstance(st, A.Return):
-                saw_return = True
+        self._analyze_block(fn.body, scope)
         # For non-void functions, require at least one return
-        if sig.ret != Void and not saw_return:
+        if sig.ret != Void and not any(isinstance(st, A.Return) for st in fn.body):
             raise SemanticError(f"Function '{fn.name}' missing return statement")
 
-    def _analyze_stmt(self, st: A.Stmt, scope: Scope):
+    def _analyze_block(self, stmts: List[A.Stmt], scope: Scope):
+        # Nested blocks are walked with an explicit stack of the statements
+        # still to analyse, rather than by recursion, so any depth will do
+        open_blocks: List[Iterator[Tuple[A.Stmt, Scope]]] = [iter([(st, scope) for st in stmts])]
+        while open_blocks:
+            item = next(open_blocks[-1], None)
+            if item is None:
+                open_blocks.pop()
+                continue
+            inner = self._analyze_stmt(*item)
+            if inner:
+                open_blocks.append(self._in_scopes(inner, item[1]))
+
+    def _in_scopes(self, blocks: List[Tuple[List[A.Stmt], List[Symbol]]],
+                   parent: Scope) -> Iterator[Tuple[A.Stmt, Scope]]:
+        # The statements of each block with the scope to analyse them in; a
+        # block's scope is opened once the previous block's has closed
+        for stmts, symbols in blocks:
+            block_scope = Scope(parent)
+            for sym in symbols:
+                block_scope.define(sym)
+            for st in stmts:
+                yield st, block_scope
+            block_scope.close()
+
+    def _analyze_stmt(self, st: A.Stmt, scope: Scope) -> List[Tuple[List[A.Stmt], List[Symbol]]]:
+        # Checks `st` itself; returns its nested blocks with the symbols each
+        # block's scope starts with, for the caller to analyse
         if isinstance(st, A.VarDecl):
             var_type = type_from_name(st.type_name) if st.type_name else None
             if st.init is not None:
@@ -91,6 +190,12 @@ class SemanticAnalyzer:
                     raise SemanticError(f"Type mismatch in initializer for '{st.name}': {var_type} vs {init_t}")
             if var_type is None:
                 raise SemanticError(f"Cannot infer type for '{st.name}' without initializer")
+            if isinstance(var_type, ArrayType):
+                # Frame layout is computed from the declared type alone
+                if st.type_name is None:
+                    raise SemanticError(f"Array variable '{st.name}' needs an explicit type")
+                if var_type.elem not in (Int, Str, Bool) or var_type.length <= 0:
+                    raise SemanticError(f"Invalid array type {var_type}")
             scope.define(Symbol(st.name, var_type))
         elif isinstance(st, A.Assign):
             sym = scope.resolve(st.name)
@@ -99,6 +204,11 @@ class SemanticAnalyzer:
             val_t = self._analyze_expr(st.value, scope)
             if sym.type != val_t:
                 raise SemanticError(f"Cannot assign {val_t} to {sym.type} variable '{st.name}'")
+        elif isinstance(st, A.IndexAssign):
+            elem_t = self._analyze_index(st.name, st.index, scope)
+            val_t = self._analyze_expr(st.value, scope)
+            if val_t != elem_t:
+                raise SemanticError(f"Cannot assign {val_t} to element of '{st.name}'")
         elif isinstance(st, A.Print):
             val_t = self._analyze_expr(st.value, scope)
             if val_t not in (Int, Str):
@@ -109,35 +219,67 @@ class SemanticAnalyzer:
                 self._analyze_expr(st.value, scope)
         elif isinstance(st, A.If):
             self._analyze_expr(st.cond, scope)
-            then_scope = Scope(scope)
-            for s in st.then_block:
-                self._analyze_stmt(s, then_scope)
             if st.else_block:
-                else_scope = Scope(scope)
-                for s in st.else_block:
-                    self._analyze_stmt(s, else_scope)
+                return [(st.then_block, []), (st.else_block, [])]
+            return [(st.then_block, [])]
         elif isinstance(st, A.While):
             self._analyze_expr(st.cond, scope)
-            body_scope = Scope(scope)
-            for s in st.body:
-                self._analyze_stmt(s, body_scope)
+            return [(st.body, [])]
+        elif isinstance(st, A.For):
+            start_t = self._analyze_expr(st.start, scope)
+            end_t = self._analyze_expr(st.end, scope)
+            if start_t != Int or end_t != Int:
+                raise SemanticError("for range bounds must be int")
+            return [(st.body, [Symbol(st.var, Int)])]
         elif isinstance(st, A.ExprStmt):
             self._analyze_expr(st.expr, scope)
         else:
             # Ignore blocks etc.
             pass
+        return []
 
     def _analyze_expr(self, e: A.Expr, scope: Scope) -> Type:
+        # Post-order over the expression with an explicit stack: a node is
+        # typed once its operands have been, from the top of `types`
+        types: List[Type] = []
+        stack: List[Tuple[A.Expr, bool]] = [(e, False)]
+        while stack:
+            node, ready = stack.pop()
+            if ready:
+                types.append(self._combine(node, types))
+                continue
+            if isinstance(node, A.Unary):
+                stack += [(node, True), (node.right, False)]
+            elif isinstance(node, A.Binary):
+                stack += [(node, True), (node.right, False), (node.left, False)]
+            elif isinstance(node, A.Index):
+                # Typed now; the index is checked once it has been analysed
+                self.ctx.set_type(node, self._element_type(node.name, scope))
+                stack += [(node, True), (node.index, False)]
+            elif isinstance(node, A.Call):
+                if node.callee not in self.ctx.functions:
+                    raise SemanticError(f"Call to undeclared function '{node.callee}'")
+                sig = self.ctx.functions[node.callee]
+                if len(node.args) != len(sig.params):
+                    raise SemanticError(f"Function '{node.callee}' expects {len(sig.params)} args, got {len(node.args)}")
+                stack.append((node, True))
+                stack.extend((a, False) for a in reversed(node.args))
+            else:
+                types.append(self._leaf_type(node, scope))
+        return types[0]
+
+    def _leaf_type(self, e: A.Expr, scope: Scope) -> Type:
         if isinstance(e, A.Literal):
+            # bool is a subclass of int, so test it first
+            if isinstance(e.value, bool):
+                self.ctx.set_type(e, Bool)
+                return Bool
             if isinstance(e.value, int):
                 self.ctx.set_type(e, Int)
                 return Int
             if isinstance(e.value, str):
                 self.ctx.set_type(e, Str)
                 return Str
-            if isinstance(e.value, bool):
-                self.ctx.set_type(e, Bool)
-                return Bool
             self.ctx.set_type(e, Void)
             return Void
         if isinstance(e, A.Identifier):
@@ -146,8 +288,12 @@ class SemanticAnalyzer:
                 raise SemanticError(f"Undeclared variable '{e.name}'")
             self.ctx.set_type(e, sym.type)
             return sym.type
+        raise SemanticError("Unhandled expression type")
+
+    def _combine(self, e: A.Expr, types: List[Type]) -> Type:
+        # Type of an operator, index or call node; pops its operands' types
         if isinstance(e, A.Unary):
-            t = self._analyze_expr(e.right, scope)
+            t = types.pop()
             if e.op == '-' and t == Int:
                 self.ctx.set_type(e, Int)
                 return Int
@@ -156,29 +302,49 @@ class SemanticAnalyzer:
                 return Bool
             raise SemanticError(f"Invalid unary op {e.op} for type {t}")
         if isinstance(e, A.Binary):
-            lt = self._analyze_expr(e.left, scope)
-            rt = self._analyze_expr(e.right, scope)
+            rt = types.pop()
+            lt = types.pop()
             if e.op in ('+', '-', '*', '/'):
                 if lt == Int and rt == Int:
                     self.ctx.set_type(e, Int)
                     return Int
                 raise SemanticError("Arithmetic operators require int operands")
             if e.op in ('==', '!=', '<', '<=', '>', '>='):
+                if isinstance(lt, ArrayType):
+                    raise SemanticError("Arrays cannot be compared")
                 if lt == rt:
                     self.ctx.set_type(e, Bool)
                     return Bool
                 raise SemanticError("Comparison requires operands of same type")
+            if e.op in ('&&', '||'):
+                if lt == Bool and rt == Bool:
+                    self.ctx.set_type(e, Bool)
+                    return Bool
+                raise SemanticError(f"Logical operator {e.op} requires bool operands")
             raise SemanticError(f"Unknown operator {e.op}")
-        if isinstance(e, A.Call):
-            if e.callee not in self.ctx.functions:
-                raise SemanticError(f"Call to undeclared function '{e.callee}'")
-            sig = self.ctx.functions[e.callee]
-            if len(e.args) != len(sig.params):
-                raise SemanticError(f"Function '{e.callee}' expects {len(sig.params)} args, got {len(e.args)}")
-            for a, pt in zip(e.args, sig.params):
-                at = self._analyze_expr(a, scope)
-                if at != pt:
-                    raise SemanticError(f"Argument type mismatch: expected {pt}, got {at}")
-            self.ctx.set_type(e, sig.ret)
-            return sig.ret
-        raise SemanticError("Unhandled expression type")
\ No newline at end of file
+        if isinstance(e, A.Index):
+            if types.pop() != Int:
+                raise SemanticError("Array index must be int")
+            return self.ctx.get_type(e)
+        sig = self.ctx.functions[e.callee]
+        arg_types = types[len(types) - len(e.args):]
+        del types[len(types) - len(e.args):]
+        for at, pt in zip(arg_types, sig.params):
+            if at != pt:
+                raise SemanticError(f"Argument type mismatch: expected {pt}, got {at}")
+        self.ctx.set_type(e, sig.ret)
+        return sig.ret
+
+    def _analyze_index(self, name: str, index: A.Expr, scope: Scope) -> Type:
+        elem_t = self._element_type(name, scope)
+        if self._analyze_expr(index, scope) != Int:
+            raise SemanticError("Array index must be int")
+        return elem_t
+
+    def _element_type(self, name: str, scope: Scope) -> Type:
+        sym = scope.resolve(name)
+        if sym is None:
+            raise SemanticError(f"Undeclared variable '{name}'")
+        if not isinstance(sym.type, ArrayType):
+            raise SemanticError(f"Cannot index non-array variable '{name}'")
+        return sym.type.elem
@@ -0,0 +1,262 @@
+import argparse
+import base64
+import json
+import queue
+import socket
+import sys
+import threading
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, Optional
+
+from .parser import ParseError
+from .sema import SemanticError
+from .assembler_8086 import AsmError
+from .linker import LinkError
+from .cache import DEFAULT_MAX_BYTES, MemoryCache
+from .driver import build_output
+from .passes import Cancelled, DEFAULT_OPT_LEVEL, OPT_LEVELS, PassManager
+
+# Warm compile server: `quinc serve` answers JSON-RPC 2.0 requests, one JSON
+# object per line, on stdin/stdout or a Unix socket. The compiler modules, the
+# parsed std library and an in-memory cache of outputs and function fragments
+# stay loaded between requests, so a small file compiles in milliseconds.
+#
+#   {"jsonrpc": "2.0", "id": 1, "method": "compile",
+#    "params": {"path": "a.ql", "source": "fn main() {}", "format": "asm", "opt": "2", "stats": true}}
+#
+# compile   params: path, source (read from path if omitted), format "asm" or
+#           "com" (base64), opt (optimisation level, default "1"), stats. Result: ok, diagnostics, asm or com, cached,
+#           and with stats the pass timings and counters. A compile request
+#           supersedes earlier ones for the same path on its connection: those
+#           still queued or running are answered with a RequestCancelled error.
+# cancel    params: id. Cancels that request if it hasn't finished.
+# status    Result: requests served and cache statistics.
+# shutdown  Stops the server once queued requests are answered.
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+REQUEST_CANCELLED = -32800  # as in the Language Server Protocol
+
+class Connection:
+    def __init__(self, reader: BinaryIO, writer: BinaryIO):
+        self.reader = reader
+        self.writer = writer
+        self.lock = threading.Lock()
+        self.pending: Dict[Any, "Request"] = {}  # id -> unanswered request
+        self.latest: Dict[str, "Request"] = {}  # path -> newest compile request
+
+    def send(self, msg: Dict[str, Any]):
+        line = json.dumps(msg).encode("utf-8") + b"\n"
+        with self.lock:
+            try:
+                self.writer.write(line)
+                self.writer.flush()
+            except (OSError, ValueError):
+                # Client went away; its remaining answers are dropped
+                pass
+
+@dataclass
+class Request:
+    id: Any
+    method: str
+    params: Dict[str, Any]
+    conn: Connection
+    cancelled: threading.Event = field(default_factory=threading.Event)
+
+def _error(id_: Any, code: int, message: str) -> Dict[str, Any]:
+    return {"jsonrpc": "2.0", "id": id_, "error": {"code": code, "message": message}}
+
+def _result(id_: Any, result: Any) -> Dict[str, Any]:
+    return {"jsonrpc": "2.0", "id": id_, "result": result}
+
+class CompileServer:
+    def __init__(self, cache_max_bytes: int = DEFAULT_MAX_BYTES // 4):
+        self.cache = MemoryCache(cache_max_bytes)
+        self.queue: "queue.Queue[Optional[Request]]" = queue.Queue()
+        self.served = 0
+        self.stopping = threading.Event()
+
+    def compile(self, params: Dict[str, Any], cancelled) -> Dict[str, Any]:
+        path = params.get("path") or "<input>"
+        source = params.get("source")
+        fmt = params.get("format", "asm")
+        if fmt not in ("asm", "com"):
+            raise ValueError(f"unknown format '{fmt}'")
+        opt = params.get("opt", DEFAULT_OPT_LEVEL)
+        if opt not in OPT_LEVELS:
+            raise ValueError(f"unknown optimisation level '{opt}'")
+        if source is None:
+            if "path" not in params:
+                raise ValueError("compile needs 'source' or 'path'")
+            data = Path(path).read_bytes()
+        else:
+            data = str(source).encode("utf-8")
+        stats = bool(params.get("stats"))
+        pm = PassManager(cancelled=cancelled)
+        result: Dict[str, Any] = {"ok": False, "diagnostics": []}
+        try:
+            # Stats need a real compilation, but fragments are still reused
+            out, result["cached"] = build_output(data, path, fmt, self.cache, pm, reuse_output=not stats,
+                                                 opt=opt)
+        except (ParseError, SemanticError, AsmError, LinkError) as e:
+            kind = {ParseError: "parse", SemanticError: "semantic", AsmError: "assembler",
+                    LinkError: "link"}[type(e)]
+            result["diagnostics"].append({"severity": "error", "kind": kind, "message": str(e)})
+            return result
+        except RecursionError:
+            result["diagnostics"].append({"severity": "error", "kind": "limit",
+                                          "message": "program nested too deeply to compile"})
+            return result
+        result["ok"] = True
+        if fmt == "asm":
+            result["asm"] = out.decode("utf-8")
+        else:
+            result["com"] = base64.b64encode(out).decode("ascii")
+        if stats:
+            result["stats"] = dict(pm.stats)
+            result["passes"] = [{"name": t.name, "ms": round(t.seconds * 1000, 3)} for t in pm.timings]
+        return result
+
+    def status(self) -> Dict[str, Any]:
+        return {"served": self.served, "queued": self.queue.qsize(),
+                "cache_entries": len(self.cache), "cache": asdict(self.cache.stats)}
+
+    def work(self):
+        # The single compile thread; compilation is CPU-bound, so more threads
+        # would only contend for the interpreter lock
+        while True:
+            req = self.queue.get()
+            if req is None:
+                return
+            conn = req.conn
+            try:
+                if req.cancelled.is_set():
+                    raise Cancelled(req.method)
+                if req.method == "compile":
+                    resp = _result(req.id, self.compile(req.params, req.cancelled.is_set))
+                else:
+                    resp = _result(req.id, self.status())
+            except Cancelled:
+                resp = _error(req.id, REQUEST_CANCELLED, "request cancelled")
+            except (OSError, ValueError, TypeError) as e:
+                resp = _error(req.id, INVALID_PARAMS, str(e))
+            except Exception as e:
+                resp = _result(req.id, {"ok": False, "diagnostics": [{
+                    "severity": "error", "kind": "internal",
+                    "message": f"internal compiler error: {type(e).__name__}: {e}"}]})
+            with conn.lock:
+                conn.pending.pop(req.id, None)
+                path = req.params.get("path")
+                if conn.latest.get(path) is req:
+                    del conn.latest[path]
+            self.served += 1
+            conn.send(resp)
+
+    def submit(self, conn: Connection, msg: Any):
+        if not isinstance(msg, dict) or not isinstance(msg.get("method"), str):
+            conn.send(_error(None, INVALID_REQUEST, "expected a JSON-RPC request object"))
+            return
+        id_, method = msg.get("id"), msg["method"]
+        params = msg.get("params") or {}
+        if not isinstance(params, dict):
+            conn.send(_error(id_, INVALID_PARAMS, "params must be an object"))
+            return
+        if method == "cancel":
+            with conn.lock:
+                target = conn.pending.get(params.get("id"))
+            if target is not None:
+                target.cancelled.set()
+            if id_ is not None:
+                conn.send(_result(id_, target is not None))
+        elif method == "shutdown":
+            self.stopping.set()
+            self.queue.put(None)
+            if id_ is not None:
+                conn.send(_result(id_, None))
+        elif method in ("compile", "status"):
+            req = Request(id_, method, params, conn)
+            with conn.lock:
+                conn.pending[id_] = req
+                if method == "compile" and params.get("path"):
+                    older = conn.latest.get(params["path"])
+                    if older is not None:
+                        older.cancelled.set()
+                    conn.latest[params["path"]] = req
+            self.queue.put(req)
+        else:
+            conn.send(_error(id_, METHOD_NOT_FOUND, f"unknown method '{method}'"))
+
+    def serve_connection(self, conn: Connection):
+        for line in conn.reader:
+            if self.stopping.is_set():
+                break
+            if not line.strip():
+                continue
+            try:
+                msg = json.loads(line)
+            except ValueError as e:
+                conn.send(_error(None, PARSE_ERROR, f"invalid JSON: {e}"))
+                continue
+            self.submit(conn, msg)
+            if self.stopping.is_set():
+                # Shut down: stop reading rather than wait for more input,
+                # and let the worker answer what is already queued
+                return
+
+def serve_stdio(server: CompileServer):
+    worker = threading.Thread(target=server.work, daemon=True)
+    worker.start()
+    server.serve_connection(Connection(sys.stdin.buffer, sys.stdout.buffer))
+    # End of input or shutdown: answer what is queued, then exit
+    server.queue.put(None)
+    worker.join()
+
+def serve_socket(server: CompileServer, path: Path):
+    if path.exists():
+        path.unlink()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(path))
+    listener.listen()
+    listener.settimeout(0.2)
+    worker = threading.Thread(target=server.work, daemon=True)
+    worker.start()
+    print(f"quinc serve: listening on {path}", file=sys.stderr)
+
+    def handle(sock: socket.socket):
+        with sock, sock.makefile("rb") as r, sock.makefile("wb") as w:
+            server.serve_connection(Connection(r, w))
+
+    try:
+        while not server.stopping.is_set():
+            try:
+                sock, _ = listener.accept()
+            except socket.timeout:
+                continue
+            sock.settimeout(None)
+            threading.Thread(target=handle, args=(sock,), daemon=True).start()
+        worker.join()
+    finally:
+        listener.close()
+        path.unlink(missing_ok=True)
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(prog="quinc serve",
+                                 description="Answer JSON-RPC compile requests from a warm compiler")
+    ap.add_argument("--socket", type=Path, help="Listen on this Unix socket instead of stdin/stdout")
+    ap.add_argument("--cache-max-mb", type=int, default=DEFAULT_MAX_BYTES // (4 * 1024 * 1024),
+                    help="In-memory cache size limit")
+    args = ap.parse_args(argv)
+    server = CompileServer(args.cache_max_mb * 1024 * 1024)
+    if args.socket is None:
+        serve_stdio(server)
+    elif not hasattr(socket, "AF_UNIX"):
+        ap.error("Unix sockets are not available on this platform")
+    else:
+        serve_socket(server, args.socket)
+
+
+if __name__ == "__main__":
+    main()
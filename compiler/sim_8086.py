@@ -0,0 +1,1032 @@
+from __future__ import annotations
+import argparse
+import bisect
+import sys
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Cycle-counting 8086 simulator for the .COM images produced by quinc. The image
+# is loaded at 0x100 behind a minimal PSP, and the DOS services the runtime uses
+# (int 21h AH=02h/09h/3Ch/3Eh/40h/4Ch, int 20h) are emulated with captured
+# output; files a program creates are kept in memory and returned with the run.
+#
+# Cycle counts come from the Intel 8086 instruction timing tables: base cost
+# plus effective-address calculation, +4 per word access at an odd address.
+# The prefetch queue and wait states are not modelled, and data-dependent
+# mul/div timings use the midpoint of their documented range, so totals are
+# estimates -- but deterministic ones, which is what comparing two builds needs.
+#
+# All segment registers are tracked but addressing uses a single 64 KiB
+# segment: every .COM program built here runs with DS = ES = SS = CS.
+
+COM_ORIGIN = 0x100
+LOAD_SEGMENT = 0x1000
+DEFAULT_MAX_STEPS = 100_000_000
+
+class SimError(Exception):
+    pass
+
+# Effective-address cycles per r/m field without displacement; +4 with one
+EA_CYCLES = (7, 8, 8, 7, 5, 5, 5, 5)
+
+# (register operand, memory operand excluding EA) for F6/F7 mul/imul/div/idiv
+MULDIV_CYCLES = {
+    (4, 0): 73, (5, 0): 89, (6, 0): 85, (7, 0): 106,
+    (4, 1): 125, (5, 1): 141, (6, 1): 153, (7, 1): 174,
+}
+MULDIV_MEM_EXTRA = 6
+
+# String instructions: (single execution, per repetition under rep); rep adds 9
+STRING_CYCLES = {
+    0xA4: (18, 17), 0xA5: (18, 17), 0xA6: (22, 22), 0xA7: (22, 22),
+    0xAA: (11, 10), 0xAB: (11, 10), 0xAC: (12, 13), 0xAD: (12, 13),
+    0xAE: (15, 15), 0xAF: (15, 15),
+}
+REP_BASE_CYCLES = 9
+
+# loopne, loope, loop, jcxz: (taken, not taken)
+LOOP_CYCLES = {0xE0: (19, 5), 0xE1: (18, 6), 0xE2: (17, 5), 0xE3: (18, 6)}
+
+@dataclass
+class LabelProfile:
+    name: str
+    instructions: int = 0
+    cycles: int = 0
+
+@dataclass
+class FunctionProfile:
+    name: str
+    calls: int = 0
+    self_cycles: int = 0
+    total_cycles: int = 0
+
+@dataclass
+class LineProfile:
+    line: int  # in the program's .ql source
+    instructions: int = 0
+    cycles: int = 0
+
+@dataclass
+class RunResult:
+    exit_code: int
+    stdout: bytes
+    stderr: bytes
+    instructions: int
+    cycles: int
+    labels: Dict[str, LabelProfile] = field(default_factory=dict)
+    functions: Dict[str, FunctionProfile] = field(default_factory=dict)
+    files: Dict[str, bytes] = field(default_factory=dict)  # created with int 21h/3Ch
+    lines: Dict[int, LineProfile] = field(default_factory=dict)  # with a line map only
+
+    def report(self, top: int = 10) -> str:
+        out = [f"exit code {self.exit_code}: {self.instructions} instructions, {self.cycles} cycles"]
+        total = self.cycles or 1
+        funcs = sorted(self.functions.values(), key=lambda f: -f.self_cycles)[:top]
+        if funcs:
+            out.append("")
+            out.append(f"{'function':<24}{'calls':>8}{'self':>12}{'%':>7}{'total':>12}")
+            for f in funcs:
+                out.append(f"{f.name:<24}{f.calls:>8}{f.self_cycles:>12}"
+                           f"{100 * f.self_cycles / total:>6.1f}%{f.total_cycles:>12}")
+        labels = sorted(self.labels.values(), key=lambda p: -p.cycles)[:top]
+        if labels:
+            out.append("")
+            out.append(f"{'label':<24}{'insns':>10}{'cycles':>12}{'%':>7}")
+            for p in labels:
+                out.append(f"{p.name:<24}{p.instructions:>10}{p.cycles:>12}{100 * p.cycles / total:>6.1f}%")
+        lines = sorted(self.lines.values(), key=lambda p: -p.cycles)[:top]
+        if lines:
+            out.append("")
+            out.append(f"{'line':<24}{'insns':>10}{'cycles':>12}{'%':>7}")
+            for p in lines:
+                name = str(p.line) if p.line else "<runtime>"
+                out.append(f"{name:<24}{p.instructions:>10}{p.cycles:>12}{100 * p.cycles / total:>6.1f}%")
+        return "\n".join(out)
+
+class Sim8086:
+    def __init__(self, image: bytes, symbols: Optional[Dict[str, int]] = None,
+                 lines: Optional[Dict[int, int]] = None):
+        if COM_ORIGIN + len(image) > 0xFFF0:
+            raise SimError(f".COM image too large ({len(image)} bytes)")
+        self.mem = bytearray(0x10000)
+        # PSP: int 20h at offset 0, reached when the program returns from the entry point
+        self.mem[0:2] = b"\xCD\x20"
+        self.mem[COM_ORIGIN:COM_ORIGIN + len(image)] = image
+        # AX, CX, DX, BX, SP, BP, SI, DI in encoding order
+        self.regs = [0, 0, 0, 0, 0xFFFE, 0, 0, 0]
+        self.sregs = [LOAD_SEGMENT] * 4
+        self.ip = COM_ORIGIN
+        self.cf = self.pf = self.af = self.zf = self.sf = self.of = self.df = 0
+        self.if_ = 1
+        self.extra = 0
+        self.exit_code: Optional[int] = None
+        self.stdout = bytearray()
+        self.stderr = bytearray()
+        self.files: Dict[str, bytearray] = {}
+        self.handles: Dict[int, str] = {}  # open file handle -> name
+        self.instructions = 0
+        self.cycles = 0
+        self.called: Optional[int] = None
+        self.returned = False
+
+        # Label lookup: nearest label at or below an address
+        names: Dict[int, str] = {}
+        for name, addr in (symbols or {}).items():
+            if addr not in names or (names[addr].count(".") > name.count(".")):
+                names[addr] = name
+        self.label_addrs = sorted(names)
+        self.label_names = [names[a] for a in self.label_addrs]
+        self.func_names = names
+        self.labels: Dict[str, LabelProfile] = {}
+        self.label_cache: Dict[int, LabelProfile] = {}
+        self.functions: Dict[str, FunctionProfile] = {}
+        self.active: Dict[str, int] = {}
+        root = self._function(COM_ORIGIN)
+        root.calls = 1
+        self.frames: List[Tuple[FunctionProfile, int]] = [(root, 0)]
+        self.active[root.name] = 1
+        # Source line of each instruction address; other code counts as line 0
+        self.line_at = lines
+        self.lines: Dict[int, LineProfile] = {}
+        self.line_cache: Dict[int, LineProfile] = {}
+
+        self.ops: List[Callable[[int], int]] = [self._op_invalid] * 256
+        for op in range(0x40):
+            if op & 7 < 6:
+                self.ops[op] = self._op_alu
+        for op in (0x06, 0x0E, 0x16, 0x1E):
+            self.ops[op] = self._op_push_sreg
+        for op in (0x07, 0x17, 0x1F):
+            self.ops[op] = self._op_pop_sreg
+        for op in (0x26, 0x2E, 0x36, 0x3E):
+            self.ops[op] = self._op_seg_prefix
+        for op in range(0x40, 0x50):
+            self.ops[op] = self._op_incdec_reg
+        for op in range(0x50, 0x58):
+            self.ops[op] = self._op_push_reg
+        for op in range(0x58, 0x60):
+            self.ops[op] = self._op_pop_reg
+        for op in range(0x70, 0x80):
+            self.ops[op] = self._op_jcc
+        for op in range(0x80, 0x84):
+            self.ops[op] = self._op_grp1
+        for op in range(0x90, 0x98):
+            self.ops[op] = self._op_xchg_ax
+        for op in STRING_CYCLES:
+            self.ops[op] = self._op_string
+        for op in range(0xB0, 0xC0):
+            self.ops[op] = self._op_mov_imm_reg
+        for op in LOOP_CYCLES:
+            self.ops[op] = self._op_loop
+        for op in range(0xF8, 0xFE):
+            self.ops[op] = self._op_flag
+        self.ops[0x84] = self.ops[0x85] = self._op_test
+        self.ops[0x86] = self.ops[0x87] = self._op_xchg
+        for op in range(0x88, 0x8C):
+            self.ops[op] = self._op_mov
+        self.ops[0x8C] = self._op_mov_from_sreg
+        self.ops[0x8D] = self._op_lea
+        self.ops[0x8E] = self._op_mov_to_sreg
+        self.ops[0x8F] = self._op_pop_rm
+        self.ops[0x98] = self._op_cbw
+        self.ops[0x99] = self._op_cwd
+        self.ops[0x9C] = self._op_pushf
+        self.ops[0x9D] = self._op_popf
+        self.ops[0x9E] = self._op_sahf
+        self.ops[0x9F] = self._op_lahf
+        for op in range(0xA0, 0xA4):
+            self.ops[op] = self._op_mov_moffs
+        self.ops[0xA8] = self.ops[0xA9] = self._op_test_acc
+        self.ops[0xC2] = self.ops[0xC3] = self._op_ret
+        self.ops[0xC6] = self.ops[0xC7] = self._op_mov_imm_rm
+        self.ops[0xCD] = self._op_int
+        for op in range(0xD0, 0xD4):
+            self.ops[op] = self._op_shift
+        self.ops[0xD7] = self._op_xlat
+        self.ops[0xE8] = self._op_call
+        self.ops[0xE9] = self._op_jmp_near
+        self.ops[0xEB] = self._op_jmp_short
+        self.ops[0xF2] = self.ops[0xF3] = self._op_rep
+        self.ops[0xF5] = self._op_cmc
+        self.ops[0xF6] = self.ops[0xF7] = self._op_grp3
+        self.ops[0xFE] = self.ops[0xFF] = self._op_grp45
+
+    # -- running
+
+    def run(self, max_steps: int = DEFAULT_MAX_STEPS) -> RunResult:
+        ops = self.ops
+        mem = self.mem
+        while self.exit_code is None:
+            if self.instructions >= max_steps:
+                raise SimError(f"Step limit of {max_steps} instructions reached at {self.ip:#06x}")
+            start = self.ip
+            fn = self.frames[-1][0]
+            self.ip = (start + 1) & 0xFFFF
+            self.extra = 0
+            cyc = ops[mem[start]](mem[start]) + self.extra
+            self.instructions += 1
+            self.cycles += cyc
+            fn.self_cycles += cyc
+            prof = self.label_cache.get(start)
+            if prof is None:
+                prof = self._label_profile(start)
+            prof.instructions += 1
+            prof.cycles += cyc
+            if self.line_at is not None:
+                lp = self.line_cache.get(start)
+                if lp is None:
+                    lp = self._line_profile(start)
+                lp.instructions += 1
+                lp.cycles += cyc
+            if self.called is not None:
+                self._enter(self.called)
+                self.called = None
+            elif self.returned:
+                self._leave()
+                self.returned = False
+        while self.frames:
+            self._leave()
+        return RunResult(self.exit_code, bytes(self.stdout), bytes(self.stderr),
+                         self.instructions, self.cycles, self.labels, self.functions,
+                         {name: bytes(data) for name, data in self.files.items()}, self.lines)
+
+    def _line_profile(self, addr: int) -> LineProfile:
+        line = self.line_at.get(addr, 0)
+        prof = self.lines.get(line)
+        if prof is None:
+            prof = self.lines[line] = LineProfile(line)
+        self.line_cache[addr] = prof
+        return prof
+
+    def _label_profile(self, addr: int) -> LabelProfile:
+        i = bisect.bisect_right(self.label_addrs, addr) - 1
+        name = self.label_names[i] if i >= 0 else f"{addr:#06x}"
+        if addr < COM_ORIGIN:
+            name = "<psp>"
+        prof = self.labels.get(name)
+        if prof is None:
+            prof = self.labels[name] = LabelProfile(name)
+        self.label_cache[addr] = prof
+        return prof
+
+    def _function(self, addr: int) -> FunctionProfile:
+        name = self.func_names.get(addr, f"{addr:#06x}")
+        prof = self.functions.get(name)
+        if prof is None:
+            prof = self.functions[name] = FunctionProfile(name)
+        return prof
+
+    def _enter(self, target: int):
+        prof = self._function(target)
+        prof.calls += 1
+        self.active[prof.name] = self.active.get(prof.name, 0) + 1
+        self.frames.append((prof, self.cycles))
+
+    def _leave(self):
+        # A ret past the entry point (into the PSP) has no frame to close
+        if len(self.frames) == 1 and self.exit_code is None:
+            return
+        prof, entry = self.frames.pop()
+        self.active[prof.name] -= 1
+        # Recursive activations are already covered by the outermost one
+        if self.active[prof.name] == 0:
+            prof.total_cycles += self.cycles - entry
+
+    # -- operand access
+
+    def _fetch8(self) -> int:
+        v = self.mem[self.ip]
+        self.ip = (self.ip + 1) & 0xFFFF
+        return v
+
+    def _fetch16(self) -> int:
+        ip = self.ip
+        v = self.mem[ip] | (self.mem[(ip + 1) & 0xFFFF] << 8)
+        self.ip = (ip + 2) & 0xFFFF
+        return v
+
+    def _fetchs8(self) -> int:
+        v = self._fetch8()
+        return v - 0x100 if v & 0x80 else v
+
+    def _rw(self, addr: int) -> int:
+        if addr & 1:
+            self.extra += 4
+        return self.mem[addr] | (self.mem[(addr + 1) & 0xFFFF] << 8)
+
+    def _ww(self, addr: int, v: int):
+        if addr & 1:
+            self.extra += 4
+        self.mem[addr] = v & 0xFF
+        self.mem[(addr + 1) & 0xFFFF] = (v >> 8) & 0xFF
+
+    def _get8(self, code: int) -> int:
+        if code < 4:
+            return self.regs[code] & 0xFF
+        return self.regs[code - 4] >> 8
+
+    def _set8(self, code: int, v: int):
+        if code < 4:
+            self.regs[code] = (self.regs[code] & 0xFF00) | (v & 0xFF)
+        else:
+            self.regs[code - 4] = (self.regs[code - 4] & 0x00FF) | ((v & 0xFF) << 8)
+
+    def _get_reg(self, w: int, code: int) -> int:
+        return self.regs[code] if w else self._get8(code)
+
+    def _set_reg(self, w: int, code: int, v: int):
+        if w:
+            self.regs[code] = v & 0xFFFF
+        else:
+            self._set8(code, v)
+
+    def _modrm(self) -> Tuple[int, int, Optional[int], int]:
+        # Returns (reg field, r/m field, address or None for a register, EA cycles)
+        b = self._fetch8()
+        mod, reg, rm = b >> 6, (b >> 3) & 7, b & 7
+        if mod == 3:
+            return reg, rm, None, 0
+        if mod == 0 and rm == 6:
+            return reg, rm, self._fetch16(), 6
+        r = self.regs
+        if rm == 0:
+            addr = r[3] + r[6]
+        elif rm == 1:
+            addr = r[3] + r[7]
+        elif rm == 2:
+            addr = r[5] + r[6]
+        elif rm == 3:
+            addr = r[5] + r[7]
+        elif rm == 4:
+            addr = r[6]
+        elif rm == 5:
+            addr = r[7]
+        elif rm == 6:
+            addr = r[5]
+        else:
+            addr = r[3]
+        ea = EA_CYCLES[rm]
+        if mod == 1:
+            addr += self._fetchs8()
+            ea += 4
+        elif mod == 2:
+            addr += self._fetch16()
+            ea += 4
+        return reg, rm, addr & 0xFFFF, ea
+
+    def _read(self, w: int, rm: int, addr: Optional[int]) -> int:
+        if addr is None:
+            return self.regs[rm] if w else self._get8(rm)
+        return self._rw(addr) if w else self.mem[addr]
+
+    def _write(self, w: int, rm: int, addr: Optional[int], v: int):
+        if addr is None:
+            self._set_reg(w, rm, v)
+        elif w:
+            self._ww(addr, v)
+        else:
+            self.mem[addr] = v & 0xFF
+
+    def _push(self, v: int):
+        self.regs[4] = (self.regs[4] - 2) & 0xFFFF
+        self._ww(self.regs[4], v)
+
+    def _pop(self) -> int:
+        v = self._rw(self.regs[4])
+        self.regs[4] = (self.regs[4] + 2) & 0xFFFF
+        return v
+
+    # -- flags
+
+    def _szp(self, w: int, r: int):
+        self.zf = int(r == 0)
+        self.sf = (r >> (15 if w else 7)) & 1
+        self.pf = int(bin(r & 0xFF).count("1") % 2 == 0)
+
+    def _add(self, w: int, a: int, b: int, c: int) -> int:
+        mask = 0xFFFF if w else 0xFF
+        sign = 0x8000 if w else 0x80
+        full = a + b + c
+        r = full & mask
+        self.cf = int(full > mask)
+        self.of = int(((a ^ r) & (b ^ r) & sign) != 0)
+        self.af = int(((a ^ b ^ r) & 0x10) != 0)
+        self._szp(w, r)
+        return r
+
+    def _sub(self, w: int, a: int, b: int, c: int) -> int:
+        mask = 0xFFFF if w else 0xFF
+        sign = 0x8000 if w else 0x80
+        full = a - b - c
+        r = full & mask
+        self.cf = int(full < 0)
+        self.of = int(((a ^ b) & (a ^ r) & sign) != 0)
+        self.af = int(((a ^ b ^ r) & 0x10) != 0)
+        self._szp(w, r)
+        return r
+
+    def _logic(self, w: int, r: int) -> int:
+        self.cf = self.of = self.af = 0
+        self._szp(w, r)
+        return r
+
+    def _alu(self, op: int, w: int, a: int, b: int) -> int:
+        if op == 0:
+            return self._add(w, a, b, 0)
+        if op == 1:
+            return self._logic(w, a | b)
+        if op == 2:
+            return self._add(w, a, b, self.cf)
+        if op == 3:
+            return self._sub(w, a, b, self.cf)
+        if op == 4:
+            return self._logic(w, a & b)
+        if op == 6:
+            return self._logic(w, a ^ b)
+        return self._sub(w, a, b, 0)  # sub, cmp
+
+    def _cond(self, cc: int) -> bool:
+        c = cc >> 1
+        if c == 0:
+            t = self.of
+        elif c == 1:
+            t = self.cf
+        elif c == 2:
+            t = self.zf
+        elif c == 3:
+            t = self.cf | self.zf
+        elif c == 4:
+            t = self.sf
+        elif c == 5:
+            t = self.pf
+        elif c == 6:
+            t = self.sf ^ self.of
+        else:
+            t = self.zf | (self.sf ^ self.of)
+        return bool(t) != bool(cc & 1)
+
+    def _flags_word(self) -> int:
+        # Bits 12-15 read as 1 on the 8086
+        return (0xF002 | self.cf | (self.pf << 2) | (self.af << 4) | (self.zf << 6) | (self.sf << 7)
+                | (self.if_ << 9) | (self.df << 10) | (self.of << 11))
+
+    def _set_flags_word(self, v: int):
+        self.cf, self.pf, self.af = v & 1, (v >> 2) & 1, (v >> 4) & 1
+        self.zf, self.sf = (v >> 6) & 1, (v >> 7) & 1
+        self.if_, self.df, self.of = (v >> 9) & 1, (v >> 10) & 1, (v >> 11) & 1
+
+    # -- instructions; each returns its cycle count
+
+    def _op_invalid(self, op: int) -> int:
+        raise SimError(f"Unsupported opcode {op:#04x} at {(self.ip - 1) & 0xFFFF:#06x}")
+
+    def _op_alu(self, op: int) -> int:
+        aop, kind = op >> 3, op & 7
+        w = kind & 1
+        if kind >= 4:
+            imm = self._fetch16() if w else self._fetch8()
+            r = self._alu(aop, w, self._get_reg(w, 0), imm)
+            if aop != 7:
+                self._set_reg(w, 0, r)
+            return 4
+        reg, rm, addr, ea = self._modrm()
+        regv = self._get_reg(w, reg)
+        rmv = self._read(w, rm, addr)
+        if kind < 2:
+            r = self._alu(aop, w, rmv, regv)
+            if aop != 7:
+                self._write(w, rm, addr, r)
+            if addr is None:
+                return 3
+            return (9 if aop == 7 else 16) + ea
+        r = self._alu(aop, w, regv, rmv)
+        if aop != 7:
+            self._set_reg(w, reg, r)
+        return 3 if addr is None else 9 + ea
+
+    def _op_grp1(self, op: int) -> int:
+        w = op & 1
+        reg, rm, addr, ea = self._modrm()
+        if op == 0x81:
+            imm = self._fetch16()
+        elif op == 0x83:
+            imm = self._fetchs8() & 0xFFFF
+        else:
+            imm = self._fetch8()
+        r = self._alu(reg, w, self._read(w, rm, addr), imm)
+        if reg != 7:
+            self._write(w, rm, addr, r)
+        if addr is None:
+            return 4
+        return (10 if reg == 7 else 17) + ea
+
+    def _op_test(self, op: int) -> int:
+        w = op & 1
+        reg, rm, addr, ea = self._modrm()
+        self._logic(w, self._get_reg(w, reg) & self._read(w, rm, addr))
+        return 3 if addr is None else 9 + ea
+
+    def _op_test_acc(self, op: int) -> int:
+        w = op & 1
+        imm = self._fetch16() if w else self._fetch8()
+        self._logic(w, self._get_reg(w, 0) & imm)
+        return 4
+
+    def _op_xchg(self, op: int) -> int:
+        w = op & 1
+        reg, rm, addr, ea = self._modrm()
+        a = self._get_reg(w, reg)
+        self._set_reg(w, reg, self._read(w, rm, addr))
+        self._write(w, rm, addr, a)
+        return 4 if addr is None else 17 + ea
+
+    def _op_xchg_ax(self, op: int) -> int:
+        r = op & 7
+        self.regs[0], self.regs[r] = self.regs[r], self.regs[0]
+        return 3
+
+    def _op_mov(self, op: int) -> int:
+        w = op & 1
+        reg, rm, addr, ea = self._modrm()
+        if op & 2:
+            self._set_reg(w, reg, self._read(w, rm, addr))
+            return 2 if addr is None else 8 + ea
+        self._write(w, rm, addr, self._get_reg(w, reg))
+        return 2 if addr is None else 9 + ea
+
+    def _op_mov_from_sreg(self, op: int) -> int:
+        reg, rm, addr, ea = self._modrm()
+        self._write(1, rm, addr, self.sregs[reg & 3])
+        return 2 if addr is None else 9 + ea
+
+    def _op_mov_to_sreg(self, op: int) -> int:
+        reg, rm, addr, ea = self._modrm()
+        self.sregs[reg & 3] = self._read(1, rm, addr)
+        return 2 if addr is None else 8 + ea
+
+    def _op_lea(self, op: int) -> int:
+        reg, rm, addr, ea = self._modrm()
+        if addr is None:
+            raise SimError(f"lea with a register operand at {self.ip:#06x}")
+        self.regs[reg] = addr
+        return 2 + ea
+
+    def _op_mov_moffs(self, op: int) -> int:
+        w = op & 1
+        addr = self._fetch16()
+        if op & 2:
+            self._write(w, 0, addr, self._get_reg(w, 0))
+        else:
+            self._set_reg(w, 0, self._read(w, 0, addr))
+        return 10
+
+    def _op_mov_imm_reg(self, op: int) -> int:
+        if op & 8:
+            self.regs[op & 7] = self._fetch16()
+        else:
+            self._set8(op & 7, self._fetch8())
+        return 4
+
+    def _op_mov_imm_rm(self, op: int) -> int:
+        w = op & 1
+        reg, rm, addr, ea = self._modrm()
+        self._write(w, rm, addr, self._fetch16() if w else self._fetch8())
+        return 4 if addr is None else 10 + ea
+
+    def _op_incdec_reg(self, op: int) -> int:
+        r = op & 7
+        cf = self.cf
+        if op < 0x48:
+            self.regs[r] = self._add(1, self.regs[r], 1, 0)
+        else:
+            self.regs[r] = self._sub(1, self.regs[r], 1, 0)
+        self.cf = cf
+        return 2
+
+    def _op_push_reg(self, op: int) -> int:
+        # push sp stores the already-decremented value on the 8086
+        if op == 0x54:
+            self._push((self.regs[4] - 2) & 0xFFFF)
+        else:
+            self._push(self.regs[op & 7])
+        return 11
+
+    def _op_pop_reg(self, op: int) -> int:
+        self.regs[op & 7] = self._pop()
+        return 8
+
+    def _op_push_sreg(self, op: int) -> int:
+        self._push(self.sregs[op >> 3])
+        return 10
+
+    def _op_pop_sreg(self, op: int) -> int:
+        self.sregs[op >> 3] = self._pop()
+        return 8
+
+    def _op_pop_rm(self, op: int) -> int:
+        reg, rm, addr, ea = self._modrm()
+        self._write(1, rm, addr, self._pop())
+        return 8 if addr is None else 17 + ea
+
+    def _op_pushf(self, op: int) -> int:
+        self._push(self._flags_word())
+        return 10
+
+    def _op_popf(self, op: int) -> int:
+        self._set_flags_word(self._pop())
+        return 8
+
+    def _op_sahf(self, op: int) -> int:
+        self._set_flags_word((self._flags_word() & 0xFF00) | (self.regs[0] >> 8))
+        return 4
+
+    def _op_lahf(self, op: int) -> int:
+        self._set8(4, self._flags_word() & 0xFF)
+        return 4
+
+    def _op_cbw(self, op: int) -> int:
+        al = self.regs[0] & 0xFF
+        self.regs[0] = al | (0xFF00 if al & 0x80 else 0)
+        return 2
+
+    def _op_cwd(self, op: int) -> int:
+        self.regs[2] = 0xFFFF if self.regs[0] & 0x8000 else 0
+        return 5
+
+    def _op_flag(self, op: int) -> int:
+        if op < 0xFA:
+            self.cf = op & 1
+        elif op < 0xFC:
+            self.if_ = op & 1
+        else:
+            self.df = op & 1
+        return 2
+
+    def _op_cmc(self, op: int) -> int:
+        self.cf ^= 1
+        return 2
+
+    def _op_xlat(self, op: int) -> int:
+        self._set8(0, self.mem[(self.regs[3] + (self.regs[0] & 0xFF)) & 0xFFFF])
+        return 11
+
+    def _op_seg_prefix(self, op: int) -> int:
+        # Overrides are accepted but change nothing with all segments equal
+        nxt = self._fetch8()
+        return 2 + self.ops[nxt](nxt)
+
+    def _op_jcc(self, op: int) -> int:
+        disp = self._fetchs8()
+        if self._cond(op & 0xF):
+            self.ip = (self.ip + disp) & 0xFFFF
+            return 16
+        return 4
+
+    def _op_loop(self, op: int) -> int:
+        disp = self._fetchs8()
+        taken_cyc, not_cyc = LOOP_CYCLES[op]
+        if op == 0xE3:
+            taken = self.regs[1] == 0
+        else:
+            self.regs[1] = (self.regs[1] - 1) & 0xFFFF
+            taken = self.regs[1] != 0
+            if op == 0xE0:
+                taken = taken and not self.zf
+            elif op == 0xE1:
+                taken = taken and bool(self.zf)
+        if taken:
+            self.ip = (self.ip + disp) & 0xFFFF
+            return taken_cyc
+        return not_cyc
+
+    def _op_jmp_short(self, op: int) -> int:
+        disp = self._fetchs8()
+        self.ip = (self.ip + disp) & 0xFFFF
+        return 15
+
+    def _op_jmp_near(self, op: int) -> int:
+        disp = self._fetch16()
+        self.ip = (self.ip + disp) & 0xFFFF
+        return 15
+
+    def _op_call(self, op: int) -> int:
+        disp = self._fetch16()
+        self._push(self.ip)
+        self.ip = (self.ip + disp) & 0xFFFF
+        self.called = self.ip
+        return 19
+
+    def _op_ret(self, op: int) -> int:
+        extra = self._fetch16() if op == 0xC2 else 0
+        self.ip = self._pop()
+        self.regs[4] = (self.regs[4] + extra) & 0xFFFF
+        self.returned = True
+        return 12 if op == 0xC2 else 8
+
+    def _op_shift(self, op: int) -> int:
+        w = op & 1
+        reg, rm, addr, ea = self._modrm()
+        n = self.regs[1] & 0xFF if op & 2 else 1
+        self._write(w, rm, addr, self._shift(reg, w, self._read(w, rm, addr), n))
+        if op & 2:
+            return 8 + 4 * n if addr is None else 20 + ea + 4 * n
+        return 2 if addr is None else 15 + ea
+
+    def _shift(self, op: int, w: int, v: int, n: int) -> int:
+        if n == 0:
+            return v
+        bits = 16 if w else 8
+        mask = (1 << bits) - 1
+        top = bits - 1
+        for _ in range(n):
+            prev = v
+            if op == 0:
+                self.cf = v >> top
+                v = ((v << 1) | self.cf) & mask
+            elif op == 1:
+                self.cf = v & 1
+                v = (v >> 1) | (self.cf << top)
+            elif op == 2:
+                c = v >> top
+                v = ((v << 1) | self.cf) & mask
+                self.cf = c
+            elif op == 3:
+                c = v & 1
+                v = (v >> 1) | (self.cf << top)
+                self.cf = c
+            elif op in (4, 6):
+                self.cf = v >> top
+                v = (v << 1) & mask
+            elif op == 5:
+                self.cf = v & 1
+                v >>= 1
+            else:
+                self.cf = v & 1
+                v = (v >> 1) | (v & (1 << top))
+        # OF as defined for a count of 1, from the last step
+        if op in (0, 2, 4, 6):
+            self.of = (v >> top) ^ self.cf
+        elif op in (1, 3):
+            self.of = ((v >> top) ^ (v >> (top - 1))) & 1
+        elif op == 5:
+            self.of = prev >> top
+        else:
+            self.of = 0
+        if op >= 4:
+            self._szp(w, v)
+        return v
+
+    def _op_grp3(self, op: int) -> int:
+        w = op & 1
+        reg, rm, addr, ea = self._modrm()
+        v = self._read(w, rm, addr)
+        if reg < 2:
+            imm = self._fetch16() if w else self._fetch8()
+            self._logic(w, v & imm)
+            return 5 if addr is None else 11 + ea
+        if reg == 2:
+            self._write(w, rm, addr, ~v & (0xFFFF if w else 0xFF))
+            return 3 if addr is None else 16 + ea
+        if reg == 3:
+            cf = int(v != 0)
+            self._write(w, rm, addr, self._sub(w, 0, v, 0))
+            self.cf = cf
+            return 3 if addr is None else 16 + ea
+        cyc = MULDIV_CYCLES[(reg, w)] + (0 if addr is None else MULDIV_MEM_EXTRA + ea)
+        if reg in (4, 5):
+            self._mul(reg == 5, w, v)
+        else:
+            self._div(reg == 7, w, v)
+        return cyc
+
+    def _mul(self, signed: bool, w: int, v: int):
+        bits = 16 if w else 8
+        a = self.regs[0] if w else self.regs[0] & 0xFF
+        if signed:
+            a = _signed(a, bits)
+            v = _signed(v, bits)
+        p = a * v
+        if w:
+            self.regs[0] = p & 0xFFFF
+            self.regs[2] = (p >> 16) & 0xFFFF
+        else:
+            self.regs[0] = p & 0xFFFF
+        if signed:
+            over = not -(1 << (bits - 1)) <= p < (1 << (bits - 1))
+        else:
+            over = p >> bits != 0
+        self.cf = self.of = int(over)
+
+    def _div(self, signed: bool, w: int, v: int):
+        bits = 16 if w else 8
+        if w:
+            n = (self.regs[2] << 16) | self.regs[0]
+        else:
+            n = self.regs[0]
+        if signed:
+            n = _signed(n, 2 * bits)
+            v = _signed(v, bits)
+        if v == 0:
+            raise SimError(f"Divide error (division by zero) at {self.ip:#06x}")
+        q = abs(n) // abs(v)
+        if (n < 0) != (v < 0):
+            q = -q
+        r = n - q * v
+        # The 8086 faults on the most negative quotient too
+        limit = (1 << (bits - 1)) - 1 if signed else (1 << bits) - 1
+        if not (-limit <= q <= limit):
+            raise SimError(f"Divide error (quotient overflow) at {self.ip:#06x}")
+        mask = (1 << bits) - 1
+        if w:
+            self.regs[0] = q & mask
+            self.regs[2] = r & mask
+        else:
+            self.regs[0] = (q & mask) | ((r & mask) << 8)
+
+    def _op_grp45(self, op: int) -> int:
+        w = op & 1
+        reg, rm, addr, ea = self._modrm()
+        if reg < 2:
+            cf = self.cf
+            v = self._read(w, rm, addr)
+            self._write(w, rm, addr, self._add(w, v, 1, 0) if reg == 0 else self._sub(w, v, 1, 0))
+            self.cf = cf
+            return 3 if addr is None else 15 + ea
+        if not w:
+            raise SimError(f"Invalid FE /{reg} at {self.ip:#06x}")
+        if reg == 2:
+            target = self._read(1, rm, addr)
+            self._push(self.ip)
+            self.ip = target
+            self.called = target
+            return 16 if addr is None else 21 + ea
+        if reg == 4:
+            self.ip = self._read(1, rm, addr)
+            return 11 if addr is None else 18 + ea
+        if reg == 6:
+            self._push(self._read(1, rm, addr))
+            return 11 if addr is None else 16 + ea
+        raise SimError(f"Far call/jmp is not supported in a .COM program ({self.ip:#06x})")
+
+    def _op_string(self, op: int, rep: Optional[int] = None) -> int:
+        w = op & 1
+        step = (-1 if self.df else 1) * (2 if w else 1)
+        single, per = STRING_CYCLES[op]
+        if rep is None:
+            self._string_once(op, w, step)
+            return single
+        count = 0
+        while self.regs[1]:
+            self._string_once(op, w, step)
+            self.regs[1] = (self.regs[1] - 1) & 0xFFFF
+            count += 1
+            # cmps/scas stop on mismatch (repe) or match (repne)
+            if op in (0xA6, 0xA7, 0xAE, 0xAF) and self.zf != (rep == 0xF3):
+                break
+        return REP_BASE_CYCLES + per * count
+
+    def _string_once(self, op: int, w: int, step: int):
+        r = self.regs
+        si, di = r[6], r[7]
+        if op < 0xA6:
+            self._write(w, 0, di, self._read(w, 0, si))
+            r[6] = (si + step) & 0xFFFF
+            r[7] = (di + step) & 0xFFFF
+        elif op < 0xA8:
+            self._sub(w, self._read(w, 0, si), self._read(w, 0, di), 0)
+            r[6] = (si + step) & 0xFFFF
+            r[7] = (di + step) & 0xFFFF
+        elif op < 0xAC:
+            self._write(w, 0, di, self._get_reg(w, 0))
+            r[7] = (di + step) & 0xFFFF
+        elif op < 0xAE:
+            self._set_reg(w, 0, self._read(w, 0, si))
+            r[6] = (si + step) & 0xFFFF
+        else:
+            self._sub(w, self._get_reg(w, 0), self._read(w, 0, di), 0)
+            r[7] = (di + step) & 0xFFFF
+
+    def _op_rep(self, op: int) -> int:
+        nxt = self._fetch8()
+        if nxt in (0x26, 0x2E, 0x36, 0x3E):
+            nxt = self._fetch8()
+        if nxt not in STRING_CYCLES:
+            # A rep prefix on anything else is ignored, as on the 8086
+            return 2 + self.ops[nxt](nxt)
+        return self._op_string(nxt, op)
+
+    def _op_int(self, op: int) -> int:
+        n = self._fetch8()
+        if n == 0x20:
+            self.exit_code = 0
+        elif n == 0x21:
+            self._dos()
+        else:
+            raise SimError(f"Unsupported interrupt {n:#04x} at {self.ip:#06x}")
+        return 51
+
+    def _dos(self):
+        ah = self.regs[0] >> 8
+        if ah == 0x02:
+            ch = self.regs[2] & 0xFF
+            self.stdout.append(ch)
+            self._set8(0, ch)
+        elif ah == 0x09:
+            addr = self.regs[2]
+            start = addr
+            while self.mem[addr] != ord("$"):
+                addr = (addr + 1) & 0xFFFF
+                if addr == start:
+                    raise SimError("Unterminated '$' string passed to int 21h/09h")
+            self.stdout.extend(self.mem[start:addr] if addr >= start else self.mem[start:] + self.mem[:addr])
+            self._set8(0, ord("$"))
+        elif ah == 0x3C:
+            # Create or truncate the file named by the ASCIIZ string at DS:DX
+            addr, name = self.regs[2], bytearray()
+            while self.mem[addr] and len(name) < 128:
+                name.append(self.mem[addr])
+                addr = (addr + 1) & 0xFFFF
+            handle = max(self.handles, default=4) + 1
+            self.handles[handle] = name.decode("latin-1").upper()
+            self.files[self.handles[handle]] = bytearray()
+            self.regs[0] = handle
+            self.cf = 0
+        elif ah == 0x3E:
+            if self.handles.pop(self.regs[3], None) is None:
+                raise SimError(f"int 21h/3Eh on unknown handle {self.regs[3]}")
+            self.cf = 0
+        elif ah == 0x40:
+            handle, count, addr = self.regs[3], self.regs[1], self.regs[2]
+            data = bytes(self.mem[(addr + i) & 0xFFFF] for i in range(count))
+            if handle in self.handles:
+                self.files[self.handles[handle]].extend(data)
+            elif handle in (1, 2):
+                (self.stdout if handle == 1 else self.stderr).extend(data)
+            else:
+                raise SimError(f"int 21h/40h to unsupported handle {handle}")
+            self.regs[0] = count
+            self.cf = 0
+        elif ah == 0x4C:
+            self.exit_code = self.regs[0] & 0xFF
+        else:
+            raise SimError(f"Unsupported DOS service AH={ah:#04x} at {self.ip:#06x}")
+
+def _signed(v: int, bits: int) -> int:
+    return v - (1 << bits) if v & (1 << (bits - 1)) else v
+
+def run(image: bytes, symbols: Optional[Dict[str, int]] = None,
+        max_steps: int = DEFAULT_MAX_STEPS, lines: Optional[Dict[int, int]] = None) -> RunResult:
+    return Sim8086(image, symbols, lines).run(max_steps)
+
+def load_program(path: Path, line_map: Optional[Path] = None
+                 ) -> Tuple[bytes, Dict[str, int], Optional[Dict[int, int]]]:
+    # .ql is compiled, .asm assembled; a bare .COM image has no symbols. Also
+    # the .ql line of each instruction address, for .ql input or with the
+    # line map the .asm was compiled with
+    from .assembler_8086 import assemble_with_lines
+    from .emitter import LineMap
+    suffix = path.suffix.lower()
+    if suffix == ".com":
+        return path.read_bytes(), {}, None
+    text = path.read_text(encoding="utf-8")
+    lmap = None
+    if suffix == ".ql":
+        from .driver import compile_source
+        lmap = LineMap(path.name)
+        text = compile_source(text, path=str(path), line_map=lmap)
+    elif line_map is not None:
+        try:
+            lmap = LineMap.loads(line_map.read_text(encoding="utf-8"))
+        except ValueError as e:
+            raise SimError(f"{line_map}: {e}")
+    image, symbols, asm_lines = assemble_with_lines(text, str(path))
+    if lmap is None:
+        return image, symbols, None
+    return image, symbols, {addr: lmap.source_line(n) for addr, n in asm_lines.items()}
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Run a QuinLang program on a simulated 8086 under DOS")
+    ap.add_argument("program", type=Path, help="Program to run: .ql source, .asm, or .COM image")
+    ap.add_argument("--top", type=int, default=10, help="Hotspots to list per table")
+    ap.add_argument("--max-steps", type=int, default=DEFAULT_MAX_STEPS, help="Instruction limit")
+    ap.add_argument("-q", "--quiet", action="store_true", help="Don't print the profile")
+    ap.add_argument("--files-dir", type=Path, default=Path("."),
+                    help="Where files the program creates are written")
+    ap.add_argument("--line-map", type=Path,
+                    help="Line map (quinc --line-map) of an .asm program, to profile by source line")
+    args = ap.parse_args(argv)
+    image, symbols, lines = load_program(args.program, args.line_map)
+    result = run(image, symbols, args.max_steps, lines)
+    sys.stdout.buffer.write(result.stdout)
+    sys.stdout.flush()
+    sys.stderr.buffer.write(result.stderr)
+    for name, data in result.files.items():
+        (args.files_dir / name).write_bytes(data)
+    if not args.quiet:
+        print(result.report(args.top), file=sys.stderr)
+    sys.exit(result.exit_code)
+
+
+if __name__ == "__main__":
+    main()
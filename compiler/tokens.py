@@ -8,6 +8,8 @@ class TokenType(Enum):
     RIGHT_PAREN = auto()
     LEFT_BRACE = auto()
     RIGHT_BRACE = auto()
+    LEFT_BRACKET = auto()
+    RIGHT_BRACKET = auto()
     COMMA = auto()
     DOT = auto()
     MINUS = auto()
@@ -26,6 +28,9 @@ class TokenType(Enum):
     GREATER_EQUAL = auto()
     LESS = auto()
     LESS_EQUAL = auto()
+    DOT_DOT = auto()
+    AMP_AMP = auto()
+    PIPE_PIPE = auto()
 
     # Literals
     IDENTIFIER = auto()
@@ -34,11 +39,15 @@ class TokenType(Enum):
 
     # Keywords
     FN = auto()
+    EXTERN = auto()
+    IMPORT = auto()
     LET = auto()
     RETURN = auto()
     IF = auto()
     ELSE = auto()
     WHILE = auto()
+    FOR = auto()
+    IN = auto()
     TRUE = auto()
     FALSE = auto()
     INT = auto()
@@ -50,11 +59,15 @@ class TokenType(Enum):
 
 KEYWORDS = {
     "fn": TokenType.FN,
+    "extern": TokenType.EXTERN,
+    "import": TokenType.IMPORT,
     "let": TokenType.LET,
     "return": TokenType.RETURN,
     "if": TokenType.IF,
     "else": TokenType.ELSE,
     "while": TokenType.WHILE,
+    "for": TokenType.FOR,
+    "in": TokenType.IN,
     "true": TokenType.TRUE,
     "false": TokenType.FALSE,
     "int": TokenType.INT,
@@ -21,8 +21,22 @@ BUILTIN_TYPES: Dict[str, Type] = {
     "bool": Bool,
 }
 
+# Every array element occupies a word, like every local slot
+ELEM_STRIDE = 2
+
+@dataclass(frozen=True)
+class ArrayType(Type):
+    elem: Type = Int
+    length: int = 0
+
+def array_of(elem: Type, length: int) -> ArrayType:
+    return ArrayType(f"[{elem}; {length}]", ELEM_STRIDE * length, elem, length)
+
 def type_from_name(name: str) -> Type:
     if name in BUILTIN_TYPES:
         return BUILTIN_TYPES[name]
+    if name.startswith("[") and name.endswith("]"):
+        elem, length = name[1:-1].rsplit(";", 1)
+        return array_of(type_from_name(elem.strip()), int(length))
     # Unknown types default to int for now (placeholder)
     return Int
\ No newline at end of file
@@ -0,0 +1,14 @@
+; Runtime checks
+;
+; rt_bounds_fail
+;   Reached by a jump from generated code when an array index is out of range.
+;   Prints a diagnostic and terminates with exit code 1; never returns.
+
+global rt_bounds_fail
+rt_bounds_fail:
+    mov dx, .msg
+    mov ah, 0x09
+    int 0x21
+    mov ax, 0x4C01
+    int 0x21
+.msg db 'index out of bounds', 13, 10, '$'
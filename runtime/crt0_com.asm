@@ -1,4 +1,5 @@
-; .COM program CRT0: set DS=CS and call main, then exit via int 21h/4C00h
+; .COM program CRT0: set DS=ES=CS and call main, then exit via int 21h/4C00h
+; Generated code relies on ES = DS and DF = 0 for string instructions (rep movs/stos)
 
 global start
 extern main
@@ -7,6 +8,9 @@ start:
     ; Establish DS = CS
     push cs
     pop ds
+    push cs
+    pop es
+    cld
 
     call main
 
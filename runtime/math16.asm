@@ -0,0 +1,231 @@
+; Integer math routines backing std/math.ql
+;
+; Included only when a program calls one of the std/math.ql externs. Routines
+; exposed to QuinLang follow the extern ABI: arguments in AX, BX, CX, DX (in
+; declaration order), result in AX, every other register preserved.
+; The 32-bit routines work on DX:AX pairs for use from assembly.
+;
+; Cycle counts are 8086 estimates from the instruction timing tables,
+; including the near call and ret.
+;
+; rt_mul32      DX:AX = DX:AX * CX:BX (low 32 bits)
+;               Preserves BX, CX, SI, DI                        ~330 cycles
+; rt_udiv32     DX:AX = DX:AX / BX, CX = DX:AX % BX (unsigned)
+;               Preserves BX, SI, DI                            ~220 cycles
+; rt_isqrt32    AX = floor(sqrt(DX:AX)) (unsigned)
+;               Preserves BX, CX, DX, SI, DI      ~400 + ~165 per Newton step
+; rt_isqrt      AX = floor(sqrt(AX)) (unsigned)                 ~530 cycles
+; rt_gcd        AX = gcd(|AX|, |BX|)                    ~60 + ~115 per step
+; rt_ipow       AX = AX ** BX (mod 2^16)           ~40 + ~150 per exponent bit
+; rt_udiv       AX = AX / BX (unsigned)                         ~125 cycles
+; rt_umod       AX = AX % BX (unsigned)                         ~127 cycles
+; rt_muldiv     AX = AX * BX / CX, 32-bit intermediate (signed) ~300 cycles
+; rt_mulhi      AX = high word of AX * BX (signed)              ~140 cycles
+;
+; Division by zero, or a quotient that doesn't fit, raises the CPU's divide
+; error (int 0) as a plain div/idiv would.
+
+global rt_mul32
+rt_mul32:
+    push si
+    push di
+    mov si, ax          ; a_lo
+    mov di, dx          ; a_hi
+    mul bx              ; DX:AX = a_lo * b_lo
+    push ax
+    push dx
+    mov ax, di
+    mul bx              ; AX = low(a_hi * b_lo)
+    mov di, ax
+    mov ax, si
+    mul cx              ; AX = low(a_lo * b_hi)
+    add di, ax
+    pop dx
+    add dx, di          ; cross terms land in the high word
+    pop ax
+    pop di
+    pop si
+    ret
+
+global rt_udiv32
+rt_udiv32:
+    mov cx, ax          ; save dividend low word
+    mov ax, dx
+    xor dx, dx
+    div bx              ; AX = quotient high, DX = partial remainder
+    xchg ax, cx         ; CX = quotient high, AX = dividend low
+    div bx              ; AX = quotient low, DX = remainder
+    xchg cx, dx         ; DX = quotient high, CX = remainder
+    ret
+
+; Newton's iteration from above, x' = (x + n/x) / 2, stopping once it no
+; longer decreases. Starting at or above floor(sqrt(n)) keeps every n/x within
+; 16 bits, except for n >= 0xFFFE0000, which is answered directly.
+global rt_isqrt32
+rt_isqrt32:
+    test dx, dx
+    jz rt_isqrt
+    cmp dx, 0xFFFE
+    jae .top
+    push bx
+    push cx
+    push dx
+    push si
+    mov si, ax          ; CX:SI = n
+    mov cx, dx
+    mov ax, dx
+    call rt_isqrt       ; sqrt(n) < (isqrt(hi) + 1) * 256
+    inc ax
+    mov ah, al
+    xor al, al
+    test ax, ax
+    jnz .guess
+    dec ax              ; (255 + 1) * 256 doesn't fit: start at 0xFFFF
+.guess:
+    mov bx, ax
+.newton:
+    mov dx, cx
+    mov ax, si
+    div bx
+    add ax, bx
+    rcr ax, 1           ; 17-bit sum halved
+    cmp ax, bx
+    jae .done
+    mov bx, ax
+    jmp .newton
+.done:
+    mov ax, bx
+    pop si
+    pop dx
+    pop cx
+    pop bx
+    ret
+.top:
+    ; 0xFFFE0000 -> 65534, 0xFFFE0001 (65535^2) and above -> 65535
+    cmp dx, 0xFFFE
+    jne .max
+    test ax, ax
+    jnz .max
+    mov ax, 65534
+    ret
+.max:
+    mov ax, 0xFFFF
+    ret
+
+; Restoring square root, two bits of the operand per step: the remainder
+; stays below 2^11, so everything fits in 16-bit registers.
+global rt_isqrt
+rt_isqrt:
+    push bx
+    push cx
+    push dx
+    push si
+    xor bx, bx          ; root
+    xor dx, dx          ; remainder
+    mov cx, 8
+.step:
+    shl ax, 1
+    rcl dx, 1
+    shl ax, 1
+    rcl dx, 1           ; remainder = remainder * 4 + next two bits
+    shl bx, 1
+    mov si, bx
+    shl si, 1
+    inc si              ; trial = 4 * old root + 1
+    cmp dx, si
+    jb .next
+    sub dx, si
+    inc bx
+.next:
+    loop .step
+    mov ax, bx
+    pop si
+    pop dx
+    pop cx
+    pop bx
+    ret
+
+; Euclid with unsigned div after taking absolute values
+global rt_gcd
+rt_gcd:
+    push bx
+    push dx
+    cwd
+    xor ax, dx
+    sub ax, dx
+    xchg ax, bx
+    cwd
+    xor ax, dx
+    sub ax, dx
+    xchg ax, bx
+    test bx, bx
+    jz .done
+.step:
+    xor dx, dx
+    div bx
+    mov ax, bx
+    mov bx, dx
+    test bx, bx
+    jnz .step
+.done:
+    pop dx
+    pop bx
+    ret
+
+; Square-and-multiply over the bits of the exponent, lowest first
+global rt_ipow
+rt_ipow:
+    push bx
+    push cx
+    push dx
+    mov cx, ax          ; base
+    mov ax, 1           ; result
+.step:
+    shr bx, 1
+    jnc .square
+    mul cx
+.square:
+    test bx, bx
+    jz .done
+    xchg ax, cx
+    mul ax
+    xchg ax, cx
+    jmp .step
+.done:
+    pop dx
+    pop cx
+    pop bx
+    ret
+
+global rt_udiv
+rt_udiv:
+    push dx
+    xor dx, dx
+    div bx
+    pop dx
+    ret
+
+global rt_umod
+rt_umod:
+    push dx
+    xor dx, dx
+    div bx
+    mov ax, dx
+    pop dx
+    ret
+
+global rt_muldiv
+rt_muldiv:
+    push dx
+    imul bx
+    idiv cx
+    pop dx
+    ret
+
+global rt_mulhi
+rt_mulhi:
+    push dx
+    imul bx
+    mov ax, dx
+    pop dx
+    ret
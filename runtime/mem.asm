@@ -0,0 +1,24 @@
+; Bulk word memory routines
+;
+; All buffers live in the single .COM segment, so DS = ES = SS and frame
+; addresses can be passed as plain offsets. crt0 leaves DF = 0.
+;
+; rt_mem_zero16
+;   Inputs:  ES:DI -> destination, CX = word count
+;   Clobbers: AX, CX, DI, FLAGS
+;
+; rt_mem_copy16
+;   Inputs:  ES:DI -> destination, DS:SI -> source, CX = word count
+;   Clobbers: CX, SI, DI, FLAGS
+;   Regions must not overlap with DI above SI
+
+global rt_mem_zero16
+rt_mem_zero16:
+    xor ax, ax
+    rep stosw
+    ret
+
+global rt_mem_copy16
+rt_mem_copy16:
+    rep movsw
+    ret
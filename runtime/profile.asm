@@ -0,0 +1,39 @@
+; Profile counter dump for instrumented builds (quinc --instrument)
+;
+; The generated program defines PGO_COUNTS, a table of PGO_NCOUNTERS 32-bit
+; block counters, and calls this when main returns.
+;
+; rt_profile_dump
+;   Writes the counter table to the file PGO.CNT, replacing it; a failed
+;   create skips the dump.
+; Preserves:
+;   AX, BX, CX, DX
+; Clobbers:
+;   FLAGS
+
+global rt_profile_dump
+rt_profile_dump:
+    push ax
+    push bx
+    push cx
+    push dx
+
+    mov ah, 0x3C           ; create file, DS:DX -> ASCIIZ name
+    xor cx, cx             ; normal attributes
+    mov dx, .name
+    int 0x21
+    jc .done
+    mov bx, ax             ; handle
+    mov ah, 0x40           ; write CX bytes from DS:DX
+    mov cx, PGO_NCOUNTERS * 4
+    mov dx, PGO_COUNTS
+    int 0x21
+    mov ah, 0x3E           ; close
+    int 0x21
+.done:
+    pop dx
+    pop cx
+    pop bx
+    pop ax
+    ret
+.name db 'PGO.CNT', 0
@@ -0,0 +1,18 @@
+; Prints "ok" if 2 + 3 == 5. Part of the corpus the in-process assembler is
+; byte-compared against NASM with:
+;   python -m compiler.assembler_8086 --compare-nasm tests/asm/*.asm
+org 0x100
+%include 'runtime/runtime.inc'
+section .text
+global main
+main:
+    mov ax, 2
+    add ax, 3
+    cmp ax, 5
+    jne .fail
+    mov dx, msg_ok
+    call rt_print_str
+.fail:
+    ret
+section .data
+msg_ok db 'ok', 13, 10, '$'
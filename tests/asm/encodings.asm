@@ -0,0 +1,73 @@
+; One instance of each operand form the code generator and runtime rely on,
+; for byte comparison against NASM. Never executed.
+org 0x100
+section .text
+forms:
+    mov ax, bx
+    mov al, [si]
+    mov [bx], al
+    mov ax, [bp-2]
+    mov [bp+4], ax
+    mov ax, word [bp+si-16]
+    mov word [bp+si-300], ax
+    mov ax, [table]
+    mov [table+2], ax
+    mov ax, word [si+table]
+    mov ax, 0x4C00
+    mov al, '$'
+    mov cx, 0xFFFF
+    mov dx, table
+    mov word [bp-2], 7
+    lea di, [bp-16]
+    add ax, bx
+    add ax, 5
+    add ax, 1000
+    add dl, '0'
+    sub sp, 14
+    cmp al, bl
+    cmp al, '$'
+    cmp cx, word [bp-8]
+    cmp dx, 0xFFFE
+    cmp si, 200
+    and ax, bx
+    or ax, bx
+    xor ah, ah
+    adc cx, cx
+    test ax, ax
+    inc cx
+    dec cx
+    inc word [bp-2]
+    neg ax
+    imul bx
+    idiv bx
+    div si
+    mul ax
+    cwd
+    shl ax, 1
+    shl ax, cl
+    shr cx, 1
+    rcl dx, 1
+    rcr ax, 1
+    xchg ax, cx
+    xchg ax, bx
+    push ax
+    pop bx
+    push cs
+    pop ds
+    pop es
+    cld
+    rep stosw
+    rep movsb
+    repne scasb
+    int 0x21
+.back:
+    jmp .back
+    je .back
+    loop .back
+    call forms
+    ret
+section .data
+table dw 1, 2, 3
+text db 'hi', 13, 10, '$'
+section .bss
+buf resb 16
@@ -0,0 +1,874 @@
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from compiler.cache import CompileCache
+from compiler.codegen_8086 import PARALLEL_MAX_DEPTH
+from compiler.cost_8086 import Cost, cheapest, instruction_cost, sequence_cost
+from compiler.driver import build_output, compile_source, write_asm
+from compiler.emitter import LineMap
+from compiler.linker import LinkError
+from compiler.parser import ParseError
+from compiler.passes import OPT_LEVELS, PassManager
+from compiler.pgo import COUNTS_FILE, Profile, ProfileError, ProfileMap
+from compiler.sema import SemanticError
+from compiler.serve import (INVALID_PARAMS, METHOD_NOT_FOUND, PARSE_ERROR, REQUEST_CANCELLED,
+                            CompileServer, Connection)
+from compiler.assembler_8086 import (AsmError, assemble, assemble_with_symbols, check_with_binutils,
+                                     compare_with_nasm)
+from compiler.sim_8086 import SimError, load_program, run as simulate
+from benchmarks import synth
+from benchmarks.run import compare as compare_benchmarks, measure
+
+# Regression tests: every tests/ql/NAME.ql is compiled at each optimisation
+# level and run in the simulator, and its output must match NAME.out. CHECKS
+# are tests of the tools around the compiler, each returning an error or None,
+# or raising Skip when a tool it needs isn't installed.
+#
+#   python -m tests.run               run them all
+#   python -m tests.run for_shadow serve_shutdown    run some
+
+TESTS_DIR = Path(__file__).resolve().parent
+ROOT = TESTS_DIR.parent
+# Far beyond any test; a miscompiled loop fails instead of hanging the run
+MAX_STEPS = 5_000_000
+
+class Skip(Exception):
+    pass
+
+def run_program(path: Path, level: str) -> bytes:
+    asm = compile_source(path.read_text(encoding="utf-8"), path=str(path), opt=level)
+    return simulate(assemble(asm, str(path)), max_steps=MAX_STEPS).stdout
+
+def check_serve_shutdown() -> Optional[str]:
+    # The server must exit after `shutdown` even though stdin stays open
+    proc = subprocess.Popen([sys.executable, "-m", "compiler.driver", "serve"], cwd=ROOT,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    requests = [{"jsonrpc": "2.0", "id": 1, "method": "compile",
+                 "params": {"path": "t.ql", "source": "fn main() { print(1); }"}},
+                {"jsonrpc": "2.0", "id": 2, "method": "shutdown"}]
+    proc.stdin.write("".join(json.dumps(r) + "\n" for r in requests).encode("utf-8"))
+    proc.stdin.flush()
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        return "still running 30s after shutdown"
+    finally:
+        proc.stdin.close()
+    answered = {json.loads(line)["id"] for line in proc.stdout.read().splitlines()}
+    proc.stdout.close()
+    if answered != {1, 2}:
+        return f"answered requests {sorted(answered)}, expected [1, 2]"
+    return None
+
+def check_serve_requests() -> Optional[str]:
+    # Everything is queued before the compile thread starts, so superseded
+    # and cancelled requests are answered as such
+    src = "fn main() { print(1); }"
+    requests = [
+        {"id": 1, "method": "compile", "params": {"path": "a.ql", "source": "fn main() { }"}},
+        {"id": 2, "method": "compile", "params": {"path": "a.ql", "source": src}},
+        {"id": 3, "method": "compile", "params": {"path": "b.ql", "source": src}},
+        {"id": 4, "method": "compile", "params": {"path": "c.ql", "source": src, "format": "com"}},
+        {"id": 5, "method": "compile", "params": {"path": "d.ql", "source": "fn main() { print(; }"}},
+        {"id": 6, "method": "compile", "params": {"source": src, "format": "exe"}},
+        {"id": 7, "method": "compile", "params": {"path": "e.ql", "source": src}},
+        {"id": 8, "method": "cancel", "params": {"id": 7}},
+        {"id": 9, "method": "frobnicate"},
+        {"id": 10, "method": "status"},
+    ]
+    lines = [json.dumps(dict(r, jsonrpc="2.0")) for r in requests]
+    lines.insert(3, "{not json")
+    out = io.BytesIO()
+    server = CompileServer()
+    server.serve_connection(Connection(io.BytesIO("\n".join(lines).encode("utf-8")), out))
+    server.queue.put(None)
+    server.work()
+    answers = {msg["id"]: msg.get("result", msg.get("error"))
+               for msg in map(json.loads, out.getvalue().splitlines())}
+    asm = compile_source(src, path="b.ql")
+    expected = {
+        None: {"code": PARSE_ERROR},
+        1: {"code": REQUEST_CANCELLED},
+        2: {"ok": True, "asm": asm, "cached": False},
+        # Same source and options as request 2
+        3: {"ok": True, "asm": asm, "cached": True},
+        5: {"ok": False, "diagnostics": [{"severity": "error", "kind": "parse",
+                                          "message": "1:19: Expected expression"}]},
+        6: {"code": INVALID_PARAMS},
+        7: {"code": REQUEST_CANCELLED},
+        8: True,
+        9: {"code": METHOD_NOT_FOUND},
+    }
+    for id_, want in expected.items():
+        got = answers.get(id_)
+        if isinstance(want, dict):
+            ok = isinstance(got, dict) and all(got.get(k) == v for k, v in want.items())
+        else:
+            ok = got == want
+        if not ok:
+            return f"request {id_}: answered {got}"
+    com = base64.b64decode(answers[4].get("com", ""))
+    if simulate(com).stdout != b"1":
+        return f"request 4: .COM printed {simulate(com).stdout!r}"
+    # The seven compile requests were served before it
+    if answers[10].get("served") != 7 or answers[10]["cache"]["hits"] < 1:
+        return f"status: {answers[10]}"
+    return None
+
+# Each access is marked with whether its index is proven in range
+BOUNDS_ELISION = """
+fn main() {
+    let a: [int; 8];
+    for i in 0..8 {
+        a[i] = i;               // proven
+    }
+    for i in 1..8 {
+        a[i - 1] = a[i];        // proven, proven
+    }
+    let k = 5;
+    print(a[k]);                // checked
+    print(a[3]);                // proven
+    print(a[band(k, 7)]);       // proven
+    print(a[clamp(k, 2, 9)]);   // checked
+    for i in 0..9 {
+        a[i] = 0;               // checked
+    }
+}
+"""
+
+def check_bounds_elision() -> Optional[str]:
+    # Only indices not proven in range get a bounds check, at every level
+    for level in OPT_LEVELS:
+        asm = compile_source(BOUNDS_ELISION, opt=level)
+        checks = sum(1 for line in asm.splitlines() if line.startswith("jae .BND"))
+        if checks != 3:
+            return f"-O{level}: {checks} bounds checks, expected 3"
+    return None
+
+# Each is reported as an AsmError naming the offending line
+ASM_ERRORS = [
+    ("shl ax, 2", "t.asm:3: Shift count must be 1 or CL on the 8086"),
+    ("mov [bx], 1", "t.asm:3: Operation size not specified"),
+    ("mov al, 300", "t.asm:3: Value 300 doesn't fit in 1 byte(s)"),
+    ("mov ax, bl", "t.asm:3: Operand size mismatch"),
+    ("mov ax, [bx+bp]", "t.asm:3: Invalid 8086 addressing mode [bx+bp]"),
+    ("nop\njmp nowhere", "t.asm:4: Undefined symbol 'nowhere'"),
+]
+
+def check_assembler() -> Optional[str]:
+    for line, message in ASM_ERRORS:
+        try:
+            assemble(f"org 0x100\nsection .text\n{line}\n", "t.asm")
+        except AsmError as e:
+            if str(e) != message:
+                return f"{line!r}: {e}, expected {message}"
+        else:
+            return f"{line!r} assembled, expected {message}"
+    # Conditional jumps only reach 127 bytes; farther ones become a reversed
+    # short jump over a near jmp
+    for gap, size in ((10, 13), (200, 206)):
+        image = assemble("org 0x100\nsection .text\njz target\n" + "nop\n" * gap + "target:\nret\n")
+        if len(image) != size:
+            return f"jz over {gap} bytes assembled to {len(image)} bytes, expected {size}"
+    path = TESTS_DIR / "asm" / "add_ok.asm"
+    out = simulate(assemble(path.read_text(encoding="utf-8"), str(path)), max_steps=MAX_STEPS).stdout
+    if out != b"ok\r\n":
+        return f"{path.name} printed {out!r}"
+    return None
+
+# Cycle counts from the 8086 timing tables, per label
+SIM_PROGRAM = """
+org 0x100
+section .text
+start:
+    mov ax, 1234        ; 4
+    mov bx, ax          ; 2
+    add ax, bx          ; 3
+    mov cx, 3           ; 4
+again:
+    loop again          ; 17 taken, 5 not
+    call twice          ; 19
+    call twice
+    mov dl, 'A'         ; 4
+    mov ah, 2           ; 4
+    int 0x21            ; 51
+    mov ax, 0x4C07      ; 4
+    int 0x21
+twice:
+    shl ax, 1           ; 2
+    ret                 ; 8
+"""
+
+def check_simulator() -> Optional[str]:
+    image, symbols = assemble_with_symbols(SIM_PROGRAM, "t.asm")
+    r = simulate(image, symbols)
+    got = (r.exit_code, r.stdout, r.instructions, r.cycles)
+    if got != (7, b"A", 18, 224):
+        return f"exit code, output, instructions, cycles: {got}, expected (7, b'A', 18, 224)"
+    labels = {name: (p.instructions, p.cycles) for name, p in r.labels.items()}
+    if labels != {"start": (4, 13), "again": (10, 191), "twice": (4, 20)}:
+        return f"label profile {labels}"
+    functions = {name: (f.calls, f.self_cycles, f.total_cycles) for name, f in r.functions.items()}
+    if functions != {"start": (1, 204, 224), "twice": (2, 20, 20)}:
+        return f"function profile {functions}"
+    try:
+        simulate(assemble("org 0x100\nsection .text\nspin:\njmp spin\n"), max_steps=1000)
+    except SimError as e:
+        if str(e) != "Step limit of 1000 instructions reached at 0x0100":
+            return f"endless loop: {e}"
+    else:
+        return "endless loop finished"
+    return None
+
+def check_benchmark_tracker() -> Optional[str]:
+    result = measure("t", "fn main() { for i in 0..3 { print(i); } }", True, 1)
+    missing = {"lex_ms", "parse_ms", "sema_ms", "codegen_ms", "peak_kib", "instructions",
+               "com_bytes", "cycles"} - set(result)
+    if missing or result["stdout"] != "012":
+        return f"measure: missing {sorted(missing)}, stdout {result['stdout']!r}"
+    base = {"a": {"instructions": 100, "cycles": 1000, "stdout": "1", "codegen_ms": 10.0},
+            "b": {"instructions": 100, "com_bytes": 300, "stdout": "2", "codegen_ms": 10.0},
+            "c": {"instructions": 100, "codegen_ms": 1.0}}
+    cur = {"a": {"instructions": 102, "cycles": 1021, "stdout": "1", "codegen_ms": 14.0},
+           "b": {"instructions": 100, "com_bytes": 300, "stdout": "3", "codegen_ms": 11.0},
+           "c": {"instructions": 100, "codegen_ms": 2.5},
+           "new": {"instructions": 5, "stdout": "4"}}
+    # Code metrics may grow up to the threshold; compile time only counts
+    # with check_compile, past both the time threshold and TIME_FLOOR_MS
+    cases = [(False, ["a: cycles 1000 -> 1021 (+2.1%)", "b: program output changed"]),
+             (True, ["a: cycles 1000 -> 1021 (+2.1%)", "a: codegen_ms 10.0 -> 14.0 (+40.0%)",
+                     "b: program output changed"])]
+    for check_compile, expected in cases:
+        problems = compare_benchmarks(cur, base, 0.02, 0.25, check_compile)
+        if problems != expected:
+            return f"compare with check_compile={check_compile}: {problems}, expected {expected}"
+    return None
+
+def quinc(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, "-m", "compiler.driver", *args], cwd=ROOT,
+                          capture_output=True, text=True, timeout=120)
+
+STATS_PROGRAM = """
+fn f(a: int): int { return a + 1; }
+fn main() { let x = "hi"; print(f(2)); print(x); }
+"""
+
+def check_pass_stats() -> Optional[str]:
+    with tempfile.TemporaryDirectory() as tmp:
+        src = Path(tmp) / "t.ql"
+        src.write_text(STATS_PROGRAM, encoding="utf-8")
+        # Instrumented runs compile even when the output is cached
+        for _ in range(2):
+            proc = quinc(str(src), "-o", str(Path(tmp) / "t.asm"), "--cache-dir", tmp,
+                         "--time-passes", "--stats", "--stats-format", "json")
+            if proc.returncode != 0 or "(cached)" in proc.stdout:
+                return f"quinc: {proc.stdout}{proc.stderr}"
+            report = json.loads(proc.stderr)
+            passes = [p["name"] for p in report["passes"]]
+            if passes[:4] != ["lex", "parse", "signatures", "reuse"] or "codegen" not in passes:
+                return f"passes {passes}"
+            if any(p["peak_kib"] is None for p in report["passes"]):
+                return "--time-passes reported no memory peak"
+            stats = {k: report["stats"][k] for k in ("tokens", "functions", "strings", "frame_bytes_max")}
+            if stats != {"tokens": 41, "functions": 2, "strings": 1, "frame_bytes_max": 2}:
+                return f"stats {stats}"
+        proc = quinc(str(src), "-o", str(Path(tmp) / "t.asm"), "--no-cache", "--stats")
+        if proc.returncode != 0 or not any(line.split() == ["functions", "2"]
+                                           for line in proc.stderr.splitlines()):
+            return f"--stats table: {proc.stderr}"
+    return None
+
+def check_batch_build() -> Optional[str]:
+    with tempfile.TemporaryDirectory() as tmp:
+        src = Path(tmp) / "src"
+        (src / "sub").mkdir(parents=True)
+        (src / "x.ql").write_text("fn main() { print(1); }", encoding="utf-8")
+        (src / "sub" / "y.ql").write_text("fn main() { print(2); }", encoding="utf-8")
+        (src / "sub" / "x.ql").write_text("fn main() { print(3); }", encoding="utf-8")
+        (src / "bad.ql").write_text("fn main() { print(; }", encoding="utf-8")
+        # The same files with one worker and with a pool; a failing file
+        # doesn't stop the others
+        images = []
+        for jobs in ("1", "2"):
+            out = Path(tmp) / f"out{jobs}"
+            proc = quinc("build", str(src), "-o", str(out), "-j", jobs, "--format", "com", "--no-cache")
+            if proc.returncode != 1 or "bad.ql: error:" not in proc.stderr \
+                    or "3/4 files compiled" not in proc.stdout:
+                return f"build -j{jobs}: {proc.stdout}{proc.stderr}"
+            images.append({p.relative_to(out): p.read_bytes() for p in out.rglob("*.com")})
+        names = {Path("x.com"), Path("sub/x.com"), Path("sub/y.com")}
+        if set(images[0]) != names or images[0] != images[1]:
+            return f"-j1 wrote {sorted(map(str, images[0]))}, -j2 wrote {sorted(map(str, images[1]))}"
+        out = simulate(images[1][Path("sub/y.com")]).stdout
+        if out != b"2":
+            return f"sub/y.com printed {out!r}"
+        # Two inputs mapping to one output file are refused up front
+        proc = quinc("build", str(src / "x.ql"), str(src / "sub" / "x.ql"), "-o", str(Path(tmp) / "o"))
+        if proc.returncode != 2 or "would both be written to" not in proc.stderr:
+            return f"clashing outputs: {proc.stderr}"
+    return None
+
+def check_compile_cache() -> Optional[str]:
+    src = b"fn main() { print(42); }"
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = CompileCache(Path(tmp) / "cache")
+        fresh = build_output(src, "t.ql", "com")[0]
+        # Keyed by source and options; the .COM is assembled from a cached .asm
+        for source, kind, opt, cached in ((src, "asm", "1", False), (src, "asm", "1", True),
+                                          (src, "asm", "2", False), (src + b"\n", "asm", "1", False),
+                                          (src, "com", "1", False), (src, "com", "1", True)):
+            data, hit = build_output(source, "t.ql", kind, cache, opt=opt)
+            if hit != cached:
+                return f"{kind} -O{opt} of {source!r}: cached={hit}, expected {cached}"
+        if data != fresh:
+            return "cached .COM differs from a fresh one"
+        (Path(tmp) / "t.ql").write_bytes(src)
+        for note in ("", " (cached)"):
+            proc = quinc(str(Path(tmp) / "t.ql"), "-o", str(Path(tmp) / "t.com"),
+                         "--cache-dir", str(Path(tmp) / "cli"))
+            if proc.stdout != f"Wrote {Path(tmp) / 't.com'}{note}\n":
+                return f"quinc: {proc.stdout}{proc.stderr}"
+        if (Path(tmp) / "t.com").read_bytes() != fresh:
+            return "quinc wrote a different .COM from the cache"
+        # Least recently used entries go first, and a hit counts as a use
+        small = CompileCache(Path(tmp) / "small", max_bytes=250)
+        for n, key in enumerate(("aa", "bb")):
+            small.put(key, "asm", bytes(100))
+            os.utime(small._path(key, "asm"), (n, n))
+        small.get("aa", "asm")
+        small.put("cc", "asm", bytes(100))
+        kept = sorted(path.stem for _, _, path in small.entries())
+        if kept != ["aa", "cc"] or small.stats.evictions != 1:
+            return f"after eviction the cache holds {kept}"
+    return None
+
+INCREMENTAL_PROGRAM = """
+fn sq(a: int): int {
+    return a * a;
+}
+
+fn add(a: int, b: int): int {
+    return a + b;
+}
+
+fn main() {
+    print(add(sq(3), 1));
+}
+"""
+
+def check_incremental() -> Optional[str]:
+    # Each edit, and how many functions keep their cached code. Whatever is
+    # reused, the output and line map must be those of a fresh compilation.
+    edits = [
+        ("unchanged", INCREMENTAL_PROGRAM, 3),
+        ("body of sq", INCREMENTAL_PROGRAM.replace("a * a", "a * a + 0 * a"), 2),
+        ("lines moved", "\n\n" + INCREMENTAL_PROGRAM.replace("fn add", "\n\nfn add"), 3),
+        # Callers are regenerated when a callee's signature changes
+        ("signature of add", INCREMENTAL_PROGRAM.replace("int): int {\n    return a + b;",
+                                                         'int): str {\n    return "x";'), 1),
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = CompileCache(Path(tmp))
+        compile_source(INCREMENTAL_PROGRAM, cache=cache)
+        for edit, src, reused in edits:
+            pm, lines, fresh_lines = PassManager(), LineMap("t.ql"), LineMap("t.ql")
+            asm = compile_source(src, pm, cache, line_map=lines)
+            if pm.stats["functions_reused"] != reused:
+                return f"{edit}: {pm.stats['functions_reused']} functions reused, expected {reused}"
+            if asm != compile_source(src, line_map=fresh_lines) or lines.rows != fresh_lines.rows:
+                return f"{edit}: output differs from a fresh compilation"
+    return None
+
+def check_parallel_codegen() -> Optional[str]:
+    # Worker processes must produce the program and line map generated
+    # in-process, label for label; functions nested too deeply to send to a
+    # worker are generated in-process among them
+    sources = [(p.name, p.read_text(encoding="utf-8"))
+               for p in sorted((ROOT / "benchmarks").glob("*.ql")) + sorted((TESTS_DIR / "ql").glob("*.ql"))]
+    sources.append(("many_functions", synth.many_functions(300)))
+    deep = synth.deep_nesting(PARALLEL_MAX_DEPTH + 10).replace("fn main()", "fn deep()")
+    sources.append(("deep_nesting", f"{deep}\n{synth.many_functions(20)}"))
+    for name, src in sources:
+        serial_lines, parallel_lines = LineMap(name), LineMap(name)
+        serial = compile_source(src, jobs=1, line_map=serial_lines)
+        if compile_source(src, jobs=3, line_map=parallel_lines) != serial:
+            return f"{name}: -j3 output differs from -j1"
+        if parallel_lines.rows != serial_lines.rows:
+            return f"{name}: -j3 line map differs from -j1"
+    return None
+
+MODULES = {
+    "base": "fn add(a: int, b: int): int { return a + b; }",
+    "util": "import base;\nfn twice(x: int): int { return add(x, x); }\n"
+            "fn unused(): int { return 9; }\nfn greet(): str { return \"hi\"; }",
+    "main": "import util;\nfn main() { print(twice(21)); print(greet()); }",
+    "c1": "import c2;\nfn f(): int { return 1; }",
+    "c2": "import c1;\nfn g(): int { return 2; }",
+    "h1": "fn h(): int { return 1; }",
+    "h2": "fn h(): int { return 2; }",
+    "k2": "import h2;\nfn k(): int { return h(); }",
+}
+
+# A program importing some of MODULES, and the error it fails with
+IMPORT_ERRORS = [
+    ("import util; fn main() { print(add(1, 2)); }",
+     "SemanticError: Call to undeclared function 'add'"),
+    ("import util; fn twice(x: int): int { return x; } fn main() { }",
+     "SemanticError: Redefinition of function 'twice'"),
+    ("import h1; import h2; fn main() { }",
+     "SemanticError: Redefinition of function 'h' by an imported module"),
+    # h2's h is only visible to k2, but both end up in the program
+    ("import h1; import k2; fn main() { print(h() + k()); }",
+     "LinkError: Function 'h' is defined by modules 'h1' and 'h2'"),
+    ("import c1; fn main() { }", "SemanticError: Import cycle: c1 -> c2 -> c1"),
+    ("import nope; fn main() { }", "SemanticError: Cannot find module 'nope'"),
+]
+
+def check_imports() -> Optional[str]:
+    with tempfile.TemporaryDirectory() as tmp:
+        src_dir, obj_dir = Path(tmp) / "src", Path(tmp) / "obj"
+        src_dir.mkdir()
+        obj_dir.mkdir()
+        for name, text in MODULES.items():
+            (src_dir / f"{name}.ql").write_text(text, encoding="utf-8")
+        main = src_dir / "main.ql"
+        asm = compile_source(MODULES["main"], path=str(main))
+        out = simulate(assemble(asm)).stdout
+        # Only functions the program can reach are linked in
+        if out != b"42hi" or "unused" in asm:
+            return f"main printed {out!r}" + (", unused was linked" if "unused" in asm else "")
+        for text, message in IMPORT_ERRORS:
+            try:
+                compile_source(text, path=str(src_dir / "x.ql"))
+            except (SemanticError, LinkError) as e:
+                got = f"{type(e).__name__}: {e}"
+                if not got.startswith(message):
+                    return f"{text!r}: {got}, expected {message}"
+            else:
+                return f"{text!r} compiled, expected {message}"
+        # Prebuilt objects link to the same program without their sources
+        for name in ("base", "util"):
+            proc = quinc(str(src_dir / f"{name}.ql"), "-o", str(obj_dir / f"{name}.qo"))
+            if proc.returncode != 0:
+                return f"quinc -o {name}.qo: {proc.stderr}"
+        (obj_dir / "main.ql").write_text(MODULES["main"], encoding="utf-8")
+        if compile_source(MODULES["main"], path=str(obj_dir / "main.ql")) != asm:
+            return "linking .qo objects gave a different program"
+        stale = json.loads((obj_dir / "base.qo").read_text(encoding="utf-8"))
+        stale["compiler"] = "0" * 64
+        (obj_dir / "base.qo").write_text(json.dumps(stale), encoding="utf-8")
+        try:
+            compile_source(MODULES["main"], path=str(obj_dir / "main.ql"))
+        except LinkError as e:
+            if "built by a different compiler version" not in str(e):
+                return f"stale object: {e}"
+        else:
+            return "an object from another compiler version was linked"
+        # Changing a module imported indirectly invalidates the cached program
+        cache = CompileCache(Path(tmp) / "cache")
+        source = main.read_bytes()
+        build_output(source, str(main), "asm", cache)
+        (src_dir / "base.ql").write_text(MODULES["base"].replace("a + b", "a + b + 1"), encoding="utf-8")
+        data, hit = build_output(source, str(main), "asm", cache)
+        if hit or simulate(assemble(data.decode("utf-8"))).stdout != b"43hi":
+            return "cached program kept the old version of an indirect import"
+    return None
+
+# `step`'s else arm is the hot one and main's loop runs 95 times per entry
+PGO_PROGRAM = """
+fn step(n: int): int {
+    let d = 1;
+    if (n >= 90) {
+        d = 2;
+    } else {
+        d = 1;
+    }
+    return n + d;
+}
+
+fn main() {
+    let n = 0;
+    let calls = 0;
+    while (n < 100) {
+        n = step(n);
+        calls = calls + 1;
+    }
+    print(calls);
+}
+"""
+
+PGO_COUNTS = {"step": {"entry": 95, "if1.then": 5, "if1.else": 90},
+              "main": {"entry": 1, "while1": 1, "while1.body": 95, "call1": 95}}
+
+def function_text(asm: str, name: str) -> str:
+    # A function's code, including the cold blocks placed after it
+    lines = asm.splitlines()
+    start = lines.index(f"{name}:")
+    end = next((i for i in range(start + 1, len(lines)) if lines[i].endswith(":")
+                and not lines[i].startswith(".")), len(lines))
+    return "\n".join(lines[start:end])
+
+def check_pgo() -> Optional[str]:
+    with tempfile.TemporaryDirectory() as tmp:
+        d = Path(tmp)
+        (d / "t.ql").write_text(PGO_PROGRAM, encoding="utf-8")
+        proc = quinc(str(d / "t.ql"), "-o", str(d / "train.com"), "--instrument")
+        if proc.returncode != 0:
+            return f"--instrument: {proc.stderr}"
+        run = simulate((d / "train.com").read_bytes())
+        if run.stdout != b"95" or COUNTS_FILE not in run.files:
+            return f"instrumented build printed {run.stdout!r} and wrote {sorted(run.files)}"
+        # Counts from several training runs add up
+        for n in (1, 2):
+            (d / f"run{n}.cnt").write_bytes(run.files[COUNTS_FILE])
+        proc = subprocess.run([sys.executable, "-m", "compiler.pgo", str(d / "train.pgomap"),
+                               str(d / "run1.cnt"), str(d / "run2.cnt"), "-o", str(d / "t.profile")],
+                              cwd=ROOT, capture_output=True, text=True, timeout=120)
+        if proc.returncode != 0:
+            return f"compiler.pgo: {proc.stderr}"
+        profile = Profile.loads((d / "t.profile").read_text(encoding="utf-8"))
+        doubled = {fn: {block: 2 * n for block, n in blocks.items()} for fn, blocks in PGO_COUNTS.items()}
+        if profile.counts != doubled:
+            return f"profile {profile.counts}, expected {doubled}"
+        proc = quinc(str(d / "t.ql"), "-o", str(d / "pgo.com"), "--profile-use", str(d / "t.profile"))
+        if proc.returncode != 0:
+            return f"--profile-use: {proc.stderr}"
+        plain = simulate(assemble(compile_source(PGO_PROGRAM)))
+        guided = simulate((d / "pgo.com").read_bytes())
+        if guided.stdout != b"95" or guided.cycles >= plain.cycles:
+            return f"profile-guided build printed {guided.stdout!r} in {guided.cycles} cycles, " \
+                   f"{plain.cycles} without the profile"
+    # The profile of a function edited since the training run is ignored
+    edited = PGO_PROGRAM.replace("d = 2", "d = 3")
+    with_profile, without = compile_source(edited, profile=profile), compile_source(edited)
+    if function_text(with_profile, "step") != function_text(without, "step") \
+            or function_text(with_profile, "main") == function_text(without, "main"):
+        return "profile applied to an edited function, or not to an unchanged one"
+    pmap = ProfileMap([("main", "entry")], {"main": "0"})
+    other = ProfileMap([("main", "entry")], {"main": "1"})
+    for runs, message in (([(pmap, bytes(8))], "counter dump has 8 bytes, expected 4"),
+                          ([(pmap, bytes(4)), (other, bytes(4))], "runs come from different builds")):
+        try:
+            fresh = Profile()
+            for layout, data in runs:
+                fresh.add_run(layout, data)
+        except ProfileError as e:
+            if not str(e).startswith(message):
+                return f"add_run: {e}, expected {message}"
+        else:
+            return f"add_run: no error, expected {message}"
+    return None
+
+LINE_MAP_PROGRAM = """fn sq(x: int): int {
+    return x * x;
+}
+
+fn main() {
+    let s = 0;
+    for i in 0..50 {
+        s = s + sq(i);
+    }
+    print(s);
+}
+"""
+
+def line_profile(path: Path, line_map: Optional[Path] = None) -> Tuple[Dict[int, Tuple[int, int]], int]:
+    # (instructions, cycles) per source line, and the run's total cycles
+    image, symbols, lines = load_program(path, line_map)
+    r = simulate(image, symbols, lines=lines)
+    return {line: (p.instructions, p.cycles) for line, p in r.lines.items()}, r.cycles
+
+def check_line_map() -> Optional[str]:
+    with tempfile.TemporaryDirectory() as tmp:
+        src = Path(tmp) / "t.ql"
+        src.write_text(LINE_MAP_PROGRAM, encoding="utf-8")
+        profile, cycles = line_profile(src)
+        if sum(c for _, c in profile.values()) != cycles:
+            return f"line profile doesn't add up to the run's {cycles} cycles"
+        # Line 0 is the startup code and runtime
+        if set(profile) != {0, 1, 2, 5, 6, 7, 8, 10, 11}:
+            return f"profiled lines {sorted(profile)}"
+        if max(profile, key=lambda line: profile[line][1]) != 2:
+            return f"hottest line isn't line 2: {profile}"
+        # The same attribution through a compiled .asm and its line map,
+        # with or without `; file:line` comments in the .asm
+        for flags in ((), ("--asm-comments",)):
+            proc = quinc(str(src), "-o", str(Path(tmp) / "t.asm"), "--line-map", "--no-cache", *flags)
+            if proc.returncode != 0:
+                return f"quinc --line-map: {proc.stderr}"
+            if line_profile(Path(tmp) / "t.asm", Path(tmp) / "t.lines")[0] != profile:
+                return f"profile through t.lines {' '.join(flags)} differs from compiling t.ql"
+        asm = (Path(tmp) / "t.asm").read_text(encoding="utf-8")
+        if "; t.ql:8" not in asm.splitlines():
+            return "--asm-comments: no `; t.ql:8` comment"
+        # Moving the code moves its lines
+        src.write_text("\n\n" + LINE_MAP_PROGRAM, encoding="utf-8")
+        moved = line_profile(src)[0]
+        if moved != {line + 2 if line else 0: counts for line, counts in profile.items()}:
+            return f"after two lines were inserted: {moved}"
+    try:
+        LineMap.loads('{"version": 0, "source": "t.ql", "rows": []}')
+    except ValueError:
+        return None
+    return "loaded a line map of another version"
+
+# Programs nested deeper than Python's recursion limit, and what they print.
+# benchmarks/stress.py checks that compile time stays linear in depth.
+DEEP_PROGRAMS = [
+    ("nesting", synth.deep_nesting(1000, indent=False), b"999"),
+    ("expression", synth.long_expression(3000), b"14250"),
+    ("parens", synth.nested_parens(3000), b"7501"),
+    ("calls", synth.nested_calls(3000), b"221"),
+]
+
+def check_deep_nesting() -> Optional[str]:
+    for name, src, expected in DEEP_PROGRAMS:
+        for level in OPT_LEVELS:
+            out = simulate(assemble(compile_source(src, opt=level)), max_steps=MAX_STEPS).stdout
+            if out != expected:
+                return f"{name} -O{level}: printed {out!r}, expected {expected!r}"
+    # Too large to run, but they must still compile
+    depth = 10 * sys.getrecursionlimit()
+    for src in (synth.deep_nesting(depth, indent=False), synth.long_expression(depth),
+                synth.nested_parens(depth), synth.nested_calls(depth)):
+        compile_source(src)
+    try:
+        compile_source("fn main() {\n" + "if (true) {\n" * depth)
+    except ParseError as e:
+        if str(e) != f"{depth + 2}:1: Expected '}}' after block":
+            return f"unterminated blocks: {e}"
+        return None
+    return "unterminated blocks compiled"
+
+# cost_8086 prices each of these as assembler_8086 encodes it and sim_8086 times it
+COST_FORMS = [
+    "mov ax, bx", "mov ax, [bp-2]", "mov [bp-2], ax", "mov ax, [x]", "mov [x], ax", "mov ax, 5",
+    "mov word [bp-2], 5", "mov ax, [bx+si+4]", "mov al, [bx]", "add ax, bx", "add ax, [bp-2]",
+    "add [bp-2], ax", "add ax, 300", "add bx, 5", "add bx, 300", "add word [bp-2], 5",
+    "add word [bp+300], 5", "cmp word [bp-2], 5", "cmp [bp-2], ax", "xor ax, ax", "test ax, ax",
+    "test ax, 1", "test bx, 1", "test word [bp-2], 1", "inc ax", "inc bl", "inc word [bp-2]",
+    "neg ax", "not word [bp-2]", "shl ax, 1", "sar word [bp-2], 1", "push ax", "push word [bp-2]",
+    "pop bx", "xchg ax, bx", "xchg bx, cx", "xchg bx, [bp-2]", "lea bx, [bp-2]", "cwd", "cbw",
+    "imul bx", "idiv word [bp-2]",
+]
+
+# x * 64 is six shifts at -O2 and an imul at -Os
+COST_PROGRAM = """fn main() {
+    let x = 3;
+    let y = x * 64;
+    x = x + 2;
+    print(x);
+    print(y);
+}
+"""
+
+def measured_cost(lines: Sequence[str]) -> Cost:
+    # BX and BP stay even: the model leaves out the 4 cycles a word access
+    # at an odd address costs
+    def program(body: Sequence[str]) -> str:
+        return "\n".join(["org 0x100", "section .text", "mov bx, 8", "mov word [bp-2], 7", "push bx",
+                          "start:", *body, "end:", "mov ax, 0x4c00", "int 0x21",
+                          "section .data", "x: dw 0", ""])
+    image, symbols = assemble_with_symbols(program(lines))
+    base = simulate(assemble(program([]))).cycles
+    return Cost(simulate(image).cycles - base, symbols["end"] - symbols["start"])
+
+def check_cost_model() -> Optional[str]:
+    for line in COST_FORMS:
+        if instruction_cost(line) != measured_cost([line]):
+            return f"{line!r}: modelled {instruction_cost(line)}, measured {measured_cost([line])}"
+    shift = ["mov cl, 3", "shl ax, cl"]
+    if sequence_cost(shift) != measured_cost(shift):
+        return f"{shift}: modelled {sequence_cost(shift)}, measured {measured_cost(shift)}"
+    unrolled = ["shl ax, 1"] * 3
+    for level, best in (("2", unrolled), ("s", shift)):
+        if cheapest(level, [unrolled, shift]) != best:
+            return f"-O{level} doesn't choose {best}"
+    # -O2 gives the fewest cycles and -Os the smallest .COM, with the same output
+    programs = [(name, (ROOT / "benchmarks" / f"{name}.ql").read_text(encoding="utf-8"))
+                for name in ("fib", "strings")]
+    for name, src in programs + [("t", COST_PROGRAM)]:
+        runs = {}
+        for level in OPT_LEVELS:
+            image = assemble(compile_source(src, opt=level))
+            r = simulate(image)
+            runs[level] = (len(image), r.cycles, r.stdout)
+        if len({out for _, _, out in runs.values()}) != 1:
+            return f"{name}: output differs between levels: {runs}"
+        if runs["s"][0] != min(size for size, _, _ in runs.values()):
+            return f"{name}: -Os isn't the smallest: {runs}"
+        if runs["2"][1] != min(cycles for _, cycles, _ in runs.values()):
+            return f"{name}: -O2 isn't the fastest: {runs}"
+        if runs["0"][:2] == runs["2"][:2]:
+            return f"{name}: -O2 is no better than -O0"
+    with tempfile.TemporaryDirectory() as tmp:
+        src = Path(tmp) / "t.ql"
+        src.write_text(COST_PROGRAM, encoding="utf-8")
+        for level in OPT_LEVELS:
+            proc = quinc(str(src), "-O" + level, "-o", str(Path(tmp) / "t.asm"), "--no-cache")
+            if proc.returncode != 0:
+                return f"quinc -O{level}: {proc.stderr}"
+            if (Path(tmp) / "t.asm").read_text(encoding="utf-8") != compile_source(COST_PROGRAM, path=str(src), opt=level):
+                return f"quinc -O{level} differs from compile_source"
+        if quinc(str(src), "-O3").returncode != 2:
+            return "quinc accepted -O3"
+    return None
+
+def streamed(src: str, path: str, **options) -> Tuple[str, str]:
+    # What compile_source returns and what it writes when streaming
+    out = io.StringIO()
+    returned = compile_source(src, path=path, out=out, **options)
+    return returned, out.getvalue()
+
+def check_streaming() -> Optional[str]:
+    # Streaming to `out` writes what compile_source would return, line map
+    # included, whether functions are generated, reused from the cache or linked
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, text in MODULES.items():
+            (Path(tmp) / f"{name}.ql").write_text(text, encoding="utf-8")
+        cases = [(str(p), p.read_text(encoding="utf-8")) for p in sorted((TESTS_DIR / "ql").glob("*.ql"))]
+        cases += [(str(Path(tmp) / "main.ql"), MODULES["main"]), ("many.ql", synth.many_functions(100))]
+        for level in OPT_LEVELS:
+            cache = CompileCache(Path(tmp) / f"cache{level}")
+            for path, src in cases:
+                asm = compile_source(src, path=path, opt=level)
+                # Cold, then with every function reused
+                for run in ("", " (cached)", " (cached)"):
+                    if streamed(src, path, opt=level, cache=cache if run else None) != ("", asm):
+                        return f"{path} -O{level}{run}: streamed output differs"
+                for comments in (False, True):
+                    expected, got = LineMap(path, comments=comments), LineMap(path, comments=comments)
+                    asm = compile_source(src, path=path, opt=level, line_map=expected)
+                    if streamed(src, path, opt=level, line_map=got) != ("", asm) or got != expected:
+                        return f"{path} -O{level}: streamed line map differs"
+        # write_asm writes the same text, or copies it from the cache
+        path, src = cases[-2]
+        out, cache = Path(tmp) / "out" / "main.asm", CompileCache(Path(tmp) / "cache")
+        for with_cache, cached in ((None, False), (cache, False), (cache, True)):
+            if write_asm(src.encode("utf-8"), path, out, with_cache) != cached:
+                return f"write_asm: cached is {not cached}, expected {cached}"
+            if out.read_text(encoding="utf-8") != compile_source(src, path=path):
+                return f"write_asm{' (cached)' * cached} wrote a different program"
+        # A failed compilation leaves the old output alone
+        try:
+            write_asm(b"fn main() { print(; }", "bad.ql", out)
+        except ParseError:
+            pass
+        if out.read_text(encoding="utf-8") != compile_source(src, path=path) or len(list(out.parent.iterdir())) != 1:
+            return f"failed write_asm left {sorted(p.name for p in out.parent.iterdir())}"
+    # The output never sits in memory as one string, so code generation
+    # peaks lower by more than its size
+    src = synth.many_functions(1000)
+    in_memory, streaming = PassManager(track_memory=True), PassManager(track_memory=True)
+    size = len(compile_source(src, in_memory))
+    with open(os.devnull, "w", encoding="utf-8") as f:
+        compile_source(src, streaming, out=f)
+    peaks = [next(t.peak_bytes for t in pm.timings if t.name == "codegen") for pm in (in_memory, streaming)]
+    if peaks[1] > peaks[0] - size:
+        return f"streaming peaked at {peaks[1]} bytes against {peaks[0]} for {size} bytes of output"
+    return None
+
+def write_corpus(out_dir: Path) -> List[Path]:
+    # The code generated for every benchmark and test program at every level,
+    # plus the hand-written sources in tests/asm
+    paths = []
+    for path in sorted((ROOT / "benchmarks").glob("*.ql")) + sorted((TESTS_DIR / "ql").glob("*.ql")):
+        for level in OPT_LEVELS:
+            out = out_dir / f"{path.parent.name}_{path.stem}_O{level}.asm"
+            out.write_text(compile_source(path.read_text(encoding="utf-8"), path=str(path), opt=level),
+                           encoding="utf-8")
+            paths.append(out)
+    return paths + sorted((TESTS_DIR / "asm").glob("*.asm"))
+
+def check_corpus(compare: Callable[[Sequence[Path]], bool]) -> Optional[str]:
+    # Run `compare` over the corpus, reporting what it prints for failures
+    report = io.StringIO()
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(report):
+        ok = compare(write_corpus(Path(tmp)))
+    if ok:
+        return None
+    return "\n".join(line for line in report.getvalue().splitlines() if ": ok (" not in line)
+
+def check_nasm_corpus() -> Optional[str]:
+    # The in-process assembler must produce what nasm does, byte for byte
+    if shutil.which("nasm") is None:
+        raise Skip("nasm not found on PATH")
+    return check_corpus(compare_with_nasm)
+
+def check_binutils_corpus() -> Optional[str]:
+    # Each instruction must decode as its source with objdump and re-encode
+    # to the same bytes with GNU as
+    if shutil.which("objdump") is None or shutil.which("as") is None:
+        raise Skip("objdump and as (GNU binutils) not found on PATH")
+    return check_corpus(check_with_binutils)
+
+CHECKS: Dict[str, Callable[[], Optional[str]]] = {
+    "assembler": check_assembler,
+    "batch_build": check_batch_build,
+    "benchmark_tracker": check_benchmark_tracker,
+    "binutils_corpus": check_binutils_corpus,
+    "bounds_elision": check_bounds_elision,
+    "compile_cache": check_compile_cache,
+    "cost_model": check_cost_model,
+    "deep_nesting": check_deep_nesting,
+    "imports": check_imports,
+    "incremental": check_incremental,
+    "line_map": check_line_map,
+    "nasm_corpus": check_nasm_corpus,
+    "parallel_codegen": check_parallel_codegen,
+    "pass_stats": check_pass_stats,
+    "pgo": check_pgo,
+    "serve_requests": check_serve_requests,
+    "serve_shutdown": check_serve_shutdown,
+    "simulator": check_simulator,
+    "streaming": check_streaming,
+}
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Run the QuinLang regression tests")
+    ap.add_argument("names", nargs="*", help="Tests to run (default: all)")
+    args = ap.parse_args(argv)
+    paths = sorted((TESTS_DIR / "ql").glob("*.ql"))
+    checks = sorted(CHECKS)
+    if args.names:
+        paths = [p for p in paths if p.stem in args.names]
+        checks = [name for name in checks if name in args.names]
+    failed = skipped = 0
+    for path in paths:
+        expected = path.with_suffix(".out").read_bytes()
+        for level in OPT_LEVELS:
+            try:
+                got = run_program(path, level)
+            except Exception as e:
+                got = f"{type(e).__name__}: {e}".encode("utf-8")
+            if got != expected:
+                failed += 1
+                print(f"FAIL {path.stem} -O{level}: expected {expected!r}, got {got!r}")
+    for name in checks:
+        try:
+            error = CHECKS[name]()
+        except Skip as e:
+            skipped += 1
+            print(f"SKIP {name}: {e}")
+            continue
+        if error is not None:
+            failed += 1
+            print(f"FAIL {name}: {error}")
+    print(f"{len(paths) + len(checks)} test(s), {failed} failure(s), {skipped} skipped")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()